@@ -1,10 +1,21 @@
+import asyncio
+import functools
+import hashlib
+import html
 import json
 import os
 import sqlite3
+import threading
+import time
+import unicodedata
 import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, Form, HTTPException, Request
+from urllib.parse import urlsplit
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, Form, HTTPException, Request, Depends
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 from passlib.context import CryptContext
@@ -60,338 +71,3576 @@ def decode_token(token: str) -> Optional[dict]:
         return None
 
 
-def get_db(path: str):
-    conn = sqlite3.connect(path)
-    conn.row_factory = sqlite3.Row
-    return conn
+# ========== POOL DE CONEXÕES SQLITE ==========
+# Uma conexão por chamada custava setup + fsync do journal em todo request e
+# gerava "database is locked" com escritores concorrentes. Cada banco agora tem
+# um pool de conexões em modo WAL, reaproveitadas entre requests. Toda conexão
+# anexa os outros dois bancos, então uma query pode juntar users, círculos e
+# mensagens; continua valendo escrever cada tabela pela conexão do seu banco.
+DB_POOL_SIZE = int(os.environ.get("LUMINA_DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("LUMINA_DB_POOL_TIMEOUT", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("LUMINA_DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = 64 * 1024 * 1024
+DB_CACHE_KIB = 16 * 1024
+# NORMAL em WAL pode perder os últimos commits numa queda de energia (nunca corrompe); FULL faz fsync a cada commit
+DB_SYNCHRONOUS = os.environ.get("LUMINA_DB_SYNCHRONOUS", "NORMAL").upper()
+
+
+class DBPool:
+    """Pool thread-safe de conexões para um arquivo SQLite."""
+
+    def __init__(self, path: str, max_size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._cond = threading.Condition()
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # Os outros bancos ficam anexados com o nome do schema (users_db, circles_db,
+        # messages_db): joins entre arquivos viram uma query só, sem costura em Python
+        for path, schema in DB_SCHEMAS.items():
+            if path != self.path:
+                conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+                conn.execute(f"PRAGMA {schema}.synchronous={DB_SYNCHRONOUS}")
+        return conn
+
+    def acquire(self):
+        with self._cond:
+            self.checkouts += 1
+            if not self._idle and self.open >= self.max_size:
+                self.waits += 1
+                start = time.monotonic()
+                ok = self._cond.wait_for(lambda: self._idle or self.open < self.max_size, self.timeout)
+                self.wait_time += time.monotonic() - start
+                if not ok:
+                    self.timeouts += 1
+                    raise HTTPException(status_code=503, detail="Banco de dados ocupado, tente novamente")
+            self.in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            self.open += 1
+        # Abre fora do lock; se falhar, devolve a vaga
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self.open -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Conexão quebrada: descarta em vez de devolver ao pool
+            with self._cond:
+                self.open -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            conn.close()
+            return
+        with self._cond:
+            self.in_use -= 1
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self.open -= len(idle)
+        for conn in idle:
+            conn.close()
 
+    def stats(self):
+        with self._cond:
+            return {
+                "open": self.open,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "max_size": self.max_size,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time_ms": round(self.wait_time * 1000, 2),
+                "timeouts": self.timeouts,
+            }
+
+
+DB_SCHEMAS = {USERS_DB: "users_db", CIRCLES_DB: "circles_db", MESSAGES_DB: "messages_db"}
+DB_POOLS = {path: DBPool(path) for path in DB_SCHEMAS}
+
+
+@contextmanager
+def db_conn(path: str):
+    """Empresta uma conexão do pool. Faz commit ao sair sem erro e rollback se houver exceção."""
+    pool = DB_POOLS[path]
+    conn = pool.acquire()
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    finally:
+        pool.release(conn)
 
-def init_users_db():
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS users (
-        id TEXT PRIMARY KEY,
-        username TEXT UNIQUE NOT NULL,
-        display_name TEXT,
-        password_hash TEXT NOT NULL,
-        avatar_color TEXT DEFAULT '#ff7b72',
-        avatar_image TEXT DEFAULT '/static/cosmic_aero/alpacas/alpaca_gray.png',
-        status TEXT DEFAULT 'online',
-        bio TEXT DEFAULT '',
-        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS friendships (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        friend_id TEXT NOT NULL,
-        status TEXT DEFAULT 'pending',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(user_id, friend_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS direct_chats (
-        id TEXT PRIMARY KEY,
-        user1_id TEXT NOT NULL,
-        user2_id TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(user1_id, user2_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS friend_notes (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        friend_id TEXT NOT NULL,
-        note TEXT DEFAULT '',
-        UNIQUE(user_id, friend_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS friend_nicknames (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        friend_id TEXT NOT NULL,
-        nickname TEXT DEFAULT '',
-        UNIQUE(user_id, friend_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS blocks (
-        id TEXT PRIMARY KEY,
-        user_id TEXT NOT NULL,
-        blocked_id TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(user_id, blocked_id)
-    )""")
-    conn.commit()
-    conn.close()
 
+def db_pool_stats():
+    return {os.path.basename(path): pool.stats() for path, pool in DB_POOLS.items()}
 
-def migrate_users_db():
-    """Adiciona colunas novas se não existirem"""
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(users)")
-    cols = [col[1] for col in c.fetchall()]
-    if 'avatar_image' not in cols:
-        c.execute("ALTER TABLE users ADD COLUMN avatar_image TEXT DEFAULT '/static/cosmic_aero/alpacas/alpaca_gray.png'")
-        conn.commit()
-    if 'bio' not in cols:
-        c.execute("ALTER TABLE users ADD COLUMN bio TEXT DEFAULT ''")
-        conn.commit()
-    conn.close()
+
+# ========== ACESSO ASSÍNCRONO AO BANCO ==========
+# Os handlers de WebSocket são async: qualquer query síncrona ali trava todos os
+# sockets do worker. run_db() manda o trabalho para um executor dedicado (com
+# concorrência limitada ao número de threads) e libera o loop para o fan-out.
+DB_EXECUTOR_WORKERS = int(os.environ.get("LUMINA_DB_WORKERS", "4"))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="quizcord-db")
+_db_exec_stats = {"calls": 0, "pending": 0, "max_pending": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+
+async def run_db(fn, *args, **kwargs):
+    """Executa uma função síncrona de banco no executor dedicado e aguarda o resultado."""
+    loop = asyncio.get_running_loop()
+    stats = _db_exec_stats
+    stats["calls"] += 1
+    stats["pending"] += 1
+    stats["max_pending"] = max(stats["max_pending"], stats["pending"])
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        stats["pending"] -= 1
+        stats["total_ms"] += elapsed
+        stats["max_ms"] = max(stats["max_ms"], elapsed)
+
+
+def db_executor_stats():
+    stats = dict(_db_exec_stats)
+    stats["workers"] = DB_EXECUTOR_WORKERS
+    stats["avg_ms"] = round(stats["total_ms"] / stats["calls"], 3) if stats["calls"] else 0.0
+    stats["total_ms"] = round(stats["total_ms"], 2)
+    stats["max_ms"] = round(stats["max_ms"], 2)
+    return stats
+
+
+class LoopMonitor:
+    """Mede quanto tempo o event loop ficou bloqueado (atraso de um sleep periódico)."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.max_block = 0.0
+        self.last_block = 0.0
+        self.samples = 0
+        self.slow_ticks = 0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            block = max(0.0, loop.time() - start - self.interval)
+            self.samples += 1
+            self.last_block = block
+            if block > self.max_block:
+                self.max_block = block
+            if block > 0.1:
+                self.slow_ticks += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            "max_block_ms": round(self.max_block * 1000, 2),
+            "last_block_ms": round(self.last_block * 1000, 2),
+            "samples": self.samples,
+            "slow_ticks": self.slow_ticks,
+        }
+
+
+loop_monitor = LoopMonitor()
+
+
+def init_users_db():
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            display_name TEXT,
+            password_hash TEXT NOT NULL,
+            avatar_color TEXT DEFAULT '#ff7b72',
+            avatar_image TEXT DEFAULT '/static/cosmic_aero/alpacas/alpaca_gray.png',
+            status TEXT DEFAULT 'online',
+            bio TEXT DEFAULT '',
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS friendships (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            friend_id TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, friend_id)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS direct_chats (
+            id TEXT PRIMARY KEY,
+            user1_id TEXT NOT NULL,
+            user2_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user1_id, user2_id)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS friend_notes (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            friend_id TEXT NOT NULL,
+            note TEXT DEFAULT '',
+            UNIQUE(user_id, friend_id)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS friend_nicknames (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            friend_id TEXT NOT NULL,
+            nickname TEXT DEFAULT '',
+            UNIQUE(user_id, friend_id)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS blocks (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            blocked_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, blocked_id)
+        )""")
 
 
 def _require_circle_member(circle_id: str, user_id: str):
     """Verifica se o usuário é membro do círculo. Levanta 403 se não for."""
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT role FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle_id, user_id))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    role = access_cache.circle_roles(circle_id).get(user_id)
+    if role is None:
         raise HTTPException(status_code=403, detail="Acesso negado: voce nao e membro deste circulo")
-    return row["role"]
+    return role
 
 
 def _require_dm_participant(chat_id: str, user_id: str):
     """Verifica se o usuário é participante da DM. Levanta 403 se não for."""
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT user1_id, user2_id FROM direct_chats WHERE id = ?", (chat_id,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    pair = access_cache.dm_participants(chat_id)
+    if pair is None:
         raise HTTPException(status_code=404, detail="Chat nao encontrado")
-    if row["user1_id"] != user_id and row["user2_id"] != user_id:
+    if user_id not in pair:
         raise HTTPException(status_code=403, detail="Acesso negado: voce nao participa desta conversa")
 
 
+def _require_topic_member(topic_id: str, user_id: str):
+    """Resolve o círculo do tópico e verifica se o usuário é membro."""
+    circle_id = access_cache.topic_circle(topic_id)
+    if circle_id is None:
+        raise HTTPException(status_code=404, detail="Topico nao encontrado")
+    return _require_circle_member(circle_id, user_id)
+
+
+def _require_room_access(room_id: str, user_id: str):
+    """Valida acesso a um room do WebSocket ("topic:<id>" ou "dm:<id>")."""
+    if room_id.startswith("topic:"):
+        _require_topic_member(room_id.split(":", 1)[1], user_id)
+    elif room_id.startswith("dm:"):
+        _require_dm_participant(room_id.split(":", 1)[1], user_id)
+
 
 def init_circles_db():
-    conn = sqlite3.connect(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS circles (
-        id TEXT PRIMARY KEY,
-        name TEXT NOT NULL,
-        owner_id TEXT NOT NULL,
-        color TEXT DEFAULT '#a78bfa',
-        icon_url TEXT,
-        invite_code TEXT UNIQUE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS circle_members (
-        id TEXT PRIMARY KEY,
-        circle_id TEXT NOT NULL,
-        user_id TEXT NOT NULL,
-        role TEXT DEFAULT 'member',
-        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(circle_id, user_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS topics (
-        id TEXT PRIMARY KEY,
-        circle_id TEXT NOT NULL,
-        name TEXT NOT NULL,
-        type TEXT DEFAULT 'text',
-        position INTEGER DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-    conn.commit()
-    conn.close()
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS circles (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            owner_id TEXT NOT NULL,
+            color TEXT DEFAULT '#a78bfa',
+            icon_url TEXT,
+            invite_code TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS circle_members (
+            id TEXT PRIMARY KEY,
+            circle_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            role TEXT DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(circle_id, user_id)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS topics (
+            id TEXT PRIMARY KEY,
+            circle_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            type TEXT DEFAULT 'text',
+            position INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
 
 
 def init_messages_db():
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        room_id TEXT NOT NULL,
-        user_id TEXT,
-        user_name TEXT NOT NULL,
-        user_color TEXT,
-        content TEXT NOT NULL,
-        msg_type TEXT DEFAULT 'text',
-        file_url TEXT,
-        reply_to_id INTEGER,
-        reply_to_user TEXT,
-        reply_to_content TEXT,
-        edited_at TIMESTAMP,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS reactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        message_id INTEGER NOT NULL,
-        user_id TEXT NOT NULL,
-        emoji TEXT NOT NULL,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(message_id, user_id, emoji)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS unread (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT NOT NULL,
-        room_id TEXT NOT NULL,
-        count INTEGER DEFAULT 1,
-        last_message_id INTEGER,
-        UNIQUE(user_id, room_id)
-    )""")
-    conn.commit()
-    conn.close()
+    with db_conn(MESSAGES_DB) as conn:
+        c = conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT NOT NULL,
+            user_id TEXT,
+            user_name TEXT NOT NULL,
+            user_color TEXT,
+            content TEXT NOT NULL,
+            msg_type TEXT DEFAULT 'text',
+            file_url TEXT,
+            reply_to_id INTEGER,
+            reply_to_user TEXT,
+            reply_to_content TEXT,
+            edited_at TIMESTAMP,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS reactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            emoji TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(message_id, user_id, emoji)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS unread (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            room_id TEXT NOT NULL,
+            count INTEGER DEFAULT 1,
+            last_message_id INTEGER,
+            UNIQUE(user_id, room_id)
+        )""")
 
 
 init_users_db()
 init_circles_db()
 init_messages_db()
-migrate_users_db()
 
 
 def init_reports_db():
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS reports (
-        id TEXT PRIMARY KEY,
-        reporter_id TEXT NOT NULL,
-        target_id TEXT,
-        target_type TEXT DEFAULT 'message',
-        room_id TEXT,
-        message_id INTEGER,
-        reason TEXT NOT NULL,
-        details TEXT DEFAULT '',
-        status TEXT DEFAULT 'open',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        resolved_at TIMESTAMP,
-        resolved_by TEXT
-    )""")
-    conn.commit()
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS reports (
+            id TEXT PRIMARY KEY,
+            reporter_id TEXT NOT NULL,
+            target_id TEXT,
+            target_type TEXT DEFAULT 'message',
+            room_id TEXT,
+            message_id INTEGER,
+            reason TEXT NOT NULL,
+            details TEXT DEFAULT '',
+            status TEXT DEFAULT 'open',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            resolved_at TIMESTAMP,
+            resolved_by TEXT
+        )""")
 
 init_reports_db()
 
 
+# ========== MIGRAÇÕES DE SCHEMA ==========
+# Os init_*_db() criam o schema base (versão 0). Cada banco guarda a versão
+# aplicada em PRAGMA user_version; no startup só rodam as migrações com número
+# maior, cada uma na sua transação. Nunca edite uma migração já publicada —
+# acrescente uma nova no fim da lista.
+
+def _users_add_profile_columns(conn):
+    """Adiciona colunas novas se não existirem (bancos criados antes de avatar_image/bio)"""
+    cols = [col[1] for col in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if 'avatar_image' not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN avatar_image TEXT DEFAULT '/static/cosmic_aero/alpacas/alpaca_gray.png'")
+    if 'bio' not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN bio TEXT DEFAULT ''")
+
+
+def _apply_reaction(reactions: dict, emoji: str, user_id: str, added: bool) -> dict:
+    """Aplica um delta de reação e devolve um mapa novo (o original pode estar em uso no cache)."""
+    users = list(reactions.get(emoji, {}).get("users", ()))
+    if added and user_id not in users:
+        users.append(user_id)
+    elif not added and user_id in users:
+        users.remove(user_id)
+    out = dict(reactions)
+    if users:
+        out[emoji] = {"count": len(users), "users": users}
+    else:
+        out.pop(emoji, None)
+    return out
+
+
+def _search_key(text) -> str:
+    """Forma normalizada para busca de usuários: minúsculas, sem acentos, espaços colapsados."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return " ".join("".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold().split())
+
+
+def _index_user_search(conn, user_id: str, username: str, display_name):
+    conn.execute("""INSERT INTO user_search (user_id, username_key, name_key) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET username_key = excluded.username_key, name_key = excluded.name_key""",
+        (user_id, _search_key(username), _search_key(display_name or username)))
+
+
+def _users_add_search_index(conn):
+    """Índice de busca de usuários: chaves normalizadas (prefixo via índice) + FTS5 trigram (substring/fuzzy).
+
+    user_search tem rowid próprio (INTEGER PRIMARY KEY): o rowid implícito de users pode
+    mudar num VACUUM e desalinharia o índice FTS. As chaves são calculadas em Python
+    (_search_key) no cadastro e na troca de display_name; os triggers só propagam para o FTS.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS user_search (
+        rid INTEGER PRIMARY KEY,
+        user_id TEXT UNIQUE NOT NULL,
+        username_key TEXT NOT NULL,
+        name_key TEXT NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_search_username ON user_search(username_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_search_name ON user_search(name_key)")
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS user_search_fts USING fts5(
+        username_key, name_key, content='user_search', content_rowid='rid', tokenize='trigram')""")
+    conn.executemany("INSERT OR IGNORE INTO user_search (user_id, username_key, name_key) VALUES (?, ?, ?)",
+                     ((uid, _search_key(username), _search_key(name or username))
+                      for uid, username, name in conn.execute("SELECT id, username, display_name FROM users").fetchall()))
+    conn.execute("INSERT INTO user_search_fts (user_search_fts) VALUES ('rebuild')")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS user_search_fts_insert AFTER INSERT ON user_search BEGIN
+        INSERT INTO user_search_fts (rowid, username_key, name_key) VALUES (new.rid, new.username_key, new.name_key);
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS user_search_fts_delete AFTER DELETE ON user_search BEGIN
+        INSERT INTO user_search_fts (user_search_fts, rowid, username_key, name_key) VALUES ('delete', old.rid, old.username_key, old.name_key);
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS user_search_fts_update AFTER UPDATE ON user_search BEGIN
+        INSERT INTO user_search_fts (user_search_fts, rowid, username_key, name_key) VALUES ('delete', old.rid, old.username_key, old.name_key);
+        INSERT INTO user_search_fts (rowid, username_key, name_key) VALUES (new.rid, new.username_key, new.name_key);
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+        DELETE FROM user_search WHERE user_id = old.id;
+    END""")
+
+
+def _messages_add_reaction_summary(conn):
+    """Agregado de reações materializado em messages.reactions ({emoji: {count, users}} em JSON).
+
+    A tabela reactions continua sendo a fonte da unicidade (user, emoji); a coluna evita
+    reler todas as reações da mensagem a cada toggle e a cada página de histórico.
+    """
+    cols = [col[1] for col in conn.execute("PRAGMA table_info(messages)").fetchall()]
+    if 'reactions' not in cols:
+        conn.execute("ALTER TABLE messages ADD COLUMN reactions TEXT")
+    summary = {}
+    for r in conn.execute("SELECT message_id, user_id, emoji FROM reactions ORDER BY id"):
+        summary[r["message_id"]] = _apply_reaction(summary.get(r["message_id"], {}), r["emoji"], r["user_id"], True)
+    conn.executemany("UPDATE messages SET reactions = ? WHERE id = ?",
+                     [(json.dumps(rx, ensure_ascii=False), mid) for mid, rx in summary.items()])
+
+
+def _messages_add_search_index(conn):
+    """Índice FTS5 de messages.content (external content: o texto não é duplicado).
+
+    O room também é indexado, como um token só (room_key = room_id sem ":", via a view
+    de conteúdo): o filtro pelos rooms do usuário entra no próprio MATCH e a busca não
+    precisa visitar em messages cada linha que casou com os termos.
+    Triggers mantêm o índice em dia com insert/edit/delete de qualquer caminho. As
+    linhas que já existiam são indexadas depois, em lotes (ver BUSCA): até lá uma
+    linha só está no índice se id > upto_id (entrou pelo trigger) ou id < next_id
+    (já passou pelo backfill), e os triggers de edit/delete respeitam isso para
+    nunca remover do índice algo que não foi indexado.
+    """
+    conn.execute("""CREATE VIEW IF NOT EXISTS messages_fts_content AS
+        SELECT id, content, replace(room_id, ':', '') AS room_key FROM messages""")
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, room_key, content='messages_fts_content', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS search_backfill (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        next_id INTEGER NOT NULL,
+        upto_id INTEGER NOT NULL
+    )""")
+    upto = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    conn.execute("INSERT OR REPLACE INTO search_backfill (id, next_id, upto_id) VALUES (1, 1, ?)", (upto,))
+    indexed = "(SELECT old.id > upto_id OR old.id < next_id FROM search_backfill)"
+    # AUTOINCREMENT: ids novos são sempre > upto_id, então o insert não precisa de guarda
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content, room_key) VALUES (new.id, new.content, replace(new.room_id, ':', ''));
+    END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages WHEN {indexed} BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, room_key) VALUES ('delete', old.id, old.content, replace(old.room_id, ':', ''));
+    END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages WHEN {indexed} BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, room_key) VALUES ('delete', old.id, old.content, replace(old.room_id, ':', ''));
+        INSERT INTO messages_fts (rowid, content, room_key) VALUES (new.id, new.content, replace(new.room_id, ':', ''));
+    END""")
+
+
+MIGRATIONS = {
+    USERS_DB: [
+        (1, _users_add_profile_columns),
+        (2, [
+            # friendships(user_id, ...) já é coberto pelo UNIQUE(user_id, friend_id)
+            "CREATE INDEX IF NOT EXISTS idx_friendships_friend_status ON friendships(friend_id, status)",
+            # direct_chats(user1_id, ...) já é coberto pelo UNIQUE(user1_id, user2_id)
+            "CREATE INDEX IF NOT EXISTS idx_direct_chats_user2 ON direct_chats(user2_id)",
+            "CREATE INDEX IF NOT EXISTS idx_reports_reporter_status ON reports(reporter_id, status, created_at)",
+        ]),
+        (3, _users_add_search_index),
+    ],
+    CIRCLES_DB: [
+        (1, [
+            "CREATE INDEX IF NOT EXISTS idx_circle_members_user ON circle_members(user_id, role)",
+            "CREATE INDEX IF NOT EXISTS idx_topics_circle_position ON topics(circle_id, position)",
+        ]),
+    ],
+    MESSAGES_DB: [
+        (1, [
+            "CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages(room_id, id DESC)",
+            # reactions(message_id) e unread(user_id) já são cobertos pelos índices UNIQUE
+        ]),
+        (2, [
+            # Modo de não lidas por marcador de leitura (LUMINA_UNREAD_MODE=marker)
+            """CREATE TABLE IF NOT EXISTS read_markers (
+                user_id TEXT NOT NULL,
+                room_id TEXT NOT NULL,
+                last_read_id INTEGER NOT NULL,
+                PRIMARY KEY (user_id, room_id)
+            )""",
+        ]),
+        (3, _messages_add_reaction_summary),
+        (4, _messages_add_search_index),
+        (5, [
+            # Uploads endereçados por conteúdo: um arquivo por SHA-256, com contagem de referências
+            """CREATE TABLE IF NOT EXISTS uploads (
+                sha256 TEXT PRIMARY KEY,
+                url TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL DEFAULT 0,
+                upload_count INTEGER NOT NULL DEFAULT 1,
+                touched_at INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            # touched_at = último upload ou última referência removida; o GC conta a carência daí
+            "CREATE INDEX IF NOT EXISTS idx_uploads_orphans ON uploads(touched_at) WHERE refs = 0",
+            """CREATE TABLE IF NOT EXISTS message_uploads (
+                message_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (message_id, sha256)
+            ) WITHOUT ROWID""",
+            # Triggers: qualquer caminho que grava messages (write-behind, edição, delete) mantém os refs
+            """CREATE TRIGGER IF NOT EXISTS messages_uploads_insert AFTER INSERT ON messages WHEN new.file_url IS NOT NULL BEGIN
+                INSERT OR IGNORE INTO message_uploads (message_id, sha256) SELECT new.id, sha256 FROM uploads WHERE url = new.file_url;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS messages_uploads_update AFTER UPDATE OF file_url ON messages BEGIN
+                DELETE FROM message_uploads WHERE message_id = old.id;
+                INSERT OR IGNORE INTO message_uploads (message_id, sha256) SELECT new.id, sha256 FROM uploads WHERE url = new.file_url;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS messages_uploads_delete AFTER DELETE ON messages WHEN old.file_url IS NOT NULL BEGIN
+                DELETE FROM message_uploads WHERE message_id = old.id;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS message_uploads_ref AFTER INSERT ON message_uploads BEGIN
+                UPDATE uploads SET refs = refs + 1 WHERE sha256 = new.sha256;
+            END""",
+            """CREATE TRIGGER IF NOT EXISTS message_uploads_unref AFTER DELETE ON message_uploads BEGIN
+                UPDATE uploads SET refs = refs - 1, touched_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE sha256 = old.sha256;
+            END""",
+        ]),
+        (6, [
+            # Cada upload ganha um nome opaco (hard link para o blob): a URL não sai do conteúdo
+            """CREATE TABLE IF NOT EXISTS upload_names (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL
+            ) WITHOUT ROWID""",
+            "CREATE INDEX IF NOT EXISTS idx_upload_names_sha256 ON upload_names(sha256)",
+            "INSERT OR IGNORE INTO upload_names (url, sha256) SELECT url, sha256 FROM uploads",
+            "DROP TRIGGER IF EXISTS messages_uploads_insert",
+            "DROP TRIGGER IF EXISTS messages_uploads_update",
+            """CREATE TRIGGER messages_uploads_insert AFTER INSERT ON messages WHEN new.file_url IS NOT NULL BEGIN
+                INSERT OR IGNORE INTO message_uploads (message_id, sha256) SELECT new.id, sha256 FROM upload_names WHERE url = new.file_url;
+            END""",
+            """CREATE TRIGGER messages_uploads_update AFTER UPDATE OF file_url ON messages BEGIN
+                DELETE FROM message_uploads WHERE message_id = old.id;
+                INSERT OR IGNORE INTO message_uploads (message_id, sha256) SELECT new.id, sha256 FROM upload_names WHERE url = new.file_url;
+            END""",
+        ]),
+    ],
+}
+
+
+def run_migrations(path: str, migrations):
+    with db_conn(path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, step in migrations:
+            if target <= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            if callable(step):
+                step(conn)
+            else:
+                for sql in step:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {int(target)}")
+            conn.commit()
+            version = target
+        conn.execute("PRAGMA optimize")
+    return version
+
+
+def schema_versions():
+    versions = {}
+    for path in MIGRATIONS:
+        with db_conn(path) as conn:
+            versions[os.path.basename(path)] = conn.execute("PRAGMA user_version").fetchone()[0]
+    return versions
+
+
+for _path, _steps in MIGRATIONS.items():
+    run_migrations(_path, _steps)
+
+
+# Queries quentes que precisam usar índice. check_query_plans() roda o
+# EXPLAIN QUERY PLAN de cada uma e acusa full scan ou sort em B-tree temporária.
+HOT_QUERIES = [
+    (MESSAGES_DB, "history", "SELECT m.id, u.avatar_image FROM messages m LEFT JOIN users_db.users u ON u.id = m.user_id WHERE m.room_id = ? ORDER BY m.id DESC LIMIT ?", ("r", 50)),
+    (MESSAGES_DB, "unread_by_user", "SELECT room_id, count FROM unread WHERE user_id = ?", ("u",)),
+    (MESSAGES_DB, "unread_marker_count", "SELECT 1 FROM messages WHERE room_id = ? AND id > ? AND (user_id IS NULL OR user_id != ?) LIMIT ?", ("r", 0, "u", 100)),
+    (USERS_DB, "user_search_username", "SELECT user_id FROM user_search WHERE username_key >= ? AND username_key < ? LIMIT ?", ("a", "b", 20)),
+    (USERS_DB, "user_search_name", "SELECT user_id FROM user_search WHERE name_key >= ? AND name_key < ? LIMIT ?", ("a", "b", 20)),
+    (CIRCLES_DB, "topic_circle", "SELECT circle_id FROM topics WHERE id = ?", ("t",)),
+    (CIRCLES_DB, "topics_by_circle", "SELECT * FROM topics WHERE circle_id = ? ORDER BY position", ("c",)),
+    (CIRCLES_DB, "circle_membership", "SELECT role FROM circle_members WHERE circle_id = ? AND user_id = ?", ("c", "u")),
+    (CIRCLES_DB, "circles_by_user", "SELECT c.id FROM circles c JOIN circle_members m ON m.circle_id = c.id WHERE m.user_id = ?", ("u",)),
+    (USERS_DB, "friends_received", "SELECT f.id FROM friendships f JOIN users u ON u.id = f.user_id WHERE f.friend_id = ? AND f.status = 'accepted'", ("u",)),
+    (USERS_DB, "friends_sent", "SELECT f.id FROM friendships f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? AND f.status = 'accepted'", ("u",)),
+    (USERS_DB, "dm_chats_by_user", "SELECT id FROM direct_chats WHERE user1_id = ? OR user2_id = ?", ("u", "u")),
+]
+
+
+def check_query_plans():
+    """Retorna {nome: {"plan": [...], "ok": bool}} para cada query de HOT_QUERIES."""
+    report = {}
+    for path, name, sql, params in HOT_QUERIES:
+        with db_conn(path) as conn:
+            plan = [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        bad = [d for d in plan if d.startswith("SCAN") or "TEMP B-TREE" in d]
+        report[name] = {"plan": plan, "ok": not bad}
+    return report
+
+
+# Os planos só mudam com o esquema (migrações rodam no import): calculados uma vez, o
+# /api/metrics serve este resultado
+QUERY_PLANS = check_query_plans()
+_slow_plans = [name for name, r in QUERY_PLANS.items() if not r["ok"]]
+if _slow_plans:
+    import warnings
+    warnings.warn(f"Queries sem indice: {', '.join(_slow_plans)}")
+
+
+
+HISTORY_MAX_LIMIT = 200
+# Na reconexão o cliente manda o último id visto; se faltarem mais que isso, recebe o histórico completo
+HISTORY_DELTA_LIMIT = 200
+
+
+def _fetch_message_rows(c, room_id: str, limit: int, before_id=None, after_id=None):
+    """Busca linhas de messages pelo índice (room_id, id), sempre em ordem crescente de id.
+
+    O avatar atual do autor vem no mesmo statement, do users_db anexado.
+    """
+    cols = """m.id, m.room_id, m.user_id, m.user_name, m.user_color, m.content, m.msg_type, m.file_url,
+        m.reply_to_id, m.reply_to_user, m.reply_to_content, m.edited_at, m.timestamp, m.reactions, u.avatar_image"""
+    base = f"SELECT {cols} FROM messages m LEFT JOIN users_db.users u ON u.id = m.user_id WHERE m.room_id = ?"
+    if after_id is not None:
+        c.execute(base + " AND m.id > ? ORDER BY m.id ASC LIMIT ?", (room_id, after_id, limit))
+        return c.fetchall()
+    if before_id is not None:
+        c.execute(base + " AND m.id < ? ORDER BY m.id DESC LIMIT ?", (room_id, before_id, limit))
+    else:
+        c.execute(base + " ORDER BY m.id DESC LIMIT ?", (room_id, limit))
+    return list(reversed(c.fetchall()))
+
+
+LAST_MESSAGE_PREVIEW_CHARS = 120
 
-def _get_history(room_id: str, limit: int = 50):
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("""SELECT id, room_id, user_id, user_name, user_color, content, msg_type, file_url,
-        reply_to_id, reply_to_user, reply_to_content, edited_at, timestamp
-        FROM messages WHERE room_id = ? ORDER BY timestamp DESC LIMIT ?""", (room_id, limit))
-    rows = c.fetchall()
+
+def _hydrate_messages(c, rows):
+    """Monta os dicts de mensagem com avatar do autor e reações agregadas."""
     msgs = []
-    msg_ids = []
-    user_ids = set()
     for r in rows:
         d = dict(r)
-        uid = d.pop("user_id")
-        user_ids.add(uid)
-        d["user"] = {"id": uid, "name": d.pop("user_name"), "color": d.pop("user_color")}
-        msg_ids.append(d["id"])
+        d["user"] = {"id": d.pop("user_id"), "name": d.pop("user_name"), "color": d.pop("user_color")}
+        avatar = d.pop("avatar_image")
+        if avatar is not None:
+            d["user"]["avatar_image"] = avatar
+        d["reactions"] = codec.loads(d["reactions"]) if d["reactions"] else {}
         msgs.append(d)
-    # Buscar avatares dos usuários (banco separado)
-    if user_ids:
-        conn2 = get_db(USERS_DB)
-        c2 = conn2.cursor()
-        placeholders = ','.join('?' * len(user_ids))
-        c2.execute(f"SELECT id, avatar_image FROM users WHERE id IN ({placeholders})", list(user_ids))
-        avatar_map = {r["id"]: r["avatar_image"] for r in c2.fetchall()}
-        conn2.close()
-        for m in msgs:
-            uid = m["user"]["id"]
-            if uid and uid in avatar_map:
-                m["user"]["avatar_image"] = avatar_map[uid]
-    # Buscar reações
-    if msg_ids:
-        placeholders = ','.join('?' * len(msg_ids))
-        c.execute(f"SELECT message_id, user_id, emoji FROM reactions WHERE message_id IN ({placeholders})", msg_ids)
-        reactions = {}
-        for r in c.fetchall():
-            mid = r["message_id"]
-            if mid not in reactions:
-                reactions[mid] = {}
-            emoji = r["emoji"]
-            if emoji not in reactions[mid]:
-                reactions[mid][emoji] = {"count": 0, "users": []}
-            reactions[mid][emoji]["count"] += 1
-            reactions[mid][emoji]["users"].append(r["user_id"])
-        for m in msgs:
-            m["reactions"] = reactions.get(m["id"], {})
-    conn.close()
-    return list(reversed(msgs))
+    return msgs
+
+
+def _history_page(room_id: str, limit: int = 50, before_id=None, after_id=None, around_id=None):
+    """Página de histórico por cursor (keyset).
+
+    Sem cursor: as mais recentes. before_id: anteriores ao id. after_id: posteriores
+    ao id. around_id: metade antes (incluindo o próprio id) e metade depois.
+    next_cursor é o before_id da página anterior e newer_cursor o after_id da
+    seguinte; None quando não há mais mensagens naquela direção.
+    """
+    if sum(x is not None for x in (before_id, after_id, around_id)) > 1:
+        raise HTTPException(status_code=400, detail="Use apenas um de before_id, after_id ou around_id")
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    if before_id is None and around_id is None and limit <= history_cache.per_room:
+        page = history_cache.page(room_id, limit, after_id)
+        if page is None and after_id is None:
+            history_cache.load(room_id)
+            page = history_cache.page(room_id, limit)
+        if page is not None:
+            return page
+    with db_conn(MESSAGES_DB) as conn:
+        c = conn.cursor()
+        if around_id is not None:
+            n_old = limit - limit // 2
+            n_new = limit // 2
+            older = _fetch_message_rows(c, room_id, n_old + 1, before_id=around_id + 1)
+            newer = _fetch_message_rows(c, room_id, n_new + 1, after_id=around_id)
+            has_older = len(older) > n_old
+            has_newer = len(newer) > n_new
+            rows = (older[1:] if has_older else older) + newer[:n_new]
+        elif after_id is not None:
+            rows = _fetch_message_rows(c, room_id, limit + 1, after_id=after_id)
+            has_older = False
+            has_newer = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            rows = _fetch_message_rows(c, room_id, limit + 1, before_id=before_id)
+            has_older = len(rows) > limit
+            # before_id pode estar além da última mensagem (ou já ter sido removida)
+            has_newer = before_id is not None and c.execute(
+                "SELECT 1 FROM messages WHERE room_id = ? AND id >= ? LIMIT 1", (room_id, before_id)).fetchone() is not None
+            rows = rows[1:] if has_older else rows
+        msgs = _hydrate_messages(c, rows)
+    return {
+        "messages": msgs,
+        "next_cursor": msgs[0]["id"] if has_older and msgs else None,
+        "newer_cursor": msgs[-1]["id"] if has_newer and msgs else None,
+    }
 
 
-class RoomManager:
-    def __init__(self):
-        self.rooms = {}
-        self.user_info = {}
-        self.ws_by_user = {}
-        self.voice_users = {}
+def _history_frame(room_id: str, last_id=None):
+    """Frame "history" do WebSocket: só o delta após last_id quando o cliente reconecta."""
+    if last_id is not None:
+        page = _history_page(room_id, HISTORY_DELTA_LIMIT, after_id=last_id)
+        if page["newer_cursor"] is None:
+            return {"type": "history", "messages": page["messages"], "delta": True, "after_id": last_id}
+    page = _history_page(room_id, 50)
+    return {"type": "history", "messages": page["messages"], "next_cursor": page["next_cursor"]}
 
-    def connect(self, room_id, ws, user):
-        self.rooms.setdefault(room_id, []).append(ws)
-        self.user_info[ws] = user
-        self.ws_by_user[user["id"]] = ws
-
-    def disconnect(self, room_id, ws):
-        if room_id in self.rooms and ws in self.rooms[room_id]:
-            self.rooms[room_id].remove(ws)
-        user = self.user_info.pop(ws, {})
-        self.ws_by_user.pop(user.get("id"), None)
-        if room_id in self.voice_users and user.get("id") in self.voice_users.get(room_id, {}):
-            del self.voice_users[room_id][user["id"]]
-            if not self.voice_users[room_id]:
-                del self.voice_users[room_id]
-        if room_id in self.rooms and not self.rooms[room_id]:
-            del self.rooms[room_id]
-        return user
-
-    async def broadcast(self, room_id, msg, exclude=None):
-        if room_id not in self.rooms:
+
+def _parse_msg_id(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+# ========== CACHE DE HISTÓRICO (rooms quentes) ==========
+# Cada room quente guarda as últimas HISTORY_CACHE_PER_ROOM mensagens já montadas
+# (avatar + reações), mantidas em dia pelos caminhos de mensagem, edição, remoção
+# e reação. Os dicts são tratados como imutáveis: toda alteração substitui o dict,
+# então quem já pegou uma página pode serializá-la sem lock. Rooms saem por LRU
+# quando o total de mensagens passa de HISTORY_CACHE_MAX_MESSAGES.
+HISTORY_CACHE_PER_ROOM = int(os.environ.get("LUMINA_HISTORY_CACHE_PER_ROOM", str(HISTORY_DELTA_LIMIT)))
+HISTORY_CACHE_MAX_MESSAGES = int(os.environ.get("LUMINA_HISTORY_CACHE_MAX_MESSAGES", "50000"))
+
+
+def _db_now():
+    """Timestamp no mesmo formato do CURRENT_TIMESTAMP do SQLite (UTC)."""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class _RoomHistory:
+    __slots__ = ("msgs", "complete")
+
+    def __init__(self, msgs, complete):
+        self.msgs = deque(msgs)
+        # complete = o room inteiro cabe no buffer (não há mensagens mais antigas no banco)
+        self.complete = complete
+
+
+class HistoryCache:
+    def __init__(self, per_room: int = HISTORY_CACHE_PER_ROOM, max_messages: int = HISTORY_CACHE_MAX_MESSAGES):
+        self.per_room = per_room
+        self.max_messages = max_messages
+        self.rooms = OrderedDict()
+        self.index = {}
+        self.total = 0
+        self._gen = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def page(self, room_id: str, limit: int, after_id=None):
+        """Mesma forma de _history_page (sem before/around), ou None se o cache não cobre o pedido."""
+        with self._lock:
+            entry = self.rooms.get(room_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            msgs = entry.msgs
+            if after_id is None:
+                if len(msgs) < limit and not entry.complete:
+                    self.misses += 1
+                    return None
+                sel = list(msgs)[-limit:] if limit < len(msgs) else list(msgs)
+                has_older = len(msgs) > limit or not entry.complete
+                page = {"messages": sel, "next_cursor": sel[0]["id"] if has_older and sel else None, "newer_cursor": None}
+            else:
+                if not (entry.complete or (msgs and msgs[0]["id"] <= after_id)):
+                    self.misses += 1
+                    return None
+                sel = [m for m in msgs if m["id"] > after_id]
+                has_newer = len(sel) > limit
+                sel = sel[:limit]
+                page = {"messages": sel, "next_cursor": None, "newer_cursor": sel[-1]["id"] if has_newer and sel else None}
+            self.rooms.move_to_end(room_id)
+            self.hits += 1
+            return page
+
+    def load(self, room_id: str):
+        """Carrega as últimas mensagens do room do banco (chamar fora do event loop)."""
+        with self._lock:
+            gen = self._gen.get(room_id, 0)
+        with db_conn(MESSAGES_DB) as conn:
+            c = conn.cursor()
+            rows = _fetch_message_rows(c, room_id, self.per_room + 1)
+            complete = len(rows) <= self.per_room
+            msgs = _hydrate_messages(c, rows if complete else rows[1:])
+        with self._lock:
+            self.loads += 1
+            # Se o room mudou durante a leitura, descarta em vez de guardar algo desatualizado
+            if self._gen.get(room_id, 0) != gen or room_id in self.rooms:
+                return
+            self.rooms[room_id] = _RoomHistory(msgs, complete)
+            for m in msgs:
+                self.index[m["id"]] = room_id
+            self.total += len(msgs)
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_messages and len(self.rooms) > 1:
+            _, entry = self.rooms.popitem(last=False)
+            for m in entry.msgs:
+                self.index.pop(m["id"], None)
+            self.total -= len(entry.msgs)
+            self.evictions += 1
+
+    def _replace(self, room_id: str, msg_id, fn):
+        self._gen[room_id] = self._gen.get(room_id, 0) + 1
+        entry = self.rooms.get(room_id)
+        if entry is None or msg_id not in self.index:
             return
-        text = json.dumps(msg)
-        for conn in self.rooms[room_id][:]:
-            if conn == exclude:
+        for i, m in enumerate(entry.msgs):
+            if m["id"] == msg_id:
+                entry.msgs[i] = fn(m)
+                return
+
+    def on_message(self, room_id: str, msg: dict, share: bool = True):
+        if share:
+            self._share({"op": "message", "r": room_id, "m": msg})
+        with self._lock:
+            self._gen[room_id] = self._gen.get(room_id, 0) + 1
+            entry = self.rooms.get(room_id)
+            if entry is None or msg["id"] in self.index:
+                return
+            entry.msgs.append(msg)
+            self.index[msg["id"]] = room_id
+            self.total += 1
+            if len(entry.msgs) > self.per_room:
+                old = entry.msgs.popleft()
+                self.index.pop(old["id"], None)
+                self.total -= 1
+                entry.complete = False
+            self._evict()
+
+    def on_edit(self, room_id: str, msg_id, content: str, edited_at: str, share: bool = True):
+        if share:
+            self._share({"op": "edit", "r": room_id, "id": msg_id, "content": content, "edited_at": edited_at})
+        with self._lock:
+            self._replace(room_id, msg_id, lambda m: {**m, "content": content, "edited_at": edited_at})
+
+    def on_reaction(self, room_id: str, msg_id, emoji: str, user_id: str, added: bool, share: bool = True):
+        if share:
+            self._share({"op": "reaction", "r": room_id, "id": msg_id, "e": emoji, "u": user_id, "a": added})
+        with self._lock:
+            self._replace(room_id, msg_id, lambda m: {**m, "reactions": _apply_reaction(m["reactions"], emoji, user_id, added)})
+
+    def on_delete(self, room_id: str, msg_id, share: bool = True):
+        if share:
+            self._share({"op": "delete", "r": room_id, "id": msg_id})
+        with self._lock:
+            self._gen[room_id] = self._gen.get(room_id, 0) + 1
+            entry = self.rooms.get(room_id)
+            if entry is None or self.index.pop(msg_id, None) is None:
+                return
+            entry.msgs = deque(m for m in entry.msgs if m["id"] != msg_id)
+            self.total -= 1
+
+    def on_avatar(self, user_id: str, avatar_image: str, share: bool = True):
+        if share:
+            self._share({"op": "avatar", "u": user_id, "avatar_image": avatar_image})
+        with self._lock:
+            for room_id, entry in self.rooms.items():
+                self._gen[room_id] = self._gen.get(room_id, 0) + 1
+                entry.msgs = deque(
+                    {**m, "user": {**m["user"], "avatar_image": avatar_image}} if m["user"].get("id") == user_id else m
+                    for m in entry.msgs)
+
+    @staticmethod
+    def _share(event: dict):
+        # Os outros workers aplicam a mesma alteração no cache deles (ver BACKPLANE)
+        backplane.publish({"k": "cache", **event})
+
+    def apply_remote(self, event: dict):
+        """Alteração feita em outro worker; aplica sem republicar."""
+        op = event["op"]
+        if op == "message":
+            self.on_message(event["r"], event["m"], share=False)
+        elif op == "edit":
+            self.on_edit(event["r"], event["id"], event["content"], event["edited_at"], share=False)
+        elif op == "reaction":
+            self.on_reaction(event["r"], event["id"], event["e"], event["u"], event["a"], share=False)
+        elif op == "delete":
+            self.on_delete(event["r"], event["id"], share=False)
+        elif op == "avatar":
+            self.on_avatar(event["u"], event["avatar_image"], share=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "rooms": len(self.rooms),
+                "messages": self.total,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+history_cache = HistoryCache()
+
+
+# ========== OPERAÇÕES DE MENSAGEM (síncronas, rodam via run_db nos WebSockets) ==========
+
+def _ws_user(row) -> dict:
+    return {"id": row["id"], "name": row["display_name"] or row["username"], "color": row["avatar_color"], "avatar_image": row["avatar_image"] or "/static/cosmic_aero/alpacas/alpaca_gray.png", "is_guest": False}
+
+
+def _load_ws_user(user_id: str, room_id: str = None):
+    """Usuário do handshake do WebSocket, já validando o acesso ao room (se houver).
+
+    Retorna None se o usuário não existe ou não pode entrar no room.
+    """
+    if room_id is not None and not access_cache.room_allowed(room_id, user_id):
+        return None
+    with db_conn(USERS_DB) as conn:
+        row = conn.execute("SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE id = ?", (user_id,)).fetchone()
+    return _ws_user(row) if row else None
+
+
+def _edit_own_message(msg_id, user_id: str, content: str):
+    """Edita se a mensagem for do usuário. Retorna o room_id, ou None sem permissão."""
+    edited_at = _db_now()
+    with db_conn(MESSAGES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT room_id, user_id FROM messages WHERE id = ?", (msg_id,))
+        row = c.fetchone()
+        if not row or row["user_id"] != user_id:
+            return None
+        c.execute("UPDATE messages SET content = ?, edited_at = ? WHERE id = ?", (content, edited_at, msg_id))
+        conn.commit()
+    history_cache.on_edit(row["room_id"], msg_id, content, edited_at)
+    return row["room_id"]
+
+
+def _delete_own_message(msg_id, user_id: str):
+    """Remove se a mensagem for do usuário. Retorna o room_id, ou None sem permissão."""
+    with db_conn(MESSAGES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT room_id, user_id FROM messages WHERE id = ?", (msg_id,))
+        row = c.fetchone()
+        if not row or row["user_id"] != user_id:
+            return None
+        c.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+        c.execute("DELETE FROM reactions WHERE message_id = ?", (msg_id,))
+        conn.commit()
+    history_cache.on_delete(row["room_id"], msg_id)
+    return row["room_id"]
+
+
+def _toggle_reaction_tx(c, msg_id, user_id: str, emoji: str, room_id=None):
+    """Adiciona/remove a reação dentro da transação do cursor.
+
+    Atualiza o agregado em messages.reactions sem reler a tabela reactions.
+    Retorna (room_id, added, {emoji: {count, users}}); room_id é None se a mensagem não
+    existe (ou, com room_id, se ela é de outro room).
+    """
+    row = c.execute("SELECT room_id FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    if not row or (room_id is not None and row["room_id"] != room_id):
+        return None, False, {}
+    c.execute("INSERT OR IGNORE INTO reactions (message_id, user_id, emoji) VALUES (?, ?, ?)", (msg_id, user_id, emoji))
+    added = c.rowcount == 1
+    if not added:
+        c.execute("DELETE FROM reactions WHERE message_id = ? AND user_id = ? AND emoji = ?", (msg_id, user_id, emoji))
+    # Relido já dentro da transação de escrita: nenhum outro toggle se intercala aqui
+    row = c.execute("SELECT room_id, reactions FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    reactions = _apply_reaction(json.loads(row["reactions"]) if row["reactions"] else {}, emoji, user_id, added)
+    c.execute("UPDATE messages SET reactions = ? WHERE id = ?",
+              (json.dumps(reactions, ensure_ascii=False) if reactions else None, msg_id))
+    return row["room_id"], added, reactions
+
+
+def _toggle_reaction(msg_id, user_id: str, emoji: str):
+    with db_conn(MESSAGES_DB) as conn:
+        room_id, added, reactions = _toggle_reaction_tx(conn.cursor(), msg_id, user_id, emoji)
+        conn.commit()
+    if room_id:
+        history_cache.on_reaction(room_id, msg_id, emoji, user_id, added)
+    return reactions
+
+
+# ========== PERSISTÊNCIA WRITE-BEHIND ==========
+# Em vez de um INSERT + commit por mensagem, mensagens e reações entram numa fila
+# e um único writer grava tudo em lotes: por tamanho ou a cada WRITE_FLUSH_MS.
+# As não lidas de cada mensagem gravada vão para o UnreadStore (memória).
+# LUMINA_WRITE_DURABILITY:
+#   "batched" (padrão) - broadcast imediato com id provisório ("seq"); o id real
+#                        vai num frame "message_committed" depois do commit
+#   "sync"             - o broadcast espera o commit do lote e já sai com o id real
+WRITE_DURABILITY = os.environ.get("LUMINA_WRITE_DURABILITY", "batched")
+WRITE_FLUSH_MS = int(os.environ.get("LUMINA_WRITE_FLUSH_MS", "10"))
+WRITE_BATCH_SIZE = int(os.environ.get("LUMINA_WRITE_BATCH_SIZE", "256"))
+WORKER_ID = uuid.uuid4().hex[:6]
+
+
+def _apply_write_batch(ops):
+    """Aplica um lote de operações numa única transação. Retorna um resultado (ou exceção) por operação."""
+    results = []
+    with db_conn(MESSAGES_DB) as conn:
+        c = conn.cursor()
+        for op in ops:
+            try:
+                if op["kind"] == "message":
+                    m = op["data"]
+                    c.execute("""INSERT INTO messages (room_id, user_id, user_name, user_color, content, msg_type, file_url,
+                        reply_to_id, reply_to_user, reply_to_content, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (m["room_id"], m["user_id"], m["user_name"], m["user_color"], m["content"], m["msg_type"],
+                         m["file_url"], m["reply_to_id"], m["reply_to_user"], m["reply_to_content"], m["timestamp"]))
+                    results.append(c.lastrowid)
+                elif op["kind"] == "reaction":
+                    r = op["data"]
+                    results.append(_toggle_reaction_tx(c, r["msg_id"], r["user_id"], r["emoji"], r.get("room_id")))
+                else:
+                    results.append(ValueError(f"operacao desconhecida: {op['kind']}"))
+            except sqlite3.Error as e:
+                results.append(e)
+        conn.commit()
+    return results
+
+
+_WRITER_STOP = object()  # sentinela de close() na fila do writer
+
+
+class MessageWriter:
+    """Fila write-behind com um único writer que grava em lotes."""
+
+    def __init__(self, flush_ms: int = WRITE_FLUSH_MS, batch_size: int = WRITE_BATCH_SIZE):
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = batch_size
+        self.queue = None
+        self._task = None
+        self._seq = 0
+        self.enqueued = 0
+        self.committed = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.last_flush_ms = 0.0
+
+    def next_seq(self) -> str:
+        self._seq += 1
+        return f"{WORKER_ID}-{self._seq}"
+
+    def start(self):
+        if self._task is None:
+            self.queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, kind: str, data: dict, on_commit=None, on_error=None):
+        """Enfileira uma operação. Retorna um Future resolvido com o resultado após o commit
+        (ou com a exceção, se a gravação falhar; on_error recebe a mesma exceção)."""
+        if self._task is None:
+            raise RuntimeError("MessageWriter nao iniciado")
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait({"kind": kind, "data": data, "future": fut, "on_commit": on_commit, "on_error": on_error})
+        self.enqueued += 1
+        return fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            op = await self.queue.get()
+            if op is _WRITER_STOP:
+                return
+            batch = [op]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    op = self.queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        op = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if op is _WRITER_STOP:
+                    # close(): grava o lote em mãos antes de sair; o resto da fila é drenado lá
+                    stopping = True
+                    break
+                batch.append(op)
+            try:
+                await self._flush(batch)
+            except Exception:
+                # Um erro em callback/cache não pode matar o único writer (a fila pararia de andar)
+                pass
+
+    async def _flush(self, batch):
+        start = time.perf_counter()
+        try:
+            results = await run_db(_apply_write_batch, batch)
+        except Exception as e:
+            results = [e] * len(batch)
+        self.last_flush_ms = (time.perf_counter() - start) * 1000
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        for op, result in zip(batch, results):
+            fut = op["future"]
+            if isinstance(result, Exception):
+                self.failed += 1
+                if not fut.done():
+                    fut.set_exception(result)
+                # Ninguém aguarda o future no modo batched; evita "exception was never retrieved".
+                # Se quem aguardava foi cancelado, exception() levantaria CancelledError aqui.
+                if not fut.cancelled():
+                    fut.exception()
+                if op["on_error"]:
+                    try:
+                        await op["on_error"](result)
+                    except Exception:
+                        pass
+                continue
+            self.committed += 1
+            self._update_cache(op, result)
+            if op["kind"] == "message":
+                d = op["data"]
+                for uid, count in unread_store.increment(d["room_id"], d["recipients"], result, d["user_id"]).items():
+                    notif_manager.notify(uid, {"type": "unread", "room_id": d["room_id"], "count": count})
+            if not fut.done():
+                fut.set_result(result)
+            if op["on_commit"]:
+                try:
+                    await op["on_commit"](result)
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _update_cache(op, result):
+        d = op["data"]
+        if op["kind"] == "message":
+            history_cache.on_message(d["room_id"], {
+                "id": result, "room_id": d["room_id"],
+                "user": {"id": d["user_id"], "name": d["user_name"], "color": d["user_color"], "avatar_image": d["user_avatar"]},
+                "content": d["content"], "msg_type": d["msg_type"], "file_url": d["file_url"],
+                "reply_to_id": d["reply_to_id"], "reply_to_user": d["reply_to_user"], "reply_to_content": d["reply_to_content"],
+                "edited_at": None, "timestamp": d["timestamp"], "reactions": {}})
+        elif op["kind"] == "reaction" and result[0]:
+            history_cache.on_reaction(result[0], d["msg_id"], d["emoji"], d["user_id"], result[1])
+
+    async def close(self):
+        """Flush final no shutdown: o writer termina o lote em andamento e o resto da
+        fila é gravado aqui."""
+        if self._task is None:
+            return
+        self.queue.put_nowait(_WRITER_STOP)
+        await self._task
+        self._task = None
+        pending = []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for i in range(0, len(pending), self.batch_size):
+            await self._flush(pending[i:i + self.batch_size])
+
+    def stats(self):
+        return {
+            "durability": WRITE_DURABILITY,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "enqueued": self.enqueued,
+            "committed": self.committed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "avg_batch": round(self.committed / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+        }
+
+
+message_writer = MessageWriter()
+
+
+# ========== NÃO LIDAS EM MEMÓRIA ==========
+# Contadores por (usuário, room) vivem em memória: incremento O(1) por destinatário
+# em vez de um upsert no SQLite por membro do room. Só as entradas alteradas vão
+# para a tabela unread, em lote, a cada UNREAD_CHECKPOINT_S (e no shutdown); no
+# startup tudo é recarregado dela. Um crash perde no máximo o último intervalo.
+# Com vários workers, incrementos e leituras passam pelo backplane e cada
+# worker grava os próprios valores (todos convergem para o mesmo total).
+# LUMINA_UNREAD_MODE:
+#   "counter" (padrão) - contador explícito por destinatário (UnreadStore)
+#   "marker"           - só o último id lido por room; total derivado de messages (ReadMarkerStore)
+UNREAD_MODE = os.environ.get("LUMINA_UNREAD_MODE", "counter")
+UNREAD_CHECKPOINT_S = float(os.environ.get("LUMINA_UNREAD_CHECKPOINT_S", "2"))
+UNREAD_CAP = int(os.environ.get("LUMINA_UNREAD_CAP", "99"))
+UNREAD_MARKER_CACHE_S = float(os.environ.get("LUMINA_UNREAD_MARKER_CACHE_S", "60"))
+
+
+class _CheckpointedStore:
+    """Estado em memória gravado em lote por checkpoint() a cada UNREAD_CHECKPOINT_S."""
+
+    _task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(UNREAD_CHECKPOINT_S)
+            try:
+                await run_db(self.checkpoint)
+            except Exception:
+                # As chaves voltaram para dirty; tenta de novo no próximo ciclo
+                pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await run_db(self.checkpoint)
+
+
+class UnreadStore(_CheckpointedStore):
+    def __init__(self):
+        self.counts = {}  # user_id -> {room_id: [count, last_message_id]}
+        self.dirty = set()
+        self._lock = threading.Lock()
+        self.increments = 0
+        self.checkpoints = 0
+        self.rows_written = 0
+        self.last_checkpoint_ms = 0.0
+
+    def load(self):
+        """Reconstrói os contadores a partir da tabela (chamar fora do event loop)."""
+        with db_conn(MESSAGES_DB) as conn:
+            rows = conn.execute("SELECT user_id, room_id, count, last_message_id FROM unread WHERE count > 0").fetchall()
+        with self._lock:
+            self.counts = {}
+            for r in rows:
+                self.counts.setdefault(r["user_id"], {})[r["room_id"]] = [r["count"], r["last_message_id"]]
+            self.dirty.clear()
+
+    def increment(self, room_id: str, user_ids, msg_id, author_id=None, share: bool = True):
+        """Soma 1 para cada destinatário. Retorna {user_id: novo total}."""
+        if share:
+            backplane.publish({"k": "unread", "op": "inc", "r": room_id, "u": list(user_ids), "id": msg_id, "a": author_id})
+        totals = {}
+        with self._lock:
+            for uid in user_ids:
+                entry = self.counts.setdefault(uid, {}).setdefault(room_id, [0, None])
+                entry[0] += 1
+                entry[1] = msg_id
+                totals[uid] = entry[0]
+                self.dirty.add((uid, room_id))
+            self.increments += len(totals)
+        return totals
+
+    def mark_read(self, user_id: str, room_id: str, upto=None, share: bool = True):
+        """Zera o room para o usuário (com upto, só se não chegou nada depois dele).
+        Retorna o novo total, ou None se nada mudou."""
+        if share:
+            backplane.publish({"k": "unread", "op": "read", "r": room_id, "u": user_id, "id": upto})
+        with self._lock:
+            rooms = self.counts.get(user_id)
+            if not rooms or room_id not in rooms:
+                return None
+            if upto is not None and rooms[room_id][1] is not None and rooms[room_id][1] > upto:
+                return None
+            del rooms[room_id]
+            if not rooms:
+                del self.counts[user_id]
+            self.dirty.add((user_id, room_id))
+            return 0
+
+    def forget(self, user_id: str = None):
+        """Membros de algum room mudaram; nada a fazer com contadores explícitos."""
+
+    def get_all(self, user_id: str):
+        with self._lock:
+            return {room_id: entry[0] for room_id, entry in self.counts.get(user_id, {}).items()}
+
+    def apply_remote(self, event: dict):
+        if event["op"] == "inc":
+            self.increment(event["r"], event["u"], event["id"], event.get("a"), share=False)
+        elif event["op"] == "read":
+            self.mark_read(event["u"], event["r"], event["id"], share=False)
+
+    def checkpoint(self) -> int:
+        """Grava as entradas alteradas desde o último checkpoint (chamar fora do event loop)."""
+        start = time.perf_counter()
+        with self._lock:
+            if not self.dirty:
+                return 0
+            keys, self.dirty = self.dirty, set()
+            rows = [(uid, room_id, *self.counts.get(uid, {}).get(room_id, (0, None))) for uid, room_id in keys]
+        try:
+            with db_conn(MESSAGES_DB) as conn:
+                conn.executemany("""INSERT INTO unread (user_id, room_id, count, last_message_id) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id, room_id) DO UPDATE SET count = excluded.count, last_message_id = excluded.last_message_id""",
+                    [r for r in rows if r[2] > 0])
+                conn.executemany("DELETE FROM unread WHERE user_id = ? AND room_id = ?",
+                    [(r[0], r[1]) for r in rows if r[2] == 0])
+                conn.commit()
+        except Exception:
+            with self._lock:
+                self.dirty |= keys
+            raise
+        self.checkpoints += 1
+        self.rows_written += len(rows)
+        self.last_checkpoint_ms = (time.perf_counter() - start) * 1000
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": "counter",
+                "users": len(self.counts),
+                "entries": sum(len(rooms) for rooms in self.counts.values()),
+                "dirty": len(self.dirty),
+                "increments": self.increments,
+                "checkpoints": self.checkpoints,
+                "rows_written": self.rows_written,
+                "last_checkpoint_ms": round(self.last_checkpoint_ms, 2),
+            }
+
+
+class ReadMarkerStore(_CheckpointedStore):
+    """Modo "marker": nada é gravado por mensagem. Cada usuário guarda só o último id
+    lido por room (read_markers) e o total sai do índice de messages, limitado a
+    UNREAD_CAP + 1 (o cliente mostra "99+"). Os totais derivados ficam em cache por
+    UNREAD_MARKER_CACHE_S e recebem +1 em memória a cada mensagem do room."""
+
+    def __init__(self):
+        self.markers = {}   # (user_id, room_id) -> last_read_id
+        self.cache = {}     # user_id -> {"at": monotonic, "rooms": {room_id: total}}
+        self.watchers = {}  # room_id -> {user_id} com total em cache
+        self.latest = {}    # room_id -> última mensagem vista
+        self.dirty = set()
+        self._lock = threading.Lock()
+        self.derivations = 0
+        self.increments = 0
+        self.checkpoints = 0
+        self.rows_written = 0
+        self.last_checkpoint_ms = 0.0
+
+    def load(self):
+        with db_conn(MESSAGES_DB) as conn:
+            rows = conn.execute("SELECT user_id, room_id, last_read_id FROM read_markers").fetchall()
+        with self._lock:
+            self.markers = {(r["user_id"], r["room_id"]): r["last_read_id"] for r in rows}
+            self.cache.clear()
+            self.watchers.clear()
+            self.dirty.clear()
+
+    @staticmethod
+    def _user_rooms(user_id: str):
+        with db_conn(USERS_DB) as conn:
+            return [r[0] for r in conn.execute(
+                """SELECT 'dm:' || id FROM direct_chats WHERE user1_id = ? OR user2_id = ?
+                UNION ALL
+                SELECT 'topic:' || t.id FROM circles_db.topics t
+                JOIN circles_db.circle_members m ON m.circle_id = t.circle_id WHERE m.user_id = ?""",
+                (user_id, user_id, user_id))]
+
+    @staticmethod
+    def _count(c, user_id: str, room_id: str, after_id: int) -> int:
+        c.execute("""SELECT COUNT(*) FROM (SELECT 1 FROM messages WHERE room_id = ? AND id > ?
+            AND (user_id IS NULL OR user_id != ?) LIMIT ?)""", (room_id, after_id, user_id, UNREAD_CAP + 1))
+        return c.fetchone()[0]
+
+    def _derive(self, user_id: str):
+        rooms = self._user_rooms(user_id)
+        with self._lock:
+            after = {room_id: self.markers.get((user_id, room_id), 0) for room_id in rooms}
+        with db_conn(MESSAGES_DB) as conn:
+            c = conn.cursor()
+            totals = {room_id: self._count(c, user_id, room_id, after_id) for room_id, after_id in after.items()}
+        with self._lock:
+            self._drop(user_id)
+            self.cache[user_id] = {"at": time.monotonic(), "rooms": totals}
+            for room_id in totals:
+                self.watchers.setdefault(room_id, set()).add(user_id)
+            self.derivations += 1
+        return totals
+
+    def _drop(self, user_id: str):
+        entry = self.cache.pop(user_id, None)
+        if entry:
+            for room_id in entry["rooms"]:
+                users = self.watchers.get(room_id)
+                if users is not None:
+                    users.discard(user_id)
+                    if not users:
+                        del self.watchers[room_id]
+
+    def get_all(self, user_id: str):
+        """Totais do usuário (chamar fora do event loop: pode consultar o banco)."""
+        with self._lock:
+            entry = self.cache.get(user_id)
+            if entry and time.monotonic() - entry["at"] < UNREAD_MARKER_CACHE_S:
+                return {room_id: n for room_id, n in entry["rooms"].items() if n}
+        return {room_id: n for room_id, n in self._derive(user_id).items() if n}
+
+    def increment(self, room_id: str, user_ids, msg_id, author_id=None, share: bool = True):
+        """O(membros com total em cache), só em memória. user_ids é ignorado: no modo
+        marcador todo membro do room tem a mensagem como não lida."""
+        if share:
+            backplane.publish({"k": "unread", "op": "inc", "r": room_id, "u": [], "id": msg_id, "a": author_id})
+        totals = {}
+        with self._lock:
+            if msg_id > self.latest.get(room_id, 0):
+                self.latest[room_id] = msg_id
+            for uid in self.watchers.get(room_id, ()):
+                if uid == author_id:
+                    continue
+                rooms = self.cache[uid]["rooms"]
+                rooms[room_id] = min(rooms.get(room_id, 0) + 1, UNREAD_CAP + 1)
+                totals[uid] = rooms[room_id]
+            self.increments += len(totals)
+        return totals
+
+    def mark_read(self, user_id: str, room_id: str, upto=None, share: bool = True):
+        """Move o marcador (só para frente, nunca além da última mensagem do room).
+        Retorna o novo total, ou None se nada mudou."""
+        if upto is None:
+            upto = self.latest.get(room_id)
+        if upto is None or (share and upto > self.latest.get(room_id, 0)):
+            # upto vem do cliente: um marcador no futuro esconderia as próximas mensagens
+            with db_conn(MESSAGES_DB) as conn:
+                room_max = conn.execute("SELECT MAX(id) FROM messages WHERE room_id = ?", (room_id,)).fetchone()[0] or 0
+            upto = room_max if upto is None else min(upto, room_max)
+        if share:
+            backplane.publish({"k": "unread", "op": "read", "r": room_id, "u": user_id, "id": upto})
+        with self._lock:
+            if self.markers.get((user_id, room_id), 0) >= upto:
+                return None
+            self.markers[(user_id, room_id)] = upto
+            self.dirty.add((user_id, room_id))
+            entry = self.cache.get(user_id)
+            if entry is None:
+                return 0 if upto >= self.latest.get(room_id, 0) else None
+            if upto >= self.latest.get(room_id, 0):
+                entry["rooms"][room_id] = 0
+                return 0
+            if not share:
+                # Evento de outro worker: não consulta o banco no event loop, só refaz depois
+                self._drop(user_id)
+                return None
+        with db_conn(MESSAGES_DB) as conn:
+            total = self._count(conn.cursor(), user_id, room_id, upto)
+        with self._lock:
+            entry = self.cache.get(user_id)
+            if entry is not None:
+                entry["rooms"][room_id] = total
+        return total
+
+    def forget(self, user_id: str = None):
+        """Os rooms do usuário (ou de todos, sem user_id) mudaram; o total é refeito no próximo get_all."""
+        with self._lock:
+            if user_id is None:
+                self.cache.clear()
+                self.watchers.clear()
+            else:
+                self._drop(user_id)
+
+    def apply_remote(self, event: dict):
+        if event["op"] == "inc":
+            self.increment(event["r"], event["u"], event["id"], event.get("a"), share=False)
+        elif event["op"] == "read":
+            self.mark_read(event["u"], event["r"], event["id"], share=False)
+
+    def checkpoint(self) -> int:
+        """Grava os marcadores que andaram desde o último checkpoint."""
+        start = time.perf_counter()
+        with self._lock:
+            if not self.dirty:
+                return 0
+            keys, self.dirty = self.dirty, set()
+            rows = [(uid, room_id, self.markers[(uid, room_id)]) for uid, room_id in keys]
+        try:
+            with db_conn(MESSAGES_DB) as conn:
+                conn.executemany("""INSERT INTO read_markers (user_id, room_id, last_read_id) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, room_id) DO UPDATE SET last_read_id = MAX(last_read_id, excluded.last_read_id)""", rows)
+                conn.commit()
+        except Exception:
+            with self._lock:
+                self.dirty |= keys
+            raise
+        self.checkpoints += 1
+        self.rows_written += len(rows)
+        self.last_checkpoint_ms = (time.perf_counter() - start) * 1000
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": "marker",
+                "markers": len(self.markers),
+                "cached_users": len(self.cache),
+                "dirty": len(self.dirty),
+                "derivations": self.derivations,
+                "increments": self.increments,
+                "checkpoints": self.checkpoints,
+                "rows_written": self.rows_written,
+                "last_checkpoint_ms": round(self.last_checkpoint_ms, 2),
+            }
+
+
+unread_store = ReadMarkerStore() if UNREAD_MODE == "marker" else UnreadStore()
+
+
+# ========== BUSCA (FTS5) ==========
+# messages_fts indexa messages.content e o room (migração 4 do banco de mensagens).
+# Termos seletivos (menos de SEARCH_SELECTIVE_MAX acertos no total) são filtrados
+# pelos rooms do usuário no join com messages. Termos comuns levam os rooms para
+# dentro do MATCH (coluna room_key), e o índice já devolve só acertos desses rooms;
+# em order=rank só os SEARCH_RANK_WINDOW mais recentes são pontuados, para um termo
+# presente em milhões de mensagens não obrigar a calcular bm25 de todas.
+SEARCH_MAX_LIMIT = 50
+SEARCH_SNIPPET_TOKENS = 12
+SEARCH_RANK_WINDOW = int(os.environ.get("LUMINA_SEARCH_RANK_WINDOW", "2000"))
+SEARCH_SELECTIVE_MAX = 2000
+SEARCH_BACKFILL_BATCH = int(os.environ.get("LUMINA_SEARCH_BACKFILL_BATCH", "2000"))
+SEARCH_BACKFILL_PAUSE_S = 0.05
+# Marcadores de uso privado no snippet; o texto é escapado e eles viram <mark>
+_MARK_OPEN, _MARK_CLOSE = "\ue000", "\ue001"
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _fts_terms(q: str) -> str:
+    """Termos do usuário como frases FTS5 (AND implícito), sem sintaxe de consulta exposta."""
+    return " ".join(_fts_phrase(term) for term in q.split())
+
+
+def _snippet_html(snippet: str) -> str:
+    return html.escape(snippet).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+def _search_messages(user_id: str, q: str, room_id=None, order: str = "rank", cursor=None, limit: int = 20):
+    """Busca nos rooms que o usuário acessa. order: "rank" (bm25) ou "recent" (id decrescente).
+
+    cursor é o next_cursor da página anterior ("score:id:piso" em rank, "id" em recent).
+    """
+    if not q.split():
+        raise HTTPException(status_code=400, detail="Busca vazia")
+    if order not in ("rank", "recent"):
+        raise HTTPException(status_code=400, detail="order deve ser rank ou recent")
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    before = after = floor = None
+    try:
+        if order == "recent":
+            before = int(cursor) if cursor else None
+        elif cursor:
+            score, last_id, floor = cursor.split(":")
+            after, floor = (float(score), int(last_id)), int(floor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor invalido")
+    with db_conn(MESSAGES_DB) as conn:
+        rooms = [r[0] for r in conn.execute("""SELECT 'dm:' || id FROM users_db.direct_chats WHERE user1_id = ? OR user2_id = ?
+            UNION ALL
+            SELECT 'topic:' || t.id FROM circles_db.topics t
+            JOIN circles_db.circle_members cm ON cm.circle_id = t.circle_id WHERE cm.user_id = ?""",
+            (user_id, user_id, user_id))]
+        if room_id:
+            rooms = [room_id] if room_id in rooms else []
+        if not rooms:
+            return {"results": [], "next_cursor": None}
+        match = f"content : ({_fts_terms(q)})"
+        hits = conn.execute("SELECT count(*) FROM (SELECT 1 FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?)",
+                            (match, SEARCH_SELECTIVE_MAX)).fetchone()[0]
+        join = "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        if hits < SEARCH_SELECTIVE_MAX:
+            scope, scope_params = "messages_fts MATCH ? AND m.room_id IN (SELECT value FROM json_each(?))", [match, json.dumps(rooms)]
+            rank_sql = f"SELECT messages_fts.rowid AS rowid, bm25(messages_fts, 1.0, 0.0) AS score {join} WHERE {scope}"
+            rank_params, floor = scope_params, 0
+        else:
+            scoped = match + " AND room_key : (" + " OR ".join(_fts_phrase(r.replace(":", "")) for r in rooms) + ")"
+            scope, scope_params = "messages_fts MATCH ?", [scoped]
+            if order == "rank" and floor is None:
+                # Piso da janela: o SEARCH_RANK_WINDOW-ésimo acerto mais recente (0 se há menos)
+                row = conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                                   (scoped, SEARCH_RANK_WINDOW - 1)).fetchone()
+                floor = row[0] if row else 0
+            rank_sql = "SELECT rowid, bm25(messages_fts, 1.0, 0.0) AS score FROM messages_fts WHERE messages_fts MATCH ? AND rowid >= ?"
+            rank_params = [scoped, floor]
+        cols = f"""m.id, m.room_id, m.user_id, m.user_name, m.msg_type, m.timestamp,
+            snippet(messages_fts, 0, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', {SEARCH_SNIPPET_TOKENS}) AS snippet"""
+        if order == "recent":
+            # O índice entrega os rowids em ordem: para no limite sem olhar o resto dos acertos
+            sql = f"SELECT {cols} {join} WHERE {scope}" + (" AND messages_fts.rowid < ?" if before else "")
+            rows = conn.execute(sql + " ORDER BY messages_fts.rowid DESC LIMIT ?",
+                                scope_params + ([before] if before else []) + [limit + 1]).fetchall()
+            scores = None
+        else:
+            # Pontua e ordena primeiro; join e snippet só para as linhas da página
+            sql = f"SELECT rowid, score FROM ({rank_sql})"
+            if after:
+                sql += " WHERE (score, rowid) > (?, ?)"
+                rank_params = rank_params + list(after)
+            ranked = conn.execute(sql + " ORDER BY score, rowid LIMIT ?", rank_params + [limit + 1]).fetchall()
+            scores = {r["rowid"]: r["score"] for r in ranked}
+            by_id = {}
+            if ranked:
+                placeholders = ",".join("?" * len(ranked))
+                by_id = {r["id"]: r for r in conn.execute(
+                    f"SELECT {cols} {join} WHERE messages_fts MATCH ? AND messages_fts.rowid IN ({placeholders})",
+                    [match] + list(scores))}
+            rows = [by_id[rid] for rid in scores if rid in by_id]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = [{
+        "id": r["id"], "room_id": r["room_id"], "user": {"id": r["user_id"], "name": r["user_name"]},
+        "msg_type": r["msg_type"], "timestamp": r["timestamp"], "snippet": _snippet_html(r["snippet"]),
+    } for r in rows]
+    next_cursor = None
+    if has_more:
+        last = rows[-1]["id"]
+        next_cursor = str(last) if scores is None else f"{scores[last]!r}:{last}:{floor}"
+    return {"results": results, "next_cursor": next_cursor}
+
+
+class SearchBackfill:
+    """Indexa em lotes, em background, as mensagens anteriores à criação do índice."""
+
+    _task = None
+
+    def __init__(self, batch: int = SEARCH_BACKFILL_BATCH):
+        self.batch = batch
+        self.batches = 0
+        self.rows = 0
+
+    def step(self) -> int:
+        """Indexa o próximo lote de ids numa transação. Retorna quantos ids ainda faltam."""
+        with db_conn(MESSAGES_DB) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT next_id, upto_id FROM search_backfill WHERE id = 1").fetchone()
+            if row is None or row["next_id"] > row["upto_id"]:
+                return 0
+            end = min(row["next_id"] + self.batch, row["upto_id"] + 1)
+            c = conn.execute("""INSERT INTO messages_fts (rowid, content, room_key)
+                SELECT id, content, room_key FROM messages_fts_content WHERE id >= ? AND id < ?""", (row["next_id"], end))
+            conn.execute("UPDATE search_backfill SET next_id = ? WHERE id = 1", (end,))
+            conn.commit()
+        self.batches += 1
+        self.rows += c.rowcount
+        return row["upto_id"] + 1 - end
+
+    def run(self):
+        """Backfill completo, síncrono (linha de comando: python disgarai.py --backfill-search)."""
+        while self.step():
+            pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        # Lotes curtos com pausa entre eles: o writer de mensagens não fica esperando o lock
+        while True:
+            try:
+                if not await run_db(self.step):
+                    break
+            except Exception:
+                # Banco ocupado ou erro transitório: o lote é refeito mais tarde
+                await asyncio.sleep(1)
+            await asyncio.sleep(SEARCH_BACKFILL_PAUSE_S)
+        self._task = None
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        with db_conn(MESSAGES_DB) as conn:
+            row = conn.execute("SELECT next_id, upto_id FROM search_backfill WHERE id = 1").fetchone()
+        return {
+            "backfill_pending": max(0, row["upto_id"] + 1 - row["next_id"]) if row else 0,
+            "backfill_batches": self.batches,
+            "backfill_rows": self.rows,
+        }
+
+
+search_backfill = SearchBackfill()
+
+
+# ========== BUSCA DE USUÁRIOS ==========
+USER_SEARCH_LIMIT = 20
+USER_SEARCH_FUZZY_MIN_LEN = 4  # abaixo disso quase tudo "parece" com a busca
+USER_SEARCH_FUZZY_CANDIDATES = 50
+# O círculo social de cada um (amigos + membros dos mesmos círculos) muda pouco e é lido a
+# cada tecla digitada: fica em memória por alguns segundos
+USER_SEARCH_CLOSE_TTL_S = float(os.environ.get("LUMINA_USER_SEARCH_CLOSE_TTL_S", "30"))
+USER_SEARCH_CLOSE_MAX = 2000
+
+# Amigos (0) e quem divide algum círculo com o usuário (1)
+_CLOSE_USERS_SQL = """SELECT c.tier, s.user_id, s.username_key, s.name_key FROM (
+        SELECT friend_id AS uid, 0 AS tier FROM friendships WHERE user_id = ? AND status = 'accepted'
+        UNION ALL SELECT user_id, 0 FROM friendships WHERE friend_id = ? AND status = 'accepted'
+        UNION ALL SELECT other.user_id, 1 FROM circles_db.circle_members me
+            JOIN circles_db.circle_members other ON other.circle_id = me.circle_id
+            WHERE me.user_id = ? AND other.user_id != ?
+    ) c JOIN user_search s ON s.user_id = c.uid"""
+
+_USER_SEARCH_FTS_SQL = """SELECT s.user_id, s.username_key, s.name_key FROM user_search_fts
+    JOIN user_search s ON s.rid = user_search_fts.rowid WHERE user_search_fts MATCH ? LIMIT ?"""
+
+_RELATIONS = ("friend", "circle", None)
+
+
+def _typo_prefix_distance(key: str, word: str, bound: int) -> int:
+    """Menor distância de edição (com transposição) entre key e algum prefixo de word.
+
+    Uma tabela só: a última linha já dá a distância para cada prefixo. Para assim que
+    a linha inteira passa de bound.
+    """
+    word = word[:len(key) + bound]
+    prev2, prev = None, list(range(len(word) + 1))
+    for i, ca in enumerate(key, 1):
+        cur = [i] + [0] * len(word)
+        for j, cb in enumerate(word, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == word[j - 2] and key[i - 2] == cb:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > bound:
+            return bound + 1
+        prev2, prev = prev, cur
+    return min(prev[max(0, len(key) - bound):])
+
+
+def _is_typo_of(key: str, words) -> bool:
+    """key é o começo de alguma das palavras com até 1 erro (2 a partir de 8 caracteres)?"""
+    bound = 1 if len(key) < 8 else 2
+    letters = set(key)
+    for word in words:
+        # Filtro barato antes da distância: letras demais fora da busca não são erro de digitação
+        if len(letters.symmetric_difference(word[:len(key) + bound])) > 2 * bound + 2:
+            continue
+        if _typo_prefix_distance(key, word, bound) <= bound:
+            return True
+    return False
+
+
+def _user_match_tier(key: str, username_key: str, name_key: str):
+    """0 exato, 1 prefixo (username, nome ou palavra do nome), 2 substring, 3 fuzzy, None sem match."""
+    if key in (username_key, name_key):
+        return 0
+    if username_key.startswith(key) or (" " + name_key).find(" " + key) >= 0:
+        return 1
+    if key in username_key or key in name_key:
+        return 2
+    if len(key) >= USER_SEARCH_FUZZY_MIN_LEN and _is_typo_of(key, [username_key, name_key] + name_key.split()[1:]):
+        return 3
+    return None
+
+
+class CloseUsersCache:
+    def __init__(self, ttl: float = USER_SEARCH_CLOSE_TTL_S, max_entries: int = USER_SEARCH_CLOSE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # user_id -> (expira_em, [(relação, user_id, username_key, name_key)])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn, user_id: str):
+        with self._lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] >= time.time():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        best = {}
+        for tier, uid, username_key, name_key in conn.execute(_CLOSE_USERS_SQL, (user_id,) * 4):
+            if uid not in best or tier < best[uid][0]:
+                best[uid] = (tier, uid, username_key, name_key)
+        close = list(best.values())
+        with self._lock:
+            self.entries[user_id] = (time.time() + self.ttl, close)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return close
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "ttl_s": self.ttl,
+            }
+
+
+close_users = CloseUsersCache()
+
+
+def _search_users(user_id: str, q: str, limit: int = USER_SEARCH_LIMIT):
+    """Amigos e membros de círculos em comum primeiro; depois o resto, por prefixo, substring e fuzzy.
+
+    O resto da base só é visitado por índice (faixa de prefixo nas chaves, trigram FTS5
+    para substring) e sempre com LIMIT; cada etapa só roda se as anteriores não
+    encheram a página, então o custo não cresce com o número de usuários.
+    """
+    key = _search_key(q)
+    if not key:
+        return []
+    hits = {}  # user_id -> (grupo, tier de match, relação, chave); ordena pela tupla
+
+    def add(rows, tier=None):
+        for uid, username_key, name_key in rows:
+            if tier is None and len(hits) >= limit:
+                break  # fuzzy vem por último no ranking: página cheia, o resto seria cortado
+            if uid in hits:
                 continue
+            t = _user_match_tier(key, username_key, name_key) if tier is None else tier
+            if t is not None:
+                hits[uid] = (2 if t == 3 else 1, t, 2, username_key)
+
+    def strong():
+        return sum(1 for h in hits.values() if h[0] < 2)
+
+    fuzzy = len(key) >= USER_SEARCH_FUZZY_MIN_LEN
+    maybe_typo = []  # próximos sem substring: só viram fuzzy se a página não encher antes
+    with db_conn(USERS_DB) as conn:
+        for entry in close_users.get(conn, user_id):
+            relation, uid, username_key, name_key = entry
+            if key in username_key or key in name_key:
+                hits[uid] = (0, _user_match_tier(key, username_key, name_key), relation, username_key)
+            elif fuzzy and key[0] in (username_key[:1], name_key[:1]):
+                # Erro de digitação na primeira letra é raro: descarta o resto sem calcular distância
+                maybe_typo.append(entry)
+        want = limit + len(hits)  # folga para os repetidos dos próximos
+        high = key[:-1] + chr(ord(key[-1]) + 1)
+        for column in ("username_key", "name_key"):
+            if strong() < limit:
+                add(conn.execute(f"SELECT user_id, username_key, name_key FROM user_search WHERE {column} >= ? AND {column} < ? LIMIT ?",
+                                 (key, high, want)), 1)
+        if len(key) >= 3 and strong() < limit:
+            # trigram: uma frase de 3+ caracteres casa como substring, usando o índice
+            add(conn.execute(_USER_SEARCH_FTS_SQL, (_fts_phrase(key), want)), 2)
+        if fuzzy and strong() < limit:
+            for relation, uid, username_key, name_key in maybe_typo:
+                if len(hits) >= limit:
+                    break
+                if _user_match_tier(key, username_key, name_key) == 3:
+                    # Abaixo de qualquer match exato/prefixo/substring, mas à frente dos fuzzy de fora
+                    hits[uid] = (2, 3, relation, username_key)
+            # Candidatos: quem contém o começo ou o fim da busca (um erro de
+            # digitação raramente estraga as duas); a confirmação é o _user_match_tier
+            half = max(3, len(key) // 2)
+            probe = _fts_phrase(key[:half]) + " OR " + _fts_phrase(key[-half:])
+            add(conn.execute(_USER_SEARCH_FTS_SQL, (probe, USER_SEARCH_FUZZY_CANDIDATES)))
+        ranked = sorted(hits, key=hits.get)[:limit]
+        if not ranked:
+            return []
+        placeholders = ",".join("?" * len(ranked))
+        users = {r["id"]: dict(r) for r in conn.execute(
+            f"SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE id IN ({placeholders})", ranked)}
+    results = []
+    for uid in ranked:
+        if uid in users:
+            users[uid]["relation"] = _RELATIONS[hits[uid][2]]
+            results.append(users[uid])
+    return results
+
+
+# ========== UPLOADS EM STREAMING ==========
+# O corpo multipart é lido em pedaços direto do request: o limite de tamanho vale
+# durante a leitura (nada é bufferizado inteiro), cada pedaço é escrito num .part por
+# um executor próprio (o loop não espera disco e o executor do banco não disputa com
+# ele) e o arquivo só aparece em static/ por rename atômico, já com o SHA-256 calculado.
+# Memória por upload: um pedaço do socket.
+try:
+    import python_multipart as multipart
+except ModuleNotFoundError:  # python-multipart antigo
+    import multipart
+
+UPLOAD_MAX_BYTES = 25 * 1024 * 1024
+AVATAR_MAX_BYTES = 5 * 1024 * 1024
+UPLOAD_ALLOWED_EXTS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp4', '.webm', '.mov', '.mp3', '.ogg', '.wav', '.pdf', '.txt', '.zip'}
+AVATAR_ALLOWED_EXTS = ['.png', '.jpg', '.jpeg', '.gif', '.webp']
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024  # boundaries e headers das partes, para o pré-check do Content-Length
+# Fora de static/ (um .part nunca é servido), mas no mesmo disco para o rename ser atômico
+UPLOAD_TMP_DIR = os.path.join(BASE_DIR, "upload_tmp")
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+UPLOAD_WORKERS = int(os.environ.get("LUMINA_UPLOAD_WORKERS", "2"))
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="quizcord-upload")
+_upload_stats = {"active": 0, "completed": 0, "rejected": 0, "bytes": 0}
+
+
+class StreamedUpload:
+    """Arquivo recebido num .part; write/commit/discard são bloqueantes (rodam no upload_executor)."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.ext = os.path.splitext(filename)[1].lower()
+        self.size = 0
+        self.tmp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex + ".part")
+        self._hash = hashlib.sha256()
+        self._file = None
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def write(self, data: bytes):
+        if self._file is None:
+            self._file = open(self.tmp_path, "wb")
+        self._file.write(data)
+        self._hash.update(data)
+
+    def commit(self, dest_path: str):
+        if self._file is None:
+            self._file = open(self.tmp_path, "wb")  # arquivo vazio também é um upload
+        self._file.close()
+        os.replace(self.tmp_path, dest_path)
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class _MultipartFileReader:
+    """Parser multipart incremental que grava a parte de arquivo `field` num StreamedUpload.
+
+    feed() faz parse e escrita juntos e roda no upload_executor: o loop só repassa os
+    pedaços do socket. Extensão é validada quando os headers da parte chegam (antes de
+    gravar qualquer byte) e o tamanho a cada pedaço.
+    """
+
+    def __init__(self, boundary: bytes, field: str, allowed_exts, max_bytes: int, too_large: str, bad_type: str = None):
+        self.field = field.encode()
+        self.allowed_exts = allowed_exts
+        self.max_bytes = max_bytes
+        self.too_large = too_large
+        self.bad_type = bad_type or f"Tipo de arquivo nao permitido. Extensoes aceitas: {', '.join(sorted(allowed_exts))}"
+        self.upload = None
+        self.done = False
+        self._target = False
+        self._headers = {}
+        self._name = self._value = b""
+        self._parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin, "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value, "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished, "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._name += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._name.lower()] = self._value
+        self._name = self._value = b""
+
+    def _on_headers_finished(self):
+        _, opts = multipart.multipart.parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._target = not self.done and opts.get(b"name") == self.field and b"filename" in opts
+        if self._target:
+            upload = StreamedUpload(opts[b"filename"].decode("utf-8", "replace"))
+            if upload.ext not in self.allowed_exts:
+                raise HTTPException(status_code=400, detail=self.bad_type)
+            self.upload = upload
+
+    def _on_part_data(self, data, start, end):
+        if self._target:
+            self.upload.size += end - start
+            if self.upload.size > self.max_bytes:
+                raise HTTPException(status_code=413, detail=self.too_large)
+            self.upload.write(data[start:end])
+
+    def _on_part_end(self):
+        if self._target:
+            self._target, self.done = False, True
+
+    def feed(self, chunk: bytes):
+        self._parser.write(chunk)
+
+    def finish(self):
+        self._parser.finalize()
+        if not self.done:
+            raise HTTPException(status_code=400, detail="Arquivo ausente")
+
+    def discard(self):
+        if self.upload is not None:
+            self.upload.discard()
+
+
+async def _upload_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(upload_executor, fn, *args)
+
+
+async def receive_upload(request: Request, field: str, allowed_exts, max_bytes: int, too_large: str, bad_type: str = None) -> StreamedUpload:
+    """Lê a parte de arquivo `field` do corpo multipart, em streaming, para um .part.
+
+    Quem chama dá o destino com `await _upload_io(upload.commit, path)`.
+    """
+    content_type, params = multipart.multipart.parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Envie o arquivo como multipart/form-data")
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        declared = 0
+    if declared > max_bytes + UPLOAD_MULTIPART_OVERHEAD:
+        _upload_stats["rejected"] += 1
+        raise HTTPException(status_code=413, detail=too_large)
+    reader = _MultipartFileReader(boundary, field, allowed_exts, max_bytes, too_large, bad_type)
+    _upload_stats["active"] += 1
+    try:
+        async for chunk in request.stream():
+            # Só lê o próximo pedaço depois de gravar este: a contrapressão chega ao cliente
+            await _upload_io(reader.feed, chunk)
+        await _upload_io(reader.finish)
+    except BaseException as e:
+        await _upload_io(reader.discard)
+        if isinstance(e, (HTTPException, multipart.exceptions.MultipartParseError)):
+            _upload_stats["rejected"] += 1
+        if isinstance(e, multipart.exceptions.MultipartParseError):
+            raise HTTPException(status_code=400, detail="Corpo multipart invalido")
+        raise
+    finally:
+        _upload_stats["active"] -= 1
+    _upload_stats["completed"] += 1
+    _upload_stats["bytes"] += reader.upload.size
+    return reader.upload
+
+
+def upload_stats():
+    return dict(_upload_stats)
+
+
+# Store deduplicado por conteúdo: cada SHA-256 é gravado uma vez e cada upload recebe
+# um nome opaco (static/uploads/<uuid><ext>, hard link para o mesmo arquivo), então o
+# mesmo conteúdo enviado de novo não é gravado outra vez e ninguém chega à URL de um
+# arquivo só por ter o conteúdo. Blobs sem mensagem apontando (refs = 0) por mais de
+# UPLOAD_GC_GRACE_S são apagados, com todos os nomes, pelo UploadSweeper; a carência
+# cobre o intervalo entre o upload e o envio da mensagem. Uploads anteriores a este
+# store (nomes uuid sem linha em uploads) nunca são apagados.
+UPLOAD_GC_GRACE_S = int(os.environ.get("LUMINA_UPLOAD_GC_GRACE_S", str(24 * 3600)))
+UPLOAD_GC_INTERVAL_S = float(os.environ.get("LUMINA_UPLOAD_GC_INTERVAL_S", "600"))
+UPLOAD_GC_BATCH = 200
+
+
+def _upload_path(url: str) -> str:
+    return os.path.join(UPLOAD_DIR, os.path.basename(url))
+
+
+def _link_upload(conn, sha256: str, url: str) -> bool:
+    """Cria url como hard link do blob já guardado (e renova a carência do GC). False se
+    o blob não existe ou o sistema de arquivos não aceita o link. Chamar dentro de BEGIN IMMEDIATE."""
+    row = conn.execute("SELECT url FROM uploads WHERE sha256 = ?", (sha256,)).fetchone()
+    if row is None:
+        return False
+    try:
+        os.link(_upload_path(row[0]), _upload_path(url))
+    except OSError:
+        return False
+    conn.execute("""UPDATE uploads SET upload_count = upload_count + 1, touched_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE sha256 = ?""", (sha256,))
+    return True
+
+
+def store_upload(upload: StreamedUpload):
+    """Dá ao upload um nome novo; se o conteúdo já existe, o nome é um link e o .part é
+    descartado. Roda no upload_executor.
+
+    Tudo dentro de BEGIN IMMEDIATE: o UploadSweeper apaga linhas e arquivos na mesma
+    transação, então um upload nunca aponta para um blob que está sendo removido.
+    """
+    sha256 = upload.sha256
+    url = f"/static/uploads/{uuid.uuid4().hex}{upload.ext}"
+    with db_conn(MESSAGES_DB) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deduplicated = _link_upload(conn, sha256, url)
+            if deduplicated:
+                upload.discard()
+            else:
+                upload.commit(_upload_path(url))
+                conn.execute("""INSERT INTO uploads (sha256, url, size, touched_at) VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+                    ON CONFLICT(sha256) DO UPDATE SET url = excluded.url, size = excluded.size,
+                        upload_count = upload_count + 1, touched_at = excluded.touched_at""",
+                    (sha256, url, upload.size))
+            conn.execute("INSERT INTO upload_names (url, sha256) VALUES (?, ?)", (url, sha256))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            upload.discard()
             try:
-                await conn.send_text(text)
-            except:
+                os.remove(_upload_path(url))
+            except FileNotFoundError:
                 pass
+            raise
+    return url, deduplicated
+
 
-    async def send_to_user(self, user_id, msg):
-        ws = self.ws_by_user.get(user_id)
-        if ws:
+def upload_store_report():
+    """Quanto o store ocupa e quanto a deduplicação economizou."""
+    with db_conn(MESSAGES_DB) as conn:
+        r = conn.execute("""SELECT count(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * (upload_count - 1)), 0),
+            COALESCE(SUM(upload_count), 0), COALESCE(SUM(refs), 0), COALESCE(SUM(refs = 0), 0) FROM uploads""").fetchone()
+    return {
+        "blobs": r[0], "stored_bytes": r[1], "saved_bytes": r[2], "uploads": r[3],
+        "message_refs": r[4], "unreferenced_blobs": r[5], **upload_sweeper.stats(),
+    }
+
+
+class UploadSweeper:
+    """Apaga, em background, blobs sem referência há mais de UPLOAD_GC_GRACE_S."""
+
+    _task = None
+
+    def __init__(self):
+        self.sweeps = 0
+        self.swept_files = 0
+        self.swept_bytes = 0
+        # Último upload_store_report(): a consulta percorre a tabela inteira, então é
+        # refeita no início e depois de cada varredura, não a cada /api/metrics
+        self.report = None
+
+    def sweep(self, now=None) -> int:
+        cutoff = int(now if now is not None else time.time()) - UPLOAD_GC_GRACE_S
+        removed = 0
+        while True:
+            with db_conn(MESSAGES_DB) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                rows = conn.execute("SELECT sha256, size FROM uploads WHERE refs = 0 AND touched_at < ? LIMIT ?",
+                                    (cutoff, UPLOAD_GC_BATCH)).fetchall()
+                for sha256, size in rows:
+                    names = conn.execute("SELECT url FROM upload_names WHERE sha256 = ?", (sha256,)).fetchall()
+                    conn.execute("DELETE FROM upload_names WHERE sha256 = ?", (sha256,))
+                    conn.execute("DELETE FROM uploads WHERE sha256 = ?", (sha256,))
+                    for (url,) in names:
+                        try:
+                            os.remove(_upload_path(url))
+                        except FileNotFoundError:
+                            pass
+                    self.swept_bytes += size
+                conn.commit()
+            removed += len(rows)
+            if len(rows) < UPLOAD_GC_BATCH:
+                break
+        self.sweeps += 1
+        self.swept_files += removed
+        return removed
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
             try:
-                await ws.send_text(json.dumps(msg))
-            except:
+                self.report = await loop.run_in_executor(upload_executor, upload_store_report)
+            except Exception:
+                pass
+            await asyncio.sleep(UPLOAD_GC_INTERVAL_S)
+            try:
+                await loop.run_in_executor(upload_executor, self.sweep)
+            except Exception:
+                # Banco ocupado: o que não foi apagado continua elegível no próximo ciclo
                 pass
 
-    def leave_room(self, room_id, ws):
-        if room_id in self.rooms and ws in self.rooms[room_id]:
-            self.rooms[room_id].remove(ws)
-            if not self.rooms[room_id]:
-                del self.rooms[room_id]
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"gc_sweeps": self.sweeps, "gc_files": self.swept_files, "gc_bytes": self.swept_bytes}
+
+
+upload_sweeper = UploadSweeper()
+
+
+# ========== CODEC JSON (WebSockets e backplane) ==========
+# Todo frame de WebSocket e todo evento do backplane passam pelo codec. Com msgspec
+# ou orjson instalados (opcionais) o encode/decode roda em C; sem eles fica o json
+# da stdlib. Os frames continuam de texto: o cliente faz JSON.parse direto.
+# LUMINA_JSON_CODEC: "auto" (padrão: msgspec, orjson, stdlib; o primeiro instalado)
+# ou um deles explicitamente.
+JSON_CODEC = os.environ.get("LUMINA_JSON_CODEC", "auto")
+
+_REQUIRED = object()
+_ID = int  # ids de mensagem: o decode converte strings só de dígitos (clientes antigos) para int
+# Frames que o cliente pode mandar: tipo -> {campo: (tipos aceitos, padrão)}.
+# Campo ausente fica com o padrão (_REQUIRED = frame inválido); padrão None também
+# aceita null. Campos fora da tabela são descartados; "room" vale em todos.
+WS_FRAME_SCHEMAS = {
+    "ping": {},
+    "subscribe": {"room": (str, _REQUIRED), "last_id": (_ID, None)},
+    "unsubscribe": {"room": (str, _REQUIRED)},
+    "mark_read": {"msg_id": (_ID, None)},
+    "typing": {},
+    "voice_join": {},
+    "voice_leave": {},
+    "voice_offer": {"target": (str, _REQUIRED), "offer": ((dict, str), _REQUIRED)},
+    "voice_answer": {"target": (str, _REQUIRED), "answer": ((dict, str), _REQUIRED)},
+    "voice_ice": {"target": (str, _REQUIRED), "candidate": ((dict, str), _REQUIRED)},
+    "edit_message": {"msg_id": (_ID, _REQUIRED), "content": (str, "")},
+    "delete_message": {"msg_id": (_ID, _REQUIRED)},
+    "reaction": {"msg_id": (_ID, _REQUIRED), "emoji": (str, _REQUIRED)},
+    "message": {"content": (str, ""), "file_url": (str, None), "reply_to_id": (_ID, None),
+                "reply_to_user": (str, None), "reply_to_content": (str, None)},
+}
+for _schema in WS_FRAME_SCHEMAS.values():
+    _schema["room"] = (str, None)
+
+
+class FrameCodec:
+    def __init__(self, name: str = JSON_CODEC):
+        self.name, self.dumps, self.loads, self.errors = self._load(name)
+        self.decoded = 0
+        self.invalid = 0
+
+    @staticmethod
+    def _load(name):
+        if name in ("auto", "msgspec"):
+            try:
+                import msgspec
+                encode = msgspec.json.Encoder().encode
+                return "msgspec", lambda obj: encode(obj).decode(), msgspec.json.Decoder().decode, (msgspec.DecodeError,)
+            except ImportError:
+                if name == "msgspec":
+                    raise
+        if name in ("auto", "orjson"):
+            try:
+                import orjson
+                dumps = orjson.dumps
+                return "orjson", lambda obj: dumps(obj).decode(), orjson.loads, (orjson.JSONDecodeError,)
+            except ImportError:
+                if name == "orjson":
+                    raise
+        return "stdlib", json.dumps, json.loads, (ValueError,)
+
+    def frame(self, msg: dict, raw: dict = None) -> str:
+        """Serializa msg; raw são campos já codificados (ex.: o user do socket),
+        colados no frame sem serializar de novo."""
+        text = self.dumps(msg)
+        if not raw:
+            return text
+        # Chave repetida viraria JSON ambíguo (cada parser fica com uma das duas)
+        assert raw.keys().isdisjoint(msg), f"campos em msg e raw: {sorted(raw.keys() & msg.keys())}"
+        fields = ",".join(f'"{k}":{v}' for k, v in raw.items())
+        return "{" + fields + ("," + text[1:] if msg else "}")
+
+    def decode_frame(self, text):
+        """Frame do cliente já validado contra WS_FRAME_SCHEMAS, ou None se inválido."""
+        self.decoded += 1
+        try:
+            data = self.loads(text)
+        except self.errors:
+            data = None
+        if isinstance(data, dict):
+            mtype = data.get("type", "message")
+            schema = WS_FRAME_SCHEMAS.get(mtype) if isinstance(mtype, str) else None
+            if schema is not None:
+                frame = {"type": mtype}
+                for field, (types, default) in schema.items():
+                    value = data.get(field, default)
+                    if types is _ID and isinstance(value, str) and value.isascii() and value.isdigit():
+                        value = int(value)
+                    elif isinstance(value, bool) and types is _ID:
+                        break
+                    if value is _REQUIRED or not (isinstance(value, types) or value is default):
+                        break
+                    frame[field] = value
+                else:
+                    return frame
+        self.invalid += 1
+        return None
 
-    def get_users(self, room_id):
+    def stats(self):
+        return {"codec": self.name, "decoded": self.decoded, "invalid": self.invalid}
+
+
+codec = FrameCodec()
+
+
+# ========== BACKPLANE (pub/sub entre workers) ==========
+# Cada processo só conhece os próprios sockets. Com vários workers (uvicorn
+# --workers N, ou várias máquinas) tudo que precisa alcançar sockets de outro
+# processo passa pelo backplane: broadcast de room, send_to_user, notificações,
+# presença nos rooms e alterações do cache de histórico. Quem publica entrega
+# localmente na hora e os outros workers entregam ao receber o evento.
+# LUMINA_BACKPLANE:
+#   "local" (padrão)                   - um processo só, nada sai dele
+#   "redis://[:senha@]host:porta"      - pub/sub num servidor compatível com Redis (RESP)
+#   "unix:///caminho/redis.sock"       - o mesmo, por socket local
+BACKPLANE_URL = os.environ.get("LUMINA_BACKPLANE", "local")
+BACKPLANE_CHANNEL = os.environ.get("LUMINA_BACKPLANE_CHANNEL", "lumina")
+BACKPLANE_OUTBOX_SIZE = int(os.environ.get("LUMINA_BACKPLANE_OUTBOX_SIZE", "10000"))
+PRESENCE_SYNC_S = float(os.environ.get("LUMINA_PRESENCE_SYNC_S", "15"))
+
+
+class LocalBackplane:
+    """Backplane dentro do processo. Sozinho não entrega nada a ninguém; instâncias
+    que compartilham o mesmo hub se enxergam como workers separados."""
+
+    def __init__(self, node_id: str = None, hub: list = None):
+        self.node_id = node_id or WORKER_ID
+        self.hub = hub if hub is not None else []
+        self.hub.append(self)
+        self._handler = None
+        self._loop = None
+        self.published = 0
+        self.received = 0
+
+    async def start(self, handler):
+        self._loop = asyncio.get_running_loop()
+        self._handler = handler
+
+    def publish(self, event: dict):
+        """Pode ser chamado de qualquer thread; a entrega roda no loop de cada worker."""
+        self.published += 1
+        event = {**event, "o": self.node_id}
+        for peer in self.hub:
+            if peer is not self and peer._handler:
+                peer._loop.call_soon_threadsafe(peer._deliver, event)
+
+    def _deliver(self, event):
+        self.received += 1
+        self._handler(event)
+
+    async def close(self):
+        self._handler = None
+        if self in self.hub:
+            self.hub.remove(self)
+
+    def stats(self):
+        return {"backend": "local", "node_id": self.node_id, "peers": len(self.hub) - 1,
+                "published": self.published, "received": self.received}
+
+
+class RedisBackplane:
+    """Pub/sub em servidor compatível com Redis, falando RESP direto (sem dependência
+    extra). Uma conexão fica em SUBSCRIBE; a outra publica em lote o que estiver na
+    fila de saída, então publish() nunca espera a rede."""
+
+    def __init__(self, url: str, channel: str = BACKPLANE_CHANNEL, node_id: str = None):
+        parts = urlsplit(url)
+        self.url = url
+        self.unix_path = parts.path if parts.scheme == "unix" else None
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.channel = channel
+        self.node_id = node_id or WORKER_ID
+        self._handler = None
+        self._loop = None
+        self._thread = None
+        self._outbox = None
+        self._tasks = []
+        self.connected = False
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    async def start(self, handler):
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.get_ident()
+        self._handler = handler
+        self._outbox = asyncio.Queue(maxsize=BACKPLANE_OUTBOX_SIZE)
+        subscribed = self._loop.create_future()
+        self._tasks = [self._loop.create_task(self._listen(subscribed)),
+                       self._loop.create_task(self._publisher())]
+        # Espera o SUBSCRIBE para não perder eventos publicados logo após o startup
+        try:
+            await asyncio.wait_for(asyncio.shield(subscribed), timeout=5)
+        except asyncio.TimeoutError:
+            import warnings
+            warnings.warn(f"Backplane {self.url} indisponivel; tentando reconectar em segundo plano")
+
+    def publish(self, event: dict):
+        """Pode ser chamado de qualquer thread."""
+        if self._outbox is None:
+            return
+        data = codec.dumps({**event, "o": self.node_id})
+        if threading.get_ident() == self._thread:
+            self._enqueue(data)
+        else:
+            self._loop.call_soon_threadsafe(self._enqueue, data)
+
+    def _enqueue(self, data: str):
+        try:
+            self._outbox.put_nowait(data)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _open(self):
+        if self.unix_path:
+            reader, writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(self._command("AUTH", self.password))
+            await writer.drain()
+            await self._read_reply(reader)
+        return reader, writer
+
+    @staticmethod
+    def _command(*args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    @classmethod
+    async def _read_reply(cls, reader):
+        line = await reader.readuntil(b"\r\n")
+        kind, rest = line[:1], line[1:-2]
+        if kind in (b"+", b":"):
+            return rest
+        if kind == b"-":
+            raise RuntimeError(rest.decode(errors="replace"))
+        if kind == b"$":
+            size = int(rest)
+            return None if size < 0 else (await reader.readexactly(size + 2))[:-2]
+        if kind == b"*":
+            return [await cls._read_reply(reader) for _ in range(int(rest))]
+        raise ConnectionError(f"resposta RESP invalida: {line!r}")
+
+    async def _listen(self, subscribed):
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._open()
+                writer.write(self._command("SUBSCRIBE", self.channel))
+                await writer.drain()
+                await self._read_reply(reader)
+                self.connected = True
+                if not subscribed.done():
+                    subscribed.set_result(True)
+                while True:
+                    reply = await self._read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._on_message(reply[2])
+            except asyncio.CancelledError:
+                raise
+            except (OSError, EOFError, ConnectionError, RuntimeError, asyncio.IncompleteReadError):
+                self.connected = False
+                self.reconnects += 1
+                await asyncio.sleep(1)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    def _on_message(self, data: bytes):
+        try:
+            event = codec.loads(data)
+        except codec.errors:
+            self.errors += 1
+            return
+        if event.get("o") == self.node_id:
+            return
+        self.received += 1
+        try:
+            self._handler(event)
+        except Exception:
+            self.errors += 1
+
+    async def _publisher(self):
+        conn = None
+        try:
+            while True:
+                batch = [await self._outbox.get()]
+                while not self._outbox.empty() and len(batch) < 512:
+                    batch.append(self._outbox.get_nowait())
+                try:
+                    if conn is None:
+                        conn = await self._open()
+                    reader, writer = conn
+                    # Pipeline: todos os PUBLISH do lote de uma vez, depois as respostas
+                    writer.write(b"".join(self._command("PUBLISH", self.channel, data) for data in batch))
+                    await writer.drain()
+                    for _ in batch:
+                        await self._read_reply(reader)
+                    self.published += len(batch)
+                except (OSError, EOFError, ConnectionError, RuntimeError, asyncio.IncompleteReadError):
+                    # O lote se perde; quem estava no outro worker recupera pelo delta ao reconectar
+                    self.errors += 1
+                    self.dropped += len(batch)
+                    if conn is not None:
+                        conn[1].close()
+                    conn = None
+                    await asyncio.sleep(1)
+        finally:
+            if conn is not None:
+                conn[1].close()
+
+    async def close(self):
+        # Dá uma chance à fila de saída antes de cancelar (eventos "bye" do shutdown)
+        for _ in range(50):
+            if self._outbox is None or self._outbox.empty():
+                break
+            await asyncio.sleep(0.01)
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self.connected = False
+
+    def stats(self):
+        return {"backend": "redis", "node_id": self.node_id, "connected": self.connected,
+                "published": self.published, "received": self.received, "dropped": self.dropped,
+                "errors": self.errors, "reconnects": self.reconnects,
+                "outbox": self._outbox.qsize() if self._outbox else 0}
+
+
+def make_backplane(url: str = BACKPLANE_URL):
+    if url == "local":
+        return LocalBackplane()
+    if url.startswith(("redis://", "unix://")):
+        return RedisBackplane(url)
+    raise ValueError(f"LUMINA_BACKPLANE invalido: {url}")
+
+
+backplane = make_backplane()
+
+
+# ========== FAN-OUT ==========
+# Cada socket tem uma fila de saída limitada e uma task escritora própria: o
+# broadcast serializa uma vez e só enfileira, sem esperar nenhum cliente. Um
+# cliente lento não atrasa os outros; com a fila cheia entra a política:
+#   "disconnect" (padrão) - fecha o socket (1013); o cliente reconecta e recebe o delta
+#   "drop"                - descarta o frame para aquele cliente
+# Frames efêmeros (indicador de digitando) são descartados já com a fila pela metade.
+FANOUT_QUEUE_SIZE = int(os.environ.get("LUMINA_FANOUT_QUEUE_SIZE", "256"))
+SLOW_CONSUMER_POLICY = os.environ.get("LUMINA_SLOW_CONSUMER_POLICY", "disconnect")
+# Heartbeat: o cliente manda {"type": "ping"} a cada 30s e recebe "pong" sem tocar
+# no banco. Socket de room sem nenhum frame por WS_IDLE_TIMEOUT_S é considerado
+# zumbi: sai dos rooms (com user_left) e é fechado pelo reaper.
+WS_IDLE_TIMEOUT_S = float(os.environ.get("LUMINA_WS_IDLE_TIMEOUT_S", "90"))
+WS_REAP_INTERVAL_S = float(os.environ.get("LUMINA_WS_REAP_INTERVAL_S", "15"))
+PONG_FRAME = codec.dumps({"type": "pong"})
+
+
+class ClientConnection:
+    """Socket com fila de saída limitada e uma task escritora."""
+
+    def __init__(self, ws, on_sent):
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=FANOUT_QUEUE_SIZE)
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.last_seen = time.monotonic()
+        self._on_sent = on_sent
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def push(self, frame: str, room_id=None, ephemeral: bool = False) -> bool:
+        if self.closed:
+            return False
+        if ephemeral and self.queue.qsize() >= self.queue.maxsize // 2:
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait((frame, time.perf_counter(), room_id))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                self.close(code=1013)
+            return False
+
+    async def _run(self):
+        try:
+            while True:
+                frame, queued_at, room_id = await self.queue.get()
+                await self.ws.send_text(frame)
+                self.sent += 1
+                self._on_sent(room_id, time.perf_counter() - queued_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket morto: fecha para o receive do ws_endpoint sair e fazer a limpeza
+            self.close(code=1011)
+
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        asyncio.get_running_loop().create_task(self._close_ws(code))
+
+    async def _close_ws(self, code):
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+        self._task.cancel()
+
+    def stop(self):
+        self.closed = True
+        self._task.cancel()
+
+
+class RoomManager:
+    """Sockets e rooms deste worker.
+
+    Um socket pode estar em vários rooms ao mesmo tempo (sessão multiplexada do
+    /ws/session); o /ws/{room_id} antigo é só o caso de um room por socket.
+    sessions indexa usuário -> sockets -> rooms, então várias abas do mesmo
+    usuário convivem sem uma sobrescrever a outra.
+    """
+
+    def __init__(self, backplane):
+        self.backplane = backplane
+        self.rooms = {}
+        self.user_info = {}
+        self.user_json = {}  # ws -> user já codificado, colado nos frames que levam "user"
+        self.sessions = {}  # user_id -> {ws: set(room_id)}
+        self.voice_users = {}
+        self.conns = {}
+        self.room_stats = {}
+        self._latencies = deque(maxlen=4096)
+        # Presença vista nos outros workers: node_id -> {"seen", "rooms": {room: [user]}, "voice": {room: {id: user}}}
+        self.remote = {}
+        self._tasks = []
+        self.heartbeats = 0
+        self.reaped = 0
+
+    def attach(self, ws, user):
+        """Registra o socket (fila de saída própria) sem entrar em room nenhum."""
+        if ws not in self.conns:
+            self.conns[ws] = ClientConnection(ws, self._record_delivery)
+        self.user_info[ws] = user
+        self.user_json[ws] = codec.dumps(user)
+        self.sessions.setdefault(user["id"], {}).setdefault(ws, set())
+        return self.conns[ws]
+
+    def join(self, room_id, ws) -> bool:
+        """Inscreve o socket no room; False se ele já estava inscrito."""
+        user = self.user_info[ws]
+        subscribed = self.sessions[user["id"]][ws]
+        if room_id in subscribed:
+            return False
+        subscribed.add(room_id)
+        self.rooms.setdefault(room_id, []).append(ws)
+        self._publish_presence("join", room_id, user)
+        return True
+
+    def leave_room(self, room_id, ws) -> bool:
+        """Tira o socket do room; False se ele não estava inscrito."""
+        user = self.user_info.get(ws)
+        subscribed = self.sessions.get(user["id"], {}).get(ws, ()) if user else ()
+        if room_id not in subscribed:
+            return False
+        subscribed.discard(room_id)
+        sockets = self.rooms.get(room_id, [])
+        if ws in sockets:
+            sockets.remove(ws)
+        if not sockets:
+            self.rooms.pop(room_id, None)
+            self.room_stats.pop(room_id, None)
+        self._publish_presence("leave", room_id, user)
+        return True
+
+    def rooms_of(self, ws):
+        user = self.user_info.get(ws)
+        return self.sessions.get(user["id"], {}).get(ws, set()) if user else set()
+
+    async def part(self, room_id, ws):
+        """Sai do room avisando quem fica (user_left e, se estava na voz, voice_user_left)."""
+        user = self.user_info.get(ws)
+        if not self.leave_room(room_id, ws):
+            return
+        typing_tracker.stop(room_id, user["id"])
+        user_json = self.user_json[ws]
+        await self.broadcast(room_id, {"type": "user_left"}, raw={"user": user_json, "users": self.users_json(room_id)})
+        if user["id"] in self.voice_users.get(room_id, {}):
+            self.voice_leave(room_id, user["id"])
+            await self.broadcast(room_id, {"type": "voice_user_left", "voice_users": self.get_voice_users(room_id)}, raw={"user": user_json})
+
+    async def close_session(self, ws):
+        """Sai de todos os rooms do socket e descarta a conexão. Idempotente (o reaper
+        pode ter chegado antes do finally do endpoint)."""
+        for room_id in list(self.rooms_of(ws)):
+            await self.part(room_id, ws)
+        conn = self.conns.pop(ws, None)
+        if conn:
+            conn.stop()
+        self.user_json.pop(ws, None)
+        user = self.user_info.pop(ws, None)
+        if user:
+            sockets = self.sessions.get(user["id"], {})
+            sockets.pop(ws, None)
+            if not sockets:
+                self.sessions.pop(user["id"], None)
+
+    def send(self, ws, msg, raw=None):
+        """Enfileira um frame para um socket só (mantém a ordem com os broadcasts)."""
+        conn = self.conns.get(ws)
+        if conn:
+            conn.push(codec.frame(msg, raw))
+
+    async def broadcast(self, room_id, msg, exclude=None, ephemeral=False, raw=None):
+        # Todo frame de room leva o room: na sessão multiplexada é o que diz ao cliente de onde ele veio
+        text = codec.frame({**msg, "room": room_id}, raw)
+        self._deliver_room(room_id, text, exclude, ephemeral)
+        self.backplane.publish({"k": "room", "r": room_id, "f": text, "e": ephemeral})
+
+    def broadcast_local(self, room_id, msg, ephemeral=False):
+        """Como broadcast, mas só para os sockets deste worker (quem chama cuida dos outros)."""
+        self._deliver_room(room_id, codec.frame({**msg, "room": room_id}), ephemeral=ephemeral)
+
+    def _deliver_room(self, room_id, text, exclude=None, ephemeral=False):
         if room_id not in self.rooms:
-            return []
-        return [self.user_info[ws] for ws in self.rooms[room_id] if ws in self.user_info]
+            return
+        stats = self.room_stats.setdefault(room_id, {"fanouts": 0, "frames": 0, "delivered": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["fanouts"] += 1
+        for ws in self.rooms[room_id]:
+            if ws is exclude:
+                continue
+            conn = self.conns.get(ws)
+            if conn and conn.push(text, room_id, ephemeral):
+                stats["frames"] += 1
+
+    async def send_to_user(self, user_id, room_id, msg):
+        """Frame para os sockets do usuário inscritos em room_id (aqui ou em outro worker)."""
+        text = codec.dumps({**msg, "room": room_id})
+        # Sempre publica, como no broadcast: o usuário pode ter abas em vários workers
+        self._deliver_user(user_id, room_id, text)
+        self.backplane.publish({"k": "user", "u": user_id, "r": room_id, "f": text})
+
+    def _deliver_user(self, user_id, room_id, text):
+        for ws, subscribed in self.sessions.get(user_id, {}).items():
+            conn = self.conns.get(ws)
+            if room_id in subscribed and conn:
+                conn.push(text, room_id)
+
+    def voice_join(self, room_id, user):
+        self.voice_users.setdefault(room_id, {})[user["id"]] = user
+        self._publish_presence("voice_join", room_id, user)
+
+    def voice_leave(self, room_id, user_id):
+        user = self.voice_users.get(room_id, {}).pop(user_id, None)
+        if room_id in self.voice_users and not self.voice_users[room_id]:
+            del self.voice_users[room_id]
+        if user:
+            self._publish_presence("voice_leave", room_id, user)
+
+    def touch(self, ws):
+        conn = self.conns.get(ws)
+        if conn:
+            conn.last_seen = time.monotonic()
+
+    def pong(self, ws):
+        self.heartbeats += 1
+        conn = self.conns.get(ws)
+        if conn:
+            conn.push(PONG_FRAME)
+
+    async def reap_idle(self):
+        """Tira dos rooms e fecha sockets sem frame nenhum há mais de WS_IDLE_TIMEOUT_S."""
+        deadline = time.monotonic() - WS_IDLE_TIMEOUT_S
+        for ws, conn in list(self.conns.items()):
+            if conn.last_seen >= deadline:
+                continue
+            self.reaped += 1
+            conn.close(code=1001)
+            await self.close_session(ws)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(WS_REAP_INTERVAL_S)
+            await self.reap_idle()
+
+    # ----- presença entre workers -----
+
+    def _publish_presence(self, op, room_id, user):
+        self.backplane.publish({"k": "presence", "op": op, "r": room_id, "user": user})
+
+    def _snapshot(self):
+        return {
+            "rooms": {room_id: [self.user_info[ws] for ws in sockets if ws in self.user_info]
+                      for room_id, sockets in self.rooms.items()},
+            "voice": {room_id: users for room_id, users in self.voice_users.items()},
+        }
+
+    def handle_event(self, event):
+        """Evento de outro worker vindo do backplane."""
+        kind = event.get("k")
+        if kind == "room":
+            self._deliver_room(event["r"], event["f"], ephemeral=event.get("e", False))
+        elif kind == "user":
+            self._deliver_user(event["u"], event.get("r"), event["f"])
+        elif kind == "presence":
+            self._apply_presence(event)
+
+    def _apply_presence(self, event):
+        node_id, op = event["o"], event["op"]
+        if op == "bye":
+            self.remote.pop(node_id, None)
+            return
+        node = self.remote.setdefault(node_id, {"seen": 0.0, "rooms": {}, "voice": {}})
+        node["seen"] = time.monotonic()
+        if op == "hello":
+            # Worker novo: recebe o estado deste na hora em vez de esperar o próximo sync
+            self.backplane.publish({"k": "presence", "op": "snapshot", **self._snapshot()})
+        elif op == "snapshot":
+            node["rooms"] = event["rooms"]
+            node["voice"] = event["voice"]
+        elif op == "join":
+            node["rooms"].setdefault(event["r"], []).append(event["user"])
+        elif op == "leave":
+            users = node["rooms"].get(event["r"], [])
+            for i, u in enumerate(users):
+                if u.get("id") == event["user"].get("id"):
+                    del users[i]
+                    break
+            if not users:
+                node["rooms"].pop(event["r"], None)
+        elif op == "voice_join":
+            node["voice"].setdefault(event["r"], {})[event["user"]["id"]] = event["user"]
+        elif op == "voice_leave":
+            node["voice"].get(event["r"], {}).pop(event["user"]["id"], None)
+
+    def start(self):
+        if not self._tasks:
+            self.backplane.publish({"k": "presence", "op": "hello"})
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._sync_loop()), loop.create_task(self._reap_loop())]
+
+    async def _sync_loop(self):
+        # Snapshot periódico corrige eventos perdidos; worker que some (crash) expira
+        while True:
+            await asyncio.sleep(PRESENCE_SYNC_S)
+            self.backplane.publish({"k": "presence", "op": "snapshot", **self._snapshot()})
+            deadline = time.monotonic() - 3 * PRESENCE_SYNC_S
+            for node_id in [n for n, node in self.remote.items() if node["seen"] < deadline]:
+                del self.remote[node_id]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self.backplane.publish({"k": "presence", "op": "bye"})
+
+    def _record_delivery(self, room_id, seconds):
+        ms = seconds * 1000
+        self._latencies.append(ms)
+        stats = self.room_stats.get(room_id)
+        if stats is not None:
+            stats["delivered"] += 1
+            stats["total_ms"] += ms
+            if ms > stats["max_ms"]:
+                stats["max_ms"] = ms
+
+    def fanout_stats(self, top: int = 20):
+        lat = sorted(self._latencies)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(len(lat) * p))], 3) if lat else 0.0
+        rooms = {}
+        busiest = sorted(self.room_stats.items(), key=lambda kv: kv[1]["fanouts"], reverse=True)[:top]
+        for room_id, st in busiest:
+            depths = [self.conns[ws].queue.qsize() for ws in self.rooms.get(room_id, []) if ws in self.conns]
+            rooms[room_id] = {
+                "members": len(self.rooms.get(room_id, [])),
+                "fanouts": st["fanouts"],
+                "frames": st["frames"],
+                "avg_delivery_ms": round(st["total_ms"] / st["delivered"], 3) if st["delivered"] else 0.0,
+                "max_delivery_ms": round(st["max_ms"], 3),
+                "max_queue_depth": max(depths) if depths else 0,
+            }
+        conns = list(self.conns.values())
+        return {
+            "connections": len(conns),
+            "users": len(self.sessions),
+            "policy": SLOW_CONSUMER_POLICY,
+            "queue_depth_total": sum(c.queue.qsize() for c in conns),
+            "dropped_frames": sum(c.dropped for c in conns),
+            "heartbeats": self.heartbeats,
+            "reaped_idle": self.reaped,
+            "delivery_p50_ms": pct(0.50),
+            "delivery_p99_ms": pct(0.99),
+            "rooms": rooms,
+        }
+
+    def users_json(self, room_id) -> str:
+        """get_users já codificado: os perfis locais saem do user_json, sem re-encode."""
+        parts = [self.user_json[ws] for ws in self.rooms.get(room_id, []) if ws in self.user_json]
+        remote = [u for node in self.remote.values() for u in node["rooms"].get(room_id, [])]
+        if remote:
+            parts.append(codec.dumps(remote)[1:-1])
+        return "[" + ",".join(parts) + "]"
+
+    def get_users(self, room_id):
+        users = [self.user_info[ws] for ws in self.rooms.get(room_id, []) if ws in self.user_info]
+        for node in self.remote.values():
+            users.extend(node["rooms"].get(room_id, []))
+        return users
 
     def get_voice_users(self, room_id):
-        return list(self.voice_users.get(room_id, {}).values())
+        users = list(self.voice_users.get(room_id, {}).values())
+        for node in self.remote.values():
+            users.extend(node["voice"].get(room_id, {}).values())
+        return users
+
+
+# Indicador de digitando: o cliente manda "typing" enquanto digita. Em vez de
+# repassar cada evento ao room inteiro, o servidor guarda quem está digitando
+# (expira em TYPING_TTL_S sem novo evento) e manda no máximo um "typing_set" por
+# room a cada TYPING_INTERVAL_S, só com os ids e só quando o conjunto muda. Pelo
+# backplane vai só a mudança de estado (mais uma renovação a cada meio TTL); cada
+# worker monta o conjunto e entrega o frame aos próprios sockets.
+TYPING_TTL_S = float(os.environ.get("LUMINA_TYPING_TTL_S", "4"))
+TYPING_INTERVAL_S = float(os.environ.get("LUMINA_TYPING_INTERVAL_S", "0.5"))
+
+
+class TypingTracker:
+    def __init__(self, rooms: RoomManager, ttl: float = TYPING_TTL_S, interval: float = TYPING_INTERVAL_S):
+        self.manager = rooms
+        self.ttl = ttl
+        self.interval = interval
+        self.rooms = {}  # room_id -> {user_id: [expira_em, renovação_publicada_em]}
+        self.sent = {}   # room_id -> ids do último typing_set entregue
+        self.dirty = set()
+        self._wake = None
+        self._task = None
+        self.received = 0
+        self.suppressed = 0
+        self.expired = 0
+        self.frames = 0
+
+    def typing(self, room_id, user_id, share: bool = True):
+        now = time.monotonic()
+        typers = self.rooms.setdefault(room_id, {})
+        entry = typers.get(user_id)
+        if share:
+            self.received += 1
+        if entry is None:
+            typers[user_id] = [now + self.ttl, now]
+            self._mark(room_id)
+            if share:
+                backplane.publish({"k": "typing", "r": room_id, "u": user_id, "on": True})
+            return
+        # Já estava digitando: só renova a expiração, nenhum frame sai
+        entry[0] = now + self.ttl
+        if share:
+            self.suppressed += 1
+            if now - entry[1] >= self.ttl / 2:
+                entry[1] = now
+                backplane.publish({"k": "typing", "r": room_id, "u": user_id, "on": True})
+
+    def stop(self, room_id, user_id, share: bool = True):
+        """Mensagem enviada ou saída do room: para de digitar sem esperar a expiração."""
+        typers = self.rooms.get(room_id)
+        if typers is None or typers.pop(user_id, None) is None:
+            return
+        self._mark(room_id)
+        if share:
+            backplane.publish({"k": "typing", "r": room_id, "u": user_id, "on": False})
+
+    def apply_remote(self, event):
+        if event["on"]:
+            self.typing(event["r"], event["u"], share=False)
+        else:
+            self.stop(event["r"], event["u"], share=False)
+
+    def _mark(self, room_id):
+        self.dirty.add(room_id)
+        if self._wake is not None:
+            self._wake.set()
+
+    def flush(self):
+        now = time.monotonic()
+        for room_id, typers in list(self.rooms.items()):
+            gone = [user_id for user_id, entry in typers.items() if entry[0] <= now]
+            for user_id in gone:
+                del typers[user_id]
+            if gone:
+                self.expired += len(gone)
+                self.dirty.add(room_id)
+            if not typers:
+                del self.rooms[room_id]
+        for room_id in self.dirty:
+            ids = sorted(self.rooms.get(room_id, ()))
+            if ids == self.sent.get(room_id, []):
+                continue
+            if ids:
+                self.sent[room_id] = ids
+            else:
+                self.sent.pop(room_id, None)
+            self.manager.broadcast_local(room_id, {"type": "typing_set", "users": ids}, ephemeral=True)
+            self.frames += 1
+        self.dirty.clear()
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self.rooms and not self.dirty:
+                # Ninguém digitando: dorme até o próximo evento em vez de acordar a cada intervalo
+                self._wake.clear()
+                await self._wake.wait()
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"rooms": len(self.rooms), "typing": sum(len(t) for t in self.rooms.values()),
+                "received": self.received, "suppressed": self.suppressed, "expired": self.expired,
+                "frames": self.frames, "ttl_s": self.ttl, "interval_s": self.interval}
+
+
+# Notificações: amizades, não lidas e status dos amigos são empurrados pelo
+# socket em vez de o cliente fazer polling (no /ws/session, ou no /ws/notifications
+# dos clientes antigos). Cada evento ganha uma versão "worker.seq" e fica num log
+# curto por usuário; ao reconectar o cliente manda a versão no handshake da sessão
+# (ou pede /api/notifications/since?v=...) e recebe só o que perdeu, ou um reset
+# com o estado completo se o log não cobre mais a versão ou ela é de outro worker.
+NOTIF_LOG_PER_USER = int(os.environ.get("LUMINA_NOTIF_LOG_PER_USER", "100"))
+NOTIF_LOG_USERS = int(os.environ.get("LUMINA_NOTIF_LOG_USERS", "10000"))
 
 
 class NotifManager:
-    def __init__(self):
+    def __init__(self, backplane):
+        self.backplane = backplane
         self.conns = {}
+        self.seq = 0
+        self.logs = OrderedDict()  # user_id -> {"floor": seq, "events": deque[(seq, msg)]}
+        self.evicted_seq = 0
+        self.pushed = 0
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.get_ident()
+
+    def attach(self, user_id, conn):
+        """Passa a entregar os eventos do usuário nesta conexão (uma por aba/sessão)."""
+        self.conns.setdefault(user_id, []).append(conn)
+
+    def detach(self, user_id, conn):
+        conns = self.conns.get(user_id, [])
+        if conn in conns:
+            conns.remove(conn)
+        if not conns:
+            self.conns.pop(user_id, None)
 
     def connect(self, user_id, ws):
-        self.conns[user_id] = ws
-
-    def disconnect(self, user_id):
-        self.conns.pop(user_id, None)
+        """Socket dedicado do /ws/notifications (clientes antigos)."""
+        conn = ClientConnection(ws, lambda room_id, seconds: None)
+        self.attach(user_id, conn)
+        conn.push(codec.dumps({"type": "hello", "v": self.version()}))
+        return conn
+
+    def disconnect(self, user_id, conn):
+        conn.stop()
+        self.detach(user_id, conn)
+
+    def version(self) -> str:
+        return f"{WORKER_ID}.{self.seq}"
+
+    def notify(self, user_id, msg):
+        """Pode ser chamado de qualquer thread. Registra e entrega aqui e nos outros workers."""
+        if self._loop is not None and threading.get_ident() != self._thread:
+            self._loop.call_soon_threadsafe(self.notify, user_id, msg)
+            return
+        self.backplane.publish({"k": "notif", "u": user_id, "m": msg})
+        self.record(user_id, msg)
 
     async def send(self, user_id, msg):
-        ws = self.conns.get(user_id)
-        if ws:
+        self.notify(user_id, msg)
+
+    def record(self, user_id, msg):
+        self.seq += 1
+        log = self.logs.get(user_id)
+        if log is None:
+            # Sem log = nenhum evento desde o último log descartado (evicted_seq)
+            log = self.logs[user_id] = {"floor": self.evicted_seq, "events": deque(maxlen=NOTIF_LOG_PER_USER)}
+            while len(self.logs) > NOTIF_LOG_USERS:
+                _, old = self.logs.popitem(last=False)
+                self.evicted_seq = max(self.evicted_seq, old["events"][-1][0])
+        else:
+            self.logs.move_to_end(user_id)
+        events = log["events"]
+        if len(events) == events.maxlen:
+            log["floor"] = events[0][0]
+        events.append((self.seq, msg))
+        conns = self.conns.get(user_id)
+        if conns:
+            text = codec.dumps({**msg, "v": self.version()})
+            for conn in conns:
+                conn.push(text)
+            self.pushed += 1
+
+    def changes_since(self, user_id, version: str):
+        """Eventos depois de version, ou None se o cliente precisa de um reset."""
+        worker, _, seq = (version or "").partition(".")
+        if worker != WORKER_ID or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        since = int(seq)
+        log = self.logs.get(user_id)
+        if since < (log["floor"] if log else self.evicted_seq):
+            return None
+        if not log:
+            return []
+        return [{**msg, "v": f"{WORKER_ID}.{s}"} for s, msg in log["events"] if s > since]
+
+    def stats(self):
+        return {"connections": sum(len(c) for c in self.conns.values()), "version": self.version(), "pushed": self.pushed,
+                "logged_users": len(self.logs)}
+
+
+# ========== PRESENÇA ==========
+# Status escolhido (online, busy, away, invisible), conexões abertas e last_seen
+# ficam em memória: conectar e desconectar não tocam no banco. last_seen e status
+# vão para users em lote a cada PRESENCE_FLUSH_S (e no shutdown). Os outros veem o
+# status efetivo ("offline" sem conexão ou invisível) e recebem só as mudanças,
+# agrupadas a cada PRESENCE_PUSH_S: uma queda só vira "offline" depois de
+# PRESENCE_OFFLINE_GRACE_S, então uma conexão móvel oscilando não gera evento
+# nenhum. Os eventos vão só para amigos e membros dos mesmos círculos.
+# Com vários workers cada um publica as próprias conexões ("status" up/down/set e
+# um snapshot a cada PRESENCE_SYNC_S); anuncia a mudança o worker onde ela ocorreu.
+PRESENCE_PUSH_S = float(os.environ.get("LUMINA_PRESENCE_PUSH_S", "1"))
+PRESENCE_FLUSH_S = float(os.environ.get("LUMINA_PRESENCE_FLUSH_S", "10"))
+PRESENCE_OFFLINE_GRACE_S = float(os.environ.get("LUMINA_PRESENCE_OFFLINE_GRACE_S", "15"))
+PRESENCE_STATUSES = ("online", "busy", "away", "invisible")
+
+
+def _presence_audiences(user_ids):
+    """Quem vê o status de cada usuário: amigos e membros dos mesmos círculos."""
+    audiences = {}
+    with db_conn(USERS_DB) as conn:
+        for user_id in user_ids:
+            rows = conn.execute("""SELECT friend_id FROM friendships WHERE user_id = ? AND status = 'accepted'
+                UNION SELECT user_id FROM friendships WHERE friend_id = ? AND status = 'accepted'
+                UNION SELECT o.user_id FROM circles_db.circle_members m
+                    JOIN circles_db.circle_members o ON o.circle_id = m.circle_id
+                    WHERE m.user_id = ? AND o.user_id != ?""", (user_id,) * 4).fetchall()
+            audiences[user_id] = [r[0] for r in rows]
+    return audiences
+
+
+class PresenceService:
+    def __init__(self, rooms: RoomManager):
+        self.manager = rooms
+        self.chosen = {}      # user_id -> status escolhido (usuários ativos, aqui ou em outro worker)
+        self.local = {}       # user_id -> conexões abertas neste worker
+        self.dropped = {}     # user_id -> quando a última conexão daqui caiu (monotonic)
+        self.nodes = {}       # node_id -> set(user_id) conectados naquele worker
+        self.announced = {}   # user_id -> último status efetivo anunciado por este worker
+        self.pending = {}     # user_id -> quando reavaliar e anunciar (monotonic)
+        self.seen = {}        # user_id -> last_seen ainda não gravado
+        self.status_dirty = set()
+        self._lock = threading.Lock()
+        self._task = None
+        self.connects = 0
+        self.announcements = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    # ----- conexões e status -----
+
+    def needs_load(self, user_id) -> bool:
+        return user_id not in self.chosen
+
+    def load(self, user_id):
+        """Status gravado do usuário (chamar fora do event loop, só quando needs_load)."""
+        with db_conn(USERS_DB) as conn:
+            row = conn.execute("SELECT status FROM users WHERE id = ?", (user_id,)).fetchone()
+        status = row["status"] if row and row["status"] in PRESENCE_STATUSES else "online"
+        with self._lock:
+            self.chosen.setdefault(user_id, status)
+
+    def connect(self, user_id):
+        with self._lock:
+            first = not self.local.get(user_id)
+            self.local[user_id] = self.local.get(user_id, 0) + 1
+            self.dropped.pop(user_id, None)
+            self.seen[user_id] = _db_now()
+            self.connects += 1
+            status = self.chosen.get(user_id)
+        if first:
+            backplane.publish({"k": "status", "op": "up", "u": user_id, "s": status})
+        self._schedule(user_id, 0)
+
+    def disconnect(self, user_id):
+        with self._lock:
+            left = self.local.get(user_id, 0) - 1
+            if left > 0:
+                self.local[user_id] = left
+            else:
+                self.local.pop(user_id, None)
+                self.dropped[user_id] = time.monotonic()
+            self.seen[user_id] = _db_now()
+        if left <= 0:
+            backplane.publish({"k": "status", "op": "down", "u": user_id})
+            self._schedule(user_id, PRESENCE_OFFLINE_GRACE_S)
+
+    def set_status(self, user_id, status: str):
+        """Status escolhido pelo usuário. Pode ser chamado de qualquer thread."""
+        with self._lock:
+            self.chosen[user_id] = status
+            self.status_dirty.add(user_id)
+        backplane.publish({"k": "status", "op": "set", "u": user_id, "s": status})
+        self._schedule(user_id, 0)
+
+    def _schedule(self, user_id, delay: float):
+        due = time.monotonic() + delay
+        with self._lock:
+            self.pending[user_id] = min(self.pending.get(user_id, due), due)
+
+    # ----- leitura -----
+
+    def _connected(self, user_id, now: float) -> bool:
+        if self.local.get(user_id):
+            return True
+        dropped = self.dropped.get(user_id)
+        if dropped is not None and now - dropped < PRESENCE_OFFLINE_GRACE_S:
+            return True
+        live = self.manager.remote
+        return any(user_id in users for node_id, users in self.nodes.items() if node_id in live)
+
+    def status_of(self, user_id, stored=None) -> str:
+        """Status escolhido (o que o próprio usuário vê)."""
+        with self._lock:
+            return self.chosen.get(user_id, stored) or "online"
+
+    def effective(self, user_id, stored=None) -> str:
+        """Status que os outros veem: "offline" sem conexão (passada a carência) ou invisível."""
+        with self._lock:
+            if not self._connected(user_id, time.monotonic()):
+                return "offline"
+            status = self.chosen.get(user_id, stored)
+        return "offline" if status == "invisible" else status or "online"
+
+    # ----- anúncio e gravação em lote -----
+
+    async def push(self):
+        """Anuncia as mudanças de status efetivo vencidas; as que se desfizeram não saem."""
+        now = time.monotonic()
+        changes = {}
+        with self._lock:
+            due = [user_id for user_id, at in self.pending.items() if at <= now]
+            for user_id in due:
+                del self.pending[user_id]
+                dropped = self.dropped.get(user_id)
+                if not self.local.get(user_id) and dropped is not None and now - dropped < PRESENCE_OFFLINE_GRACE_S:
+                    self.pending[user_id] = dropped + PRESENCE_OFFLINE_GRACE_S
+        for user_id in due:
+            if user_id in self.pending:
+                continue
+            status = self.effective(user_id)
+            # Quem nunca foi anunciado já aparece como offline para os outros
+            if self.announced.get(user_id, "offline") == status:
+                self.coalesced += 1
+                self._settle(user_id, status)
+            else:
+                changes[user_id] = status
+        if not changes:
+            return
+        try:
+            audiences = await run_db(_presence_audiences, list(changes))
+        except Exception:
+            # Nada saiu: announced fica como estava e as mudanças voltam para o próximo ciclo
+            for user_id in changes:
+                self._schedule(user_id, 0)
+            raise
+        for user_id, status in changes.items():
+            self._settle(user_id, status)
+            # Também para quem está desconectado: o log de notificações repõe na reconexão
+            msg = {"type": "friend_status", "user_id": user_id, "status": status}
+            recipients = audiences.get(user_id, ())
+            for recipient in recipients:
+                notif_manager.notify(recipient, msg)
+            self.announcements += 1
+            self.delivered += len(recipients)
+
+    def _settle(self, user_id, status):
+        if status == "offline":
+            self._forget(user_id)
+        else:
+            self.announced[user_id] = status
+
+    def _forget(self, user_id):
+        # Offline de vez: a memória guarda só quem está ativo (o próximo connect relê o status)
+        with self._lock:
+            self.announced.pop(user_id, None)
+            self.dropped.pop(user_id, None)
+            if user_id not in self.status_dirty and not self._connected(user_id, time.monotonic()):
+                self.chosen.pop(user_id, None)
+
+    def flush(self) -> int:
+        """Grava last_seen e status alterados (chamar fora do event loop)."""
+        with self._lock:
+            seen, self.seen = self.seen, {}
+            dirty, self.status_dirty = self.status_dirty, set()
+            statuses = [(self.chosen[user_id], user_id) for user_id in dirty if user_id in self.chosen]
+        if not seen and not statuses:
+            return 0
+        try:
+            with db_conn(USERS_DB) as conn:
+                conn.executemany("UPDATE users SET last_seen = ? WHERE id = ?", [(at, user_id) for user_id, at in seen.items()])
+                conn.executemany("UPDATE users SET status = ? WHERE id = ?", statuses)
+                conn.commit()
+        except Exception:
+            with self._lock:
+                for user_id, at in seen.items():
+                    self.seen.setdefault(user_id, at)
+                self.status_dirty |= dirty
+            raise
+        self.flushes += 1
+        self.rows_written += len(seen) + len(statuses)
+        return len(seen) + len(statuses)
+
+    # ----- entre workers -----
+
+    def publish_snapshot(self):
+        with self._lock:
+            users = {user_id: self.chosen.get(user_id) for user_id in self.local}
+        backplane.publish({"k": "status", "op": "snapshot", "users": users})
+
+    def apply_remote(self, event):
+        node_id, op = event["o"], event["op"]
+        with self._lock:
+            if op == "snapshot":
+                self.nodes[node_id] = set(event["users"])
+                for user_id, status in event["users"].items():
+                    if status:
+                        self.chosen.setdefault(user_id, status)
+            elif op == "up":
+                self.nodes.setdefault(node_id, set()).add(event["u"])
+                if event.get("s"):
+                    self.chosen.setdefault(event["u"], event["s"])
+            elif op == "down":
+                self.nodes.get(node_id, set()).discard(event["u"])
+            elif op == "set":
+                self.chosen[event["u"]] = event["s"]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        last_flush = last_snapshot = time.monotonic()
+        while True:
+            await asyncio.sleep(PRESENCE_PUSH_S)
+            now = time.monotonic()
             try:
-                await ws.send_text(json.dumps(msg))
-            except:
+                await self.push()
+                if now - last_flush >= PRESENCE_FLUSH_S:
+                    last_flush = now
+                    await run_db(self.flush)
+            except Exception:
+                # O que não foi gravado voltou para a fila; tenta de novo no próximo ciclo
                 pass
-
-
-manager = RoomManager()
-notif_manager = NotifManager()
+            if now - last_snapshot >= PRESENCE_SYNC_S:
+                last_snapshot = now
+                self.publish_snapshot()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await run_db(self.flush)
+
+    def stats(self):
+        with self._lock:
+            return {"local_users": len(self.local), "known_users": len(self.chosen), "pending": len(self.pending),
+                    "dirty": len(self.seen) + len(self.status_dirty), "connects": self.connects,
+                    "announcements": self.announcements, "delivered": self.delivered, "coalesced": self.coalesced,
+                    "flushes": self.flushes, "rows_written": self.rows_written}
+
+
+manager = RoomManager(backplane)
+notif_manager = NotifManager(backplane)
+typing_tracker = TypingTracker(manager)
+presence = PresenceService(manager)
+
+
+def _on_backplane_event(event):
+    kind = event.get("k")
+    if kind == "notif":
+        notif_manager.record(event["u"], event["m"])
+    elif kind == "cache":
+        history_cache.apply_remote(event)
+    elif kind == "unread":
+        unread_store.apply_remote(event)
+    elif kind == "auth":
+        auth_cache.invalidate_user(event["u"], share=False)
+    elif kind == "access":
+        access_cache.apply_remote(event)
+    elif kind == "typing":
+        typing_tracker.apply_remote(event)
+    elif kind == "status":
+        presence.apply_remote(event)
+    else:
+        if kind == "presence" and event.get("op") == "hello":
+            # Worker novo: recebe também quem está conectado aqui
+            presence.publish_snapshot()
+        manager.handle_event(event)
+
+
+# ========== CACHE DE AUTENTICAÇÃO ==========
+# require_user decodificava o JWT e fazia um SELECT em users a cada chamada REST.
+# Agora o token resolvido (claims + perfil) fica em cache por AUTH_CACHE_TTL_S,
+# nunca além do "exp" do token. update_status, update_profile, upload_avatar e a
+# conexão de notificações invalidam o usuário (em todos os workers, via backplane).
+AUTH_CACHE_TTL_S = float(os.environ.get("LUMINA_AUTH_CACHE_TTL_S", "60"))
+AUTH_CACHE_MAX = int(os.environ.get("LUMINA_AUTH_CACHE_MAX", "10000"))
+
+
+class AuthCache:
+    def __init__(self, ttl: float = AUTH_CACHE_TTL_S, max_entries: int = AUTH_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # token -> (expira_em, claims, perfil)
+        self.by_user = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, token: str):
+        """Perfil em cache para o token, ou None."""
+        with self._lock:
+            entry = self.entries.get(token)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, token: str, claims: dict, user: dict):
+        expires = time.time() + self.ttl
+        if "exp" in claims:
+            expires = min(expires, claims["exp"])
+        with self._lock:
+            self._drop(token)
+            self.entries[token] = (expires, claims, user)
+            self.by_user.setdefault(user["id"], set()).add(token)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, token: str):
+        entry = self.entries.pop(token, None)
+        if entry is not None:
+            tokens = self.by_user.get(entry[2]["id"])
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self.by_user[entry[2]["id"]]
+
+    def invalidate_user(self, user_id: str, share: bool = True):
+        if share:
+            backplane.publish({"k": "auth", "u": user_id})
+        with self._lock:
+            for token in list(self.by_user.get(user_id, ())):
+                self._drop(token)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "ttl_s": self.ttl,
+            }
+
+
+auth_cache = AuthCache()
 
 
 def get_token_from_request(request: Request) -> str:
@@ -402,18 +3651,167 @@ def get_token_from_request(request: Request) -> str:
 
 
 def require_user(request: Request):
+    """Usuário autenticado; usar como dependência: user: dict = Depends(require_user)."""
     token = get_token_from_request(request)
-    payload = decode_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Token invalido")
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT id, username, display_name, avatar_color, avatar_image, bio, status FROM users WHERE id = ?", (payload["sub"],))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        raise HTTPException(status_code=404, detail="Usuario nao encontrado")
-    return dict(row)
+    user = auth_cache.get(token)
+    if user is None:
+        payload = decode_token(token)
+        if not payload:
+            raise HTTPException(status_code=401, detail="Token invalido")
+        with db_conn(USERS_DB) as conn:
+            c = conn.cursor()
+            c.execute("SELECT id, username, display_name, avatar_color, avatar_image, bio, status FROM users WHERE id = ?", (payload["sub"],))
+            row = c.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Usuario nao encontrado")
+        user = dict(row)
+        auth_cache.put(token, payload, user)
+    # Cópia: o dict em cache é compartilhado entre requisições
+    return dict(user)
+
+
+# ========== CACHE DE PERMISSÕES ==========
+# Autorização de rooms (handshake do WebSocket, subscribe, históricos REST) sem banco no
+# caminho quente: tópico -> círculo, círculo -> {membro: papel} e DM -> participantes,
+# carregados sob demanda. Só o que existe é guardado (tópico/DM inexistente não vira
+# entrada), então criar tópico ou DM não deixa nada velho para trás. join_circle,
+# create_circle, create_topic, accept_friend e block_user invalidam o que tocam, em
+# todos os workers via backplane; o TTL cobre escritas feitas por fora da aplicação.
+ACCESS_CACHE_TTL_S = float(os.environ.get("LUMINA_ACCESS_CACHE_TTL_S", "300"))
+ACCESS_CACHE_MAX = int(os.environ.get("LUMINA_ACCESS_CACHE_MAX", "20000"))
+
+
+class AccessCache:
+    def __init__(self, ttl: float = ACCESS_CACHE_TTL_S, max_entries: int = ACCESS_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.topics = OrderedDict()   # topic_id -> (expira_em, circle_id)
+        self.circles = OrderedDict()  # circle_id -> (expira_em, {user_id: role})
+        self.dms = OrderedDict()      # chat_id -> (expira_em, (user1_id, user2_id))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Sobe a cada invalidação: um load que começou antes dela não grava o resultado velho
+        self._generation = 0
+
+    def _get(self, table, key):
+        entry = table.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        table.move_to_end(key)
+        return entry[1]
+
+    def _put(self, table, key, value, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            table[key] = (time.time() + self.ttl, value)
+            table.move_to_end(key)
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+
+    def peek_room(self, room_id: str, user_id: str):
+        """True/False só com o que está em memória; None se falta algo (use room_allowed via run_db)."""
+        kind, _, target = room_id.partition(":")
+        with self._lock:
+            if kind == "topic":
+                circle_id = self._get(self.topics, target)
+                members = self._get(self.circles, circle_id) if circle_id is not None else None
+                allowed = None if members is None else user_id in members
+            elif kind == "dm":
+                pair = self._get(self.dms, target)
+                allowed = None if pair is None else user_id in pair
+            else:
+                allowed = True
+            if allowed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return allowed
+
+    def topic_circle(self, topic_id: str):
+        """circle_id do tópico, ou None se o tópico não existe."""
+        with self._lock:
+            circle_id = self._get(self.topics, topic_id)
+            generation = self._generation
+        if circle_id is None:
+            with db_conn(CIRCLES_DB) as conn:
+                row = conn.execute("SELECT circle_id FROM topics WHERE id = ?", (topic_id,)).fetchone()
+            if row is None:
+                return None
+            circle_id = row[0]
+            self._put(self.topics, topic_id, circle_id, generation)
+        return circle_id
+
+    def circle_roles(self, circle_id: str) -> dict:
+        """{user_id: role} dos membros do círculo (vazio se o círculo não existe)."""
+        with self._lock:
+            members = self._get(self.circles, circle_id)
+            generation = self._generation
+        if members is None:
+            with db_conn(CIRCLES_DB) as conn:
+                members = dict(conn.execute("SELECT user_id, role FROM circle_members WHERE circle_id = ?", (circle_id,)).fetchall())
+            self._put(self.circles, circle_id, members, generation)
+        return members
+
+    def dm_participants(self, chat_id: str):
+        """(user1_id, user2_id) da DM, ou None se ela não existe."""
+        with self._lock:
+            pair = self._get(self.dms, chat_id)
+            generation = self._generation
+        if pair is None:
+            with db_conn(USERS_DB) as conn:
+                row = conn.execute("SELECT user1_id, user2_id FROM direct_chats WHERE id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return None
+            pair = (row[0], row[1])
+            self._put(self.dms, chat_id, pair, generation)
+        return pair
+
+    def room_allowed(self, room_id: str, user_id: str) -> bool:
+        allowed = self.peek_room(room_id, user_id)
+        if allowed is not None:
+            return allowed
+        kind, _, target = room_id.partition(":")
+        if kind == "topic":
+            circle_id = self.topic_circle(target)
+            return circle_id is not None and user_id in self.circle_roles(circle_id)
+        pair = self.dm_participants(target)
+        return pair is not None and user_id in pair
+
+    def invalidate(self, circle_id: str = None, topic_id: str = None, user_id: str = None, share: bool = True):
+        """Descarta um círculo, um tópico e/ou as DMs de um usuário."""
+        if share:
+            backplane.publish({"k": "access", "c": circle_id, "t": topic_id, "u": user_id})
+        with self._lock:
+            if circle_id is not None:
+                self.circles.pop(circle_id, None)
+            if topic_id is not None:
+                self.topics.pop(topic_id, None)
+            if user_id is not None:
+                for chat_id in [k for k, (_, pair) in self.dms.items() if user_id in pair]:
+                    del self.dms[chat_id]
+            self._generation += 1
+            self.invalidations += 1
+
+    def apply_remote(self, event):
+        self.invalidate(event.get("c"), event.get("t"), event.get("u"), share=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "topics": len(self.topics),
+                "circles": len(self.circles),
+                "dms": len(self.dms),
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "ttl_s": self.ttl,
+            }
+
+
+access_cache = AccessCache()
 
 
 @app.get("/", response_class=FileResponse)
@@ -422,175 +3820,190 @@ def home():
 
 
 @app.post("/api/status")
-def update_status(request: Request, status: str = Form(...)):
-    user = require_user(request)
-    valid_statuses = ['online', 'busy', 'away', 'invisible']
-    if status not in valid_statuses:
+def update_status(user: dict = Depends(require_user), status: str = Form(...)):
+    if status not in PRESENCE_STATUSES:
         raise HTTPException(status_code=400, detail="Status invalido")
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("UPDATE users SET status = ? WHERE id = ?", (status, user["id"]))
-    conn.commit()
-    conn.close()
+    # Gravado no próximo flush; amigos e membros recebem a mudança efetiva pelo PresenceService
+    presence.set_status(user["id"], status)
     return {"status": status}
 
 
 @app.post("/api/me/update")
-def update_profile(request: Request, display_name: str = Form(None), avatar_color: str = Form(None), bio: str = Form(None)):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    updates = []
-    params = []
-    if display_name is not None:
-        updates.append("display_name = ?")
-        params.append(display_name)
-    if avatar_color is not None:
-        updates.append("avatar_color = ?")
-        params.append(avatar_color)
-    if bio is not None:
-        updates.append("bio = ?")
-        params.append(bio)
-    if updates:
-        params.append(user["id"])
-        c.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", params)
-        conn.commit()
-    c.execute("SELECT id, username, display_name, avatar_color, avatar_image, bio, status FROM users WHERE id = ?", (user["id"],))
-    row = dict(c.fetchone())
-    conn.close()
+def update_profile(user: dict = Depends(require_user), display_name: str = Form(None), avatar_color: str = Form(None), bio: str = Form(None)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        updates = []
+        params = []
+        if display_name is not None:
+            updates.append("display_name = ?")
+            params.append(display_name)
+        if avatar_color is not None:
+            updates.append("avatar_color = ?")
+            params.append(avatar_color)
+        if bio is not None:
+            updates.append("bio = ?")
+            params.append(bio)
+        if updates:
+            params.append(user["id"])
+            c.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", params)
+            if display_name is not None:
+                c.execute("UPDATE user_search SET name_key = ? WHERE user_id = ?", (_search_key(display_name or user["username"]), user["id"]))
+            conn.commit()
+            auth_cache.invalidate_user(user["id"])
+            _notify_friends(user["id"], {"type": "friends_changed"})
+        c.execute("SELECT id, username, display_name, avatar_color, avatar_image, bio, status FROM users WHERE id = ?", (user["id"],))
+        row = dict(c.fetchone())
+    row["status"] = presence.status_of(user["id"], row["status"])
     return row
 
 
+def _set_avatar(user_id: str, avatar_url: str):
+    with db_conn(USERS_DB) as conn:
+        conn.execute("UPDATE users SET avatar_image = ? WHERE id = ?", (avatar_url, user_id))
+        conn.commit()
+
+
 @app.post("/api/me/avatar")
-async def upload_avatar(request: Request, file: UploadFile = File(...)):
-    user = require_user(request)
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in ['.png', '.jpg', '.jpeg', '.gif', '.webp']:
-        raise HTTPException(status_code=400, detail="Formato invalido. Use PNG, JPG, GIF ou WEBP")
-    fname = f"avatar_{user['id']}_{uuid.uuid4().hex[:8]}{ext}"
-    path = os.path.join(AVATAR_DIR, fname)
-    with open(path, "wb") as f:
-        f.write(await file.read())
+async def upload_avatar(request: Request, user: dict = Depends(require_user)):
+    upload = await receive_upload(request, "file", AVATAR_ALLOWED_EXTS, AVATAR_MAX_BYTES, "Arquivo muito grande. Limite: 5MB",
+                                  "Formato invalido. Use PNG, JPG, GIF ou WEBP")
+    fname = f"avatar_{user['id']}_{uuid.uuid4().hex[:8]}{upload.ext}"
+    await _upload_io(upload.commit, os.path.join(AVATAR_DIR, fname))
     avatar_url = f"/static/avatars/{fname}"
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("UPDATE users SET avatar_image = ? WHERE id = ?", (avatar_url, user["id"]))
-    conn.commit()
-    conn.close()
+    await run_db(_set_avatar, user["id"], avatar_url)
+    auth_cache.invalidate_user(user["id"])
+    history_cache.on_avatar(user["id"], avatar_url)
+    await run_db(_notify_friends, user["id"], {"type": "friends_changed"})
     return {"avatar_image": avatar_url}
 
 
 @app.get("/api/users/{user_id}/mutuals")
-def get_mutuals(user_id: str, request: Request):
-    me_user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    # Meus amigos
-    c.execute("""SELECT friend_id as fid FROM friendships WHERE user_id = ? AND status = 'accepted'
-        UNION
-        SELECT user_id as fid FROM friendships WHERE friend_id = ? AND status = 'accepted'""", (me_user["id"], me_user["id"]))
-    my_friend_ids = {r["fid"] for r in c.fetchall()}
-    # Amigos do target
-    c.execute("""SELECT friend_id as fid FROM friendships WHERE user_id = ? AND status = 'accepted'
-        UNION
-        SELECT user_id as fid FROM friendships WHERE friend_id = ? AND status = 'accepted'""", (user_id, user_id))
-    their_friend_ids = {r["fid"] for r in c.fetchall()}
-    mutual_ids = list(my_friend_ids & their_friend_ids)
-    mutual_friends = []
-    if mutual_ids:
-        placeholders = ','.join('?' * len(mutual_ids))
-        c.execute(f"SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE id IN ({placeholders})", mutual_ids)
-        mutual_friends = [dict(r) for r in c.fetchall()]
-    # Círculos mútuos
-    c.execute("""SELECT c.id, c.name, c.color, c.icon_url 
-        FROM circle_members m1 
-        JOIN circle_members m2 ON m1.circle_id = m2.circle_id
-        JOIN circles c ON c.id = m1.circle_id
-        WHERE m1.user_id = ? AND m2.user_id = ?""", (me_user["id"], user_id))
-    mutual_circles = [dict(r) for r in c.fetchall()]
-    # Nota e apelido
-    c.execute("SELECT note FROM friend_notes WHERE user_id = ? AND friend_id = ?", (me_user["id"], user_id))
-    note_row = c.fetchone()
-    note = note_row["note"] if note_row else ""
-    c.execute("SELECT nickname FROM friend_nicknames WHERE user_id = ? AND friend_id = ?", (me_user["id"], user_id))
-    nick_row = c.fetchone()
-    nickname = nick_row["nickname"] if nick_row else ""
-    conn.close()
+def get_mutuals(user_id: str, me_user: dict = Depends(require_user)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        # Meus amigos
+        c.execute("""SELECT friend_id as fid FROM friendships WHERE user_id = ? AND status = 'accepted'
+            UNION
+            SELECT user_id as fid FROM friendships WHERE friend_id = ? AND status = 'accepted'""", (me_user["id"], me_user["id"]))
+        my_friend_ids = {r["fid"] for r in c.fetchall()}
+        # Amigos do target
+        c.execute("""SELECT friend_id as fid FROM friendships WHERE user_id = ? AND status = 'accepted'
+            UNION
+            SELECT user_id as fid FROM friendships WHERE friend_id = ? AND status = 'accepted'""", (user_id, user_id))
+        their_friend_ids = {r["fid"] for r in c.fetchall()}
+        mutual_ids = list(my_friend_ids & their_friend_ids)
+        mutual_friends = []
+        if mutual_ids:
+            placeholders = ','.join('?' * len(mutual_ids))
+            c.execute(f"SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE id IN ({placeholders})", mutual_ids)
+            mutual_friends = [dict(r) for r in c.fetchall()]
+        # Círculos mútuos
+        c.execute("""SELECT c.id, c.name, c.color, c.icon_url 
+            FROM circles_db.circle_members m1
+            JOIN circles_db.circle_members m2 ON m1.circle_id = m2.circle_id
+            JOIN circles_db.circles c ON c.id = m1.circle_id
+            WHERE m1.user_id = ? AND m2.user_id = ?""", (me_user["id"], user_id))
+        mutual_circles = [dict(r) for r in c.fetchall()]
+        # Nota e apelido
+        c.execute("SELECT note FROM friend_notes WHERE user_id = ? AND friend_id = ?", (me_user["id"], user_id))
+        note_row = c.fetchone()
+        note = note_row["note"] if note_row else ""
+        c.execute("SELECT nickname FROM friend_nicknames WHERE user_id = ? AND friend_id = ?", (me_user["id"], user_id))
+        nick_row = c.fetchone()
+        nickname = nick_row["nickname"] if nick_row else ""
     return {"friends": mutual_friends, "circles": mutual_circles, "note": note, "nickname": nickname}
 
 
 @app.post("/api/friends/{friend_id}/note")
-def set_friend_note(friend_id: str, request: Request, note: str = Form("")):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    try:
-        c.execute("""INSERT INTO friend_notes (id, user_id, friend_id, note) VALUES (?, ?, ?, ?)""",
-            (str(uuid.uuid4())[:8], user["id"], friend_id, note))
-    except sqlite3.IntegrityError:
-        c.execute("UPDATE friend_notes SET note = ? WHERE user_id = ? AND friend_id = ?", (note, user["id"], friend_id))
-    conn.commit()
-    conn.close()
+def set_friend_note(friend_id: str, user: dict = Depends(require_user), note: str = Form("")):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        try:
+            c.execute("""INSERT INTO friend_notes (id, user_id, friend_id, note) VALUES (?, ?, ?, ?)""",
+                (str(uuid.uuid4())[:8], user["id"], friend_id, note))
+        except sqlite3.IntegrityError:
+            c.execute("UPDATE friend_notes SET note = ? WHERE user_id = ? AND friend_id = ?", (note, user["id"], friend_id))
+        conn.commit()
     return {"ok": True}
 
 
 @app.post("/api/friends/{friend_id}/nickname")
-def set_friend_nickname(friend_id: str, request: Request, nickname: str = Form("")):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    try:
-        c.execute("""INSERT INTO friend_nicknames (id, user_id, friend_id, nickname) VALUES (?, ?, ?, ?)""",
-            (str(uuid.uuid4())[:8], user["id"], friend_id, nickname))
-    except sqlite3.IntegrityError:
-        c.execute("UPDATE friend_nicknames SET nickname = ? WHERE user_id = ? AND friend_id = ?", (nickname, user["id"], friend_id))
-    conn.commit()
-    conn.close()
+def set_friend_nickname(friend_id: str, user: dict = Depends(require_user), nickname: str = Form("")):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        try:
+            c.execute("""INSERT INTO friend_nicknames (id, user_id, friend_id, nickname) VALUES (?, ?, ?, ?)""",
+                (str(uuid.uuid4())[:8], user["id"], friend_id, nickname))
+        except sqlite3.IntegrityError:
+            c.execute("UPDATE friend_nicknames SET nickname = ? WHERE user_id = ? AND friend_id = ?", (nickname, user["id"], friend_id))
+        conn.commit()
     return {"ok": True}
 
 
 @app.post("/api/users/{user_id}/block")
-def block_user(user_id: str, request: Request):
-    user = require_user(request)
+def block_user(user_id: str, user: dict = Depends(require_user)):
     if user_id == user["id"]:
         raise HTTPException(status_code=400, detail="Nao pode bloquear voce mesmo")
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM friendships WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
-        (user["id"], user_id, user_id, user["id"]))
-    try:
-        c.execute("INSERT INTO blocks (id, user_id, blocked_id) VALUES (?, ?, ?)",
-            (str(uuid.uuid4())[:8], user["id"], user_id))
-    except sqlite3.IntegrityError:
-        pass
-    conn.commit()
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM friendships WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
+            (user["id"], user_id, user_id, user["id"]))
+        try:
+            c.execute("INSERT INTO blocks (id, user_id, blocked_id) VALUES (?, ?, ?)",
+                (str(uuid.uuid4())[:8], user["id"], user_id))
+        except sqlite3.IntegrityError:
+            pass
+        conn.commit()
+    access_cache.invalidate(user_id=user["id"])
+    notif_manager.notify(user_id, {"type": "friends_changed"})
     return {"ok": True}
 
 
 @app.post("/api/users/{user_id}/unblock")
-def unblock_user(user_id: str, request: Request):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM blocks WHERE user_id = ? AND blocked_id = ?", (user["id"], user_id))
-    conn.commit()
-    conn.close()
+def unblock_user(user_id: str, user: dict = Depends(require_user)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM blocks WHERE user_id = ? AND blocked_id = ?", (user["id"], user_id))
+        conn.commit()
     return {"ok": True}
 
 
 @app.get("/api/blocks")
-def list_blocks(request: Request):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("""SELECT b.blocked_id as id, u.username, u.display_name, u.avatar_color, u.avatar_image 
-        FROM blocks b JOIN users u ON u.id = b.blocked_id WHERE b.user_id = ?""", (user["id"],))
-    rows = [dict(r) for r in c.fetchall()]
-    conn.close()
+def list_blocks(user: dict = Depends(require_user)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("""SELECT b.blocked_id as id, u.username, u.display_name, u.avatar_color, u.avatar_image 
+            FROM blocks b JOIN users u ON u.id = b.blocked_id WHERE b.user_id = ?""", (user["id"],))
+        rows = [dict(r) for r in c.fetchall()]
     return rows
 
 
+@app.get("/api/metrics")
+def get_metrics(user: dict = Depends(require_user)):
+    return {
+        "db_pools": db_pool_stats(),
+        "db_executor": db_executor_stats(),
+        "event_loop": loop_monitor.stats(),
+        "message_writer": message_writer.stats(),
+        "history_cache": history_cache.stats(),
+        "fanout": manager.fanout_stats(),
+        "auth_cache": auth_cache.stats(),
+        "notifications": notif_manager.stats(),
+        "typing": typing_tracker.stats(),
+        "presence": presence.stats(),
+        "ws_codec": codec.stats(),
+        "unread": unread_store.stats(),
+        "search": search_backfill.stats(),
+        "user_search_close": close_users.stats(),
+        "access_cache": access_cache.stats(),
+        "uploads": upload_stats(),
+        "upload_store": {**(upload_sweeper.report or {}), **upload_sweeper.stats()},
+        "backplane": backplane.stats(),
+        "schema_versions": schema_versions(),
+        "query_plans": {name: r["ok"] for name, r in QUERY_PLANS.items()},
+    }
+
+
 @app.get("/api/version")
 def get_version():
     return {
@@ -627,27 +4040,25 @@ def register(username: str = Form(...), password: str = Form(...), display_name:
     alpaca_img = random.choice(ALPACA_POOL)
 
     uid = str(uuid.uuid4())[:8]
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO users (id, username, display_name, password_hash, avatar_color, avatar_image) VALUES (?, ?, ?, ?, ?, ?)",
-            (uid, username.lower(), display_name or username, get_password_hash(password), color, alpaca_img))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Username ja existe")
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        try:
+            c.execute("INSERT INTO users (id, username, display_name, password_hash, avatar_color, avatar_image) VALUES (?, ?, ?, ?, ?, ?)",
+                (uid, username.lower(), display_name or username, get_password_hash(password), color, alpaca_img))
+            _index_user_search(conn, uid, username.lower(), display_name or username)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=400, detail="Username ja existe")
     token = create_access_token({"sub": uid, "username": username.lower()})
     return {"token": token, "user": {"id": uid, "username": username, "display_name": display_name or username, "color": color, "avatar_image": alpaca_img}}
 
 
 @app.post("/api/login")
 def login(username: str = Form(...), password: str = Form(...)):
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username.lower(),))
-    row = c.fetchone()
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE username = ?", (username.lower(),))
+        row = c.fetchone()
     if not row or not verify_password(password, row["password_hash"]):
         raise HTTPException(status_code=401, detail="Usuario ou senha invalidos")
     user = dict(row)
@@ -656,65 +4067,87 @@ def login(username: str = Form(...), password: str = Form(...)):
 
 
 @app.get("/api/me")
-def me(request: Request):
-    return require_user(request)
+def me(user: dict = Depends(require_user)):
+    return {**user, "status": presence.status_of(user["id"], user.get("status"))}
 
 
 @app.get("/api/users/search")
-def search_users(request: Request, q: str = ""):
-    require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE username LIKE ? OR display_name LIKE ? LIMIT 20",
-        (f"%{q}%", f"%{q}%"))
-    rows = [dict(r) for r in c.fetchall()]
-    conn.close()
-    return rows
+def search_users(user: dict = Depends(require_user), q: str = ""):
+    return _search_users(user["id"], q)
 
 
-@app.get("/api/friends")
-def list_friends(request: Request):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT f.id, f.friend_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? AND f.status = 'accepted'", (user["id"],))
-    sent = [dict(r) for r in c.fetchall()]
-    c.execute("SELECT f.id, f.user_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.user_id WHERE f.friend_id = ? AND f.status = 'accepted'", (user["id"],))
-    received = [dict(r) for r in c.fetchall()]
-    c.execute("SELECT f.id, f.friend_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? AND f.status = 'pending'", (user["id"],))
-    pending_sent = [dict(r) for r in c.fetchall()]
-    c.execute("SELECT f.id, f.user_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.user_id WHERE f.friend_id = ? AND f.status = 'pending'", (user["id"],))
-    pending_received = [dict(r) for r in c.fetchall()]
-    conn.close()
+def _friends_of(user_id: str):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT f.id, f.friend_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? AND f.status = 'accepted'", (user_id,))
+        sent = [dict(r) for r in c.fetchall()]
+        c.execute("SELECT f.id, f.user_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.user_id WHERE f.friend_id = ? AND f.status = 'accepted'", (user_id,))
+        received = [dict(r) for r in c.fetchall()]
+        c.execute("SELECT f.id, f.friend_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.friend_id WHERE f.user_id = ? AND f.status = 'pending'", (user_id,))
+        pending_sent = [dict(r) for r in c.fetchall()]
+        c.execute("SELECT f.id, f.user_id as fid, f.status, u.display_name, u.username, u.avatar_color, u.avatar_image, u.status as user_status FROM friendships f JOIN users u ON u.id = f.user_id WHERE f.friend_id = ? AND f.status = 'pending'", (user_id,))
+        pending_received = [dict(r) for r in c.fetchall()]
+    for row in sent + received + pending_sent + pending_received:
+        row["user_status"] = presence.effective(row["fid"], row["user_status"])
     return {"friends": sent + received, "pending_sent": pending_sent, "pending_received": pending_received}
 
 
+def _friend_ids(user_id: str):
+    with db_conn(USERS_DB) as conn:
+        rows = conn.execute("""SELECT friend_id FROM friendships WHERE user_id = ? AND status = 'accepted'
+            UNION SELECT user_id FROM friendships WHERE friend_id = ? AND status = 'accepted'""", (user_id, user_id)).fetchall()
+    return [r[0] for r in rows]
+
+
+def _notify_friends(user_id: str, msg: dict):
+    for fid in _friend_ids(user_id):
+        notif_manager.notify(fid, msg)
+
+
+@app.get("/api/friends")
+def list_friends(user: dict = Depends(require_user)):
+    return _friends_of(user["id"])
+
+
+def _create_friend_request(user_id: str, username: str) -> str:
+    """Cria a solicitação pendente. Retorna o id do destinatário."""
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE username = ?", (username.lower(),))
+        target = c.fetchone()
+        if not target:
+            raise HTTPException(status_code=404, detail="Usuario nao encontrado")
+        tid = target["id"]
+        if tid == user_id:
+            raise HTTPException(status_code=400, detail="Nao pode adicionar voce mesmo")
+        c.execute("SELECT * FROM friendships WHERE user_id = ? AND friend_id = ?", (user_id, tid))
+        if c.fetchone():
+            raise HTTPException(status_code=400, detail="Solicitacao ja existe")
+        c.execute("SELECT * FROM friendships WHERE user_id = ? AND friend_id = ?", (tid, user_id))
+        if c.fetchone():
+            raise HTTPException(status_code=400, detail="Solicitacao ja existe")
+        fid = str(uuid.uuid4())[:8]
+        c.execute("INSERT INTO friendships (id, user_id, friend_id, status) VALUES (?, ?, ?, 'pending')", (fid, user_id, tid))
+        conn.commit()
+    return tid
+
+
+def _accept_friend_request(user_id: str, friend_id: str):
+    """Aceita a solicitação de friend_id e cria o DM entre os dois."""
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("UPDATE friendships SET status = 'accepted' WHERE user_id = ? AND friend_id = ? AND status = 'pending'", (friend_id, user_id))
+        if c.rowcount == 0:
+            raise HTTPException(status_code=400, detail="Solicitacao nao encontrada")
+        dm_id = str(uuid.uuid4())[:8]
+        u1, u2 = sorted([user_id, friend_id])
+        c.execute("INSERT OR IGNORE INTO direct_chats (id, user1_id, user2_id) VALUES (?, ?, ?)", (dm_id, u1, u2))
+        conn.commit()
+
+
 @app.post("/api/friends/request")
-async def add_friend(request: Request, username: str = Form(...)):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE username = ?", (username.lower(),))
-    target = c.fetchone()
-    if not target:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Usuario nao encontrado")
-    tid = target["id"]
-    if tid == user["id"]:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Nao pode adicionar voce mesmo")
-    c.execute("SELECT * FROM friendships WHERE user_id = ? AND friend_id = ?", (user["id"], tid))
-    if c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Solicitacao ja existe")
-    c.execute("SELECT * FROM friendships WHERE user_id = ? AND friend_id = ?", (tid, user["id"]))
-    if c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Solicitacao ja existe")
-    fid = str(uuid.uuid4())[:8]
-    c.execute("INSERT INTO friendships (id, user_id, friend_id, status) VALUES (?, ?, ?, 'pending')", (fid, user["id"], tid))
-    conn.commit()
-    conn.close()
+async def add_friend(user: dict = Depends(require_user), username: str = Form(...)):
+    tid = await run_db(_create_friend_request, user["id"], username)
     await notif_manager.send(tid, {
         "type": "friend_request",
         "from": {"id": user["id"], "username": user["username"], "display_name": user.get("display_name") or user["username"], "avatar_color": user.get("avatar_color", "#ff7b72"), "avatar_image": user.get("avatar_image", "/static/cosmic_aero/alpacas/alpaca_gray.png")}
@@ -723,19 +4156,11 @@ async def add_friend(request: Request, username: str = Form(...)):
 
 
 @app.post("/api/friends/accept")
-async def accept_friend(request: Request, friend_id: str = Form(...)):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("UPDATE friendships SET status = 'accepted' WHERE user_id = ? AND friend_id = ? AND status = 'pending'", (friend_id, user["id"]))
-    if c.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Solicitacao nao encontrada")
-    dm_id = str(uuid.uuid4())[:8]
-    u1, u2 = sorted([user["id"], friend_id])
-    c.execute("INSERT OR IGNORE INTO direct_chats (id, user1_id, user2_id) VALUES (?, ?, ?)", (dm_id, u1, u2))
-    conn.commit()
-    conn.close()
+async def accept_friend(user: dict = Depends(require_user), friend_id: str = Form(...)):
+    await run_db(_accept_friend_request, user["id"], friend_id)
+    access_cache.invalidate(user_id=user["id"])
+    unread_store.forget(user["id"])
+    unread_store.forget(friend_id)
     await notif_manager.send(friend_id, {
         "type": "friend_accepted",
         "by": {"id": user["id"], "username": user["username"], "display_name": user.get("display_name") or user["username"], "avatar_color": user.get("avatar_color", "#ff7b72"), "avatar_image": user.get("avatar_image", "/static/cosmic_aero/alpacas/alpaca_gray.png")}
@@ -744,369 +4169,549 @@ async def accept_friend(request: Request, friend_id: str = Form(...)):
 
 
 @app.post("/api/friends/reject")
-def reject_friend(request: Request, friend_id: str = Form(...)):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM friendships WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
-        (user["id"], friend_id, friend_id, user["id"]))
-    conn.commit()
-    conn.close()
+def reject_friend(user: dict = Depends(require_user), friend_id: str = Form(...)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM friendships WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
+            (user["id"], friend_id, friend_id, user["id"]))
+        conn.commit()
+    notif_manager.notify(friend_id, {"type": "friends_changed"})
     return {"ok": True}
 
 
 @app.get("/api/circles")
-def list_circles(request: Request):
-    user = require_user(request)
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT c.* FROM circles c JOIN circle_members m ON m.circle_id = c.id WHERE m.user_id = ? ORDER BY c.created_at DESC", (user["id"],))
-    circles = [dict(r) for r in c.fetchall()]
-    conn.close()
+def list_circles(user: dict = Depends(require_user)):
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT c.* FROM circles c JOIN circle_members m ON m.circle_id = c.id WHERE m.user_id = ? ORDER BY c.created_at DESC", (user["id"],))
+        circles = [dict(r) for r in c.fetchall()]
     return circles
 
 
 @app.post("/api/circles")
-def create_circle(request: Request, name: str = Form(...), color: str = Form("#a78bfa")):
-    user = require_user(request)
+def create_circle(user: dict = Depends(require_user), name: str = Form(...), color: str = Form("#a78bfa")):
     cid = str(uuid.uuid4())[:8]
     invite = str(uuid.uuid4())[:12]
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("INSERT INTO circles (id, name, owner_id, color, invite_code) VALUES (?, ?, ?, ?, ?)", (cid, name, user["id"], color, invite))
-    mid = str(uuid.uuid4())[:8]
-    c.execute("INSERT INTO circle_members (id, circle_id, user_id, role) VALUES (?, ?, ?, 'owner')", (mid, cid, user["id"]))
-    tid = str(uuid.uuid4())[:8]
-    c.execute("INSERT INTO topics (id, circle_id, name, type, position) VALUES (?, ?, ?, 'text', 0)", (tid, cid, "geral"))
-    conn.commit()
-    conn.close()
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO circles (id, name, owner_id, color, invite_code) VALUES (?, ?, ?, ?, ?)", (cid, name, user["id"], color, invite))
+        mid = str(uuid.uuid4())[:8]
+        c.execute("INSERT INTO circle_members (id, circle_id, user_id, role) VALUES (?, ?, ?, 'owner')", (mid, cid, user["id"]))
+        tid = str(uuid.uuid4())[:8]
+        c.execute("INSERT INTO topics (id, circle_id, name, type, position) VALUES (?, ?, ?, 'text', 0)", (tid, cid, "geral"))
+        conn.commit()
+    access_cache.invalidate(circle_id=cid, topic_id=tid)
+    unread_store.forget(user["id"])
     return {"id": cid, "name": name, "color": color, "invite_code": invite}
 
 
 @app.post("/api/circles/join")
-def join_circle(request: Request, code: str = Form(...)):
-    user = require_user(request)
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT * FROM circles WHERE invite_code = ?", (code,))
-    circle = c.fetchone()
-    if not circle:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Codigo invalido")
-    c.execute("SELECT * FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle["id"], user["id"]))
-    if c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Ja esta no circulo")
-    mid = str(uuid.uuid4())[:8]
-    c.execute("INSERT INTO circle_members (id, circle_id, user_id, role) VALUES (?, ?, ?, 'member')", (mid, circle["id"], user["id"]))
-    conn.commit()
-    conn.close()
+def join_circle(user: dict = Depends(require_user), code: str = Form(...)):
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM circles WHERE invite_code = ?", (code,))
+        circle = c.fetchone()
+        if not circle:
+            raise HTTPException(status_code=404, detail="Codigo invalido")
+        c.execute("SELECT * FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle["id"], user["id"]))
+        if c.fetchone():
+            raise HTTPException(status_code=400, detail="Ja esta no circulo")
+        mid = str(uuid.uuid4())[:8]
+        c.execute("INSERT INTO circle_members (id, circle_id, user_id, role) VALUES (?, ?, ?, 'member')", (mid, circle["id"], user["id"]))
+        conn.commit()
+    access_cache.invalidate(circle_id=circle["id"])
+    unread_store.forget(user["id"])
     return {"id": circle["id"], "name": circle["name"]}
 
 
 @app.get("/api/circles/by-invite/{code}")
 def get_circle_by_invite(code: str):
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT id, name, color, icon_url, invite_code FROM circles WHERE invite_code = ?", (code,))
-    circle = c.fetchone()
-    conn.close()
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, name, color, icon_url, invite_code FROM circles WHERE invite_code = ?", (code,))
+        circle = c.fetchone()
     if not circle:
         raise HTTPException(status_code=404, detail="Codigo invalido")
     return dict(circle)
 
 
 @app.get("/api/circles/{circle_id}")
-def get_circle(circle_id: str, request: Request):
-    user = require_user(request)
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT * FROM circles WHERE id = ?", (circle_id,))
-    circle = c.fetchone()
-    if not circle:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Circulo nao encontrado")
-    c.execute("SELECT * FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle_id, user["id"]))
-    if not c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=403, detail="Nao e membro")
-    c.execute("SELECT user_id, role FROM circle_members WHERE circle_id = ?", (circle_id,))
-    member_rows = c.fetchall()
-    c.execute("SELECT * FROM topics WHERE circle_id = ? ORDER BY position", (circle_id,))
-    topics = [dict(r) for r in c.fetchall()]
-    conn.close()
-    user_ids = [m["user_id"] for m in member_rows]
-    members = []
-    if user_ids:
-        conn2 = get_db(USERS_DB)
-        c2 = conn2.cursor()
-        placeholders = ','.join('?' * len(user_ids))
-        c2.execute(f"SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE id IN ({placeholders})", user_ids)
-        user_map = {u["id"]: dict(u) for u in c2.fetchall()}
-        conn2.close()
-        for m in member_rows:
-            u = user_map.get(m["user_id"], {})
-            members.append({
-                "id": m["user_id"],
-                "username": u.get("username", ""),
-                "display_name": u.get("display_name", ""),
-                "avatar_color": u.get("avatar_color", "#888"),
-                "avatar_image": u.get("avatar_image", "/static/cosmic_aero/alpacas/alpaca_gray.png"),
-                "role": m["role"]
-            })
+def get_circle(circle_id: str, user: dict = Depends(require_user)):
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM circles WHERE id = ?", (circle_id,))
+        circle = c.fetchone()
+        if not circle:
+            raise HTTPException(status_code=404, detail="Circulo nao encontrado")
+        c.execute("SELECT * FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle_id, user["id"]))
+        if not c.fetchone():
+            raise HTTPException(status_code=403, detail="Nao e membro")
+        c.execute("""SELECT m.user_id AS id, COALESCE(u.username, '') AS username,
+            CASE WHEN u.id IS NULL THEN '' ELSE u.display_name END AS display_name,
+            CASE WHEN u.id IS NULL THEN '#888' ELSE u.avatar_color END AS avatar_color,
+            CASE WHEN u.id IS NULL THEN '/static/cosmic_aero/alpacas/alpaca_gray.png' ELSE u.avatar_image END AS avatar_image,
+            m.role
+            FROM circle_members m LEFT JOIN users_db.users u ON u.id = m.user_id
+            WHERE m.circle_id = ?""", (circle_id,))
+        members = [dict(r) for r in c.fetchall()]
+        c.execute("SELECT * FROM topics WHERE circle_id = ? ORDER BY position", (circle_id,))
+        topics = [dict(r) for r in c.fetchall()]
+    for member in members:
+        member["status"] = presence.effective(member["id"])
     return {"circle": dict(circle), "members": members, "topics": topics}
 
 
 @app.post("/api/circles/{circle_id}/topics")
-def create_topic(circle_id: str, request: Request, name: str = Form(...), type: str = Form("text")):
-    user = require_user(request)
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT role FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle_id, user["id"]))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=403, detail="Acesso negado: voce nao e membro deste circulo")
-    if row["role"] not in ("owner", "mod"):
-        conn.close()
-        raise HTTPException(status_code=403, detail="Sem permissao")
-    tid = str(uuid.uuid4())[:8]
-    c.execute("SELECT MAX(position) as mp FROM topics WHERE circle_id = ?", (circle_id,))
-    pos = (c.fetchone()["mp"] or 0) + 1
-    c.execute("INSERT INTO topics (id, circle_id, name, type, position) VALUES (?, ?, ?, ?, ?)", (tid, circle_id, name, type, pos))
-    conn.commit()
-    conn.close()
+def create_topic(circle_id: str, user: dict = Depends(require_user), name: str = Form(...), type: str = Form("text")):
+    with db_conn(CIRCLES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT role FROM circle_members WHERE circle_id = ? AND user_id = ?", (circle_id, user["id"]))
+        row = c.fetchone()
+        if not row:
+            raise HTTPException(status_code=403, detail="Acesso negado: voce nao e membro deste circulo")
+        if row["role"] not in ("owner", "mod"):
+            raise HTTPException(status_code=403, detail="Sem permissao")
+        tid = str(uuid.uuid4())[:8]
+        c.execute("SELECT MAX(position) as mp FROM topics WHERE circle_id = ?", (circle_id,))
+        pos = (c.fetchone()["mp"] or 0) + 1
+        c.execute("INSERT INTO topics (id, circle_id, name, type, position) VALUES (?, ?, ?, ?, ?)", (tid, circle_id, name, type, pos))
+        conn.commit()
+    access_cache.invalidate(topic_id=tid)
+    # Todos os membros do círculo ganharam um room
+    unread_store.forget()
     return {"id": tid, "name": name, "type": type}
 
 
 @app.get("/api/dm-chats")
-def list_dm_chats(request: Request):
-    user = require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("""SELECT d.id, d.user1_id, d.user2_id,
-        CASE WHEN d.user1_id = ? THEN d.user2_id ELSE d.user1_id END as peer_id,
-        u.display_name, u.username, u.avatar_color, u.avatar_image
-        FROM direct_chats d
-        JOIN users u ON u.id = CASE WHEN d.user1_id = ? THEN d.user2_id ELSE d.user1_id END
-        WHERE d.user1_id = ? OR d.user2_id = ?""", (user["id"], user["id"], user["id"], user["id"]))
-    chats = [dict(r) for r in c.fetchall()]
-    conn.close()
-    conn2 = get_db(MESSAGES_DB)
-    c2 = conn2.cursor()
-    for ch in chats:
-        c2.execute("SELECT count FROM unread WHERE user_id = ? AND room_id = ?", (user["id"], "dm:" + ch["id"]))
-        row = c2.fetchone()
-        ch["unread"] = row["count"] if row else 0
-    conn2.close()
+def list_dm_chats(user: dict = Depends(require_user)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        # Última mensagem de cada DM: um seek em (room_id, id DESC) no messages_db por conversa,
+        # então a latência não cresce com o tamanho do histórico
+        c.execute("""SELECT d.id, d.user1_id, d.user2_id,
+            CASE WHEN d.user1_id = ? THEN d.user2_id ELSE d.user1_id END as peer_id,
+            u.display_name, u.username, u.avatar_color, u.avatar_image,
+            lm.id AS lm_id, lm.user_id AS lm_user_id, lm.user_name AS lm_user_name, lm.msg_type AS lm_msg_type,
+            lm.timestamp AS lm_timestamp,
+            CASE WHEN length(lm.content) > ? THEN substr(lm.content, 1, ?) || '…' ELSE COALESCE(lm.content, '') END AS lm_content
+            FROM direct_chats d
+            JOIN users u ON u.id = CASE WHEN d.user1_id = ? THEN d.user2_id ELSE d.user1_id END
+            LEFT JOIN messages_db.messages lm ON lm.id = (
+                SELECT id FROM messages_db.messages WHERE room_id = 'dm:' || d.id ORDER BY id DESC LIMIT 1)
+            WHERE d.user1_id = ? OR d.user2_id = ?
+            ORDER BY lm.id IS NULL, lm.id DESC""",
+            (user["id"], LAST_MESSAGE_PREVIEW_CHARS, LAST_MESSAGE_PREVIEW_CHARS, user["id"], user["id"], user["id"]))
+        rows = c.fetchall()
+    unread = unread_store.get_all(user["id"])
+    # Mesma ordem das colunas do SELECT; zip sai bem mais barato que dict(sqlite3.Row) por linha
+    chat_keys = ("id", "user1_id", "user2_id", "peer_id", "display_name", "username", "avatar_color", "avatar_image")
+    last_keys = ("id", "user_id", "user_name", "msg_type", "timestamp", "content")
+    chats = []
+    # Conversas mais recentes primeiro; as sem mensagens ficam no fim
+    for r in rows:
+        ch = dict(zip(chat_keys, r))
+        ch["unread"] = unread.get("dm:" + ch["id"], 0)
+        ch["last_message"] = dict(zip(last_keys, r[len(chat_keys):])) if r["lm_id"] is not None else None
+        chats.append(ch)
     return chats
 
 
 @app.get("/api/dm-chats/{chat_id}/history")
-def dm_history(chat_id: str, request: Request, limit: int = 50):
-    user = require_user(request)
+def dm_history(chat_id: str, user: dict = Depends(require_user), limit: int = 50, before_id: Optional[int] = None,
+               after_id: Optional[int] = None, around_id: Optional[int] = None):
     _require_dm_participant(chat_id, user["id"])
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM unread WHERE user_id = ? AND room_id = ?", (user["id"], "dm:" + chat_id))
-    conn.commit()
-    conn.close()
-    return _get_history(f"dm:{chat_id}", limit)
+    count = unread_store.mark_read(user["id"], "dm:" + chat_id)
+    if count is not None:
+        # Atualiza o contador também nas outras abas/dispositivos do usuário
+        notif_manager.notify(user["id"], {"type": "unread", "room_id": "dm:" + chat_id, "count": count})
+    return _history_page(f"dm:{chat_id}", limit, before_id, after_id, around_id)
 
 
 @app.get("/api/topics/{topic_id}/history")
-def topic_history(topic_id: str, request: Request, limit: int = 50):
-    user = require_user(request)
+def topic_history(topic_id: str, user: dict = Depends(require_user), limit: int = 50, before_id: Optional[int] = None,
+                  after_id: Optional[int] = None, around_id: Optional[int] = None):
     # Verificar se o usuário é membro do círculo ao qual o tópico pertence
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT circle_id FROM topics WHERE id = ?", (topic_id,))
-    topic_row = c.fetchone()
-    conn.close()
-    if not topic_row:
-        raise HTTPException(status_code=404, detail="Topico nao encontrado")
-    _require_circle_member(topic_row["circle_id"], user["id"])
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM unread WHERE user_id = ? AND room_id = ?", (user["id"], "topic:" + topic_id))
-    conn.commit()
-    conn.close()
-    return _get_history(f"topic:{topic_id}", limit)
+    _require_topic_member(topic_id, user["id"])
+    count = unread_store.mark_read(user["id"], "topic:" + topic_id)
+    if count is not None:
+        # Atualiza o contador também nas outras abas/dispositivos do usuário
+        notif_manager.notify(user["id"], {"type": "unread", "room_id": "topic:" + topic_id, "count": count})
+    return _history_page(f"topic:{topic_id}", limit, before_id, after_id, around_id)
 
 
 @app.get("/api/unread")
-def get_unread(request: Request):
-    user = require_user(request)
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("SELECT room_id, count FROM unread WHERE user_id = ?", (user["id"],))
-    rows = {r["room_id"]: r["count"] for r in c.fetchall()}
-    conn.close()
-    return rows
+def get_unread(user: dict = Depends(require_user)):
+    return unread_store.get_all(user["id"])
+
+
+@app.get("/api/notifications/since")
+async def notifications_since(v: str = "", user: dict = Depends(require_user)):
+    """O que mudou para o usuário desde a versão v (do frame "hello" ou do último evento)."""
+    events = notif_manager.changes_since(user["id"], v)
+    version = notif_manager.version()
+    if events is not None:
+        return {"reset": False, "v": version, "events": events}
+    # Versão lida antes do snapshot: um evento concorrente é reenviado, nunca perdido
+    friends = await run_db(_friends_of, user["id"])
+    unread = await run_db(unread_store.get_all, user["id"])
+    return {"reset": True, "v": version, "friends": friends, "unread": unread}
 
 
 @app.post("/api/messages/{msg_id}/react")
-def react_to_message(msg_id: int, request: Request, emoji: str = Form(...)):
-    user = require_user(request)
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO reactions (message_id, user_id, emoji) VALUES (?, ?, ?)", (msg_id, user["id"], emoji))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        c.execute("DELETE FROM reactions WHERE message_id = ? AND user_id = ? AND emoji = ?", (msg_id, user["id"], emoji))
-        conn.commit()
+def react_to_message(msg_id: int, user: dict = Depends(require_user), emoji: str = Form(...)):
     # Retornar reações atualizadas
-    c.execute("SELECT user_id, emoji FROM reactions WHERE message_id = ?", (msg_id,))
-    reactions = {}
-    for r in c.fetchall():
-        emoji = r["emoji"]
-        if emoji not in reactions:
-            reactions[emoji] = {"count": 0, "users": []}
-        reactions[emoji]["count"] += 1
-        reactions[emoji]["users"].append(r["user_id"])
-    conn.close()
-    return {"reactions": reactions}
+    return {"reactions": _toggle_reaction(msg_id, user["id"], emoji)}
+
+
+@app.get("/api/search")
+def search(q: str = "", user: dict = Depends(require_user), room_id: Optional[str] = None, order: str = "rank",
+           cursor: Optional[str] = None, limit: int = 20):
+    """Busca de mensagens nos rooms do usuário. snippet vem escapado, com os termos em <mark>."""
+    return _search_messages(user["id"], q, room_id, order, cursor, limit)
 
 
 @app.patch("/api/messages/{msg_id}")
-def edit_message(msg_id: int, request: Request, content: str = Form(...)):
-    user = require_user(request)
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM messages WHERE id = ?", (msg_id,))
-    row = c.fetchone()
-    if not row or row["user_id"] != user["id"]:
-        conn.close()
+def edit_message(msg_id: int, user: dict = Depends(require_user), content: str = Form(...)):
+    if not _edit_own_message(msg_id, user["id"], content):
         raise HTTPException(status_code=403, detail="Sem permissao")
-    c.execute("UPDATE messages SET content = ?, edited_at = CURRENT_TIMESTAMP WHERE id = ?", (content, msg_id))
-    conn.commit()
-    c.execute("SELECT id, room_id, user_id, user_name, user_color, content, msg_type, file_url, reply_to_id, reply_to_user, reply_to_content, edited_at, timestamp FROM messages WHERE id = ?", (msg_id,))
-    msg = dict(c.fetchone())
-    msg["user"] = {"name": msg.pop("user_name"), "color": msg.pop("user_color")}
-    conn.close()
+    with db_conn(MESSAGES_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, room_id, user_id, user_name, user_color, content, msg_type, file_url, reply_to_id, reply_to_user, reply_to_content, edited_at, timestamp FROM messages WHERE id = ?", (msg_id,))
+        msg = dict(c.fetchone())
+        msg["user"] = {"name": msg.pop("user_name"), "color": msg.pop("user_color")}
     return msg
 
 
 @app.delete("/api/messages/{msg_id}")
-def delete_message(msg_id: int, request: Request):
-    user = require_user(request)
-    conn = get_db(MESSAGES_DB)
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM messages WHERE id = ?", (msg_id,))
-    row = c.fetchone()
-    if not row or row["user_id"] != user["id"]:
-        conn.close()
+def delete_message(msg_id: int, user: dict = Depends(require_user)):
+    if not _delete_own_message(msg_id, user["id"]):
         raise HTTPException(status_code=403, detail="Sem permissao")
-    c.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
-    c.execute("DELETE FROM reactions WHERE message_id = ?", (msg_id,))
-    conn.commit()
-    conn.close()
     return {"ok": True}
 
 
 @app.get("/api/users/{user_id}/profile")
-def get_user_profile(user_id: str, request: Request):
-    require_user(request)
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("SELECT id, username, display_name, avatar_color, avatar_image, bio, status FROM users WHERE id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+def get_user_profile(user_id: str, user: dict = Depends(require_user)):
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, display_name, avatar_color, avatar_image, bio, status FROM users WHERE id = ?", (user_id,))
+        row = c.fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="Usuario nao encontrado")
-    return dict(row)
+    profile = dict(row)
+    if user_id == user["id"]:
+        profile["status"] = presence.status_of(user_id, profile["status"])
+    else:
+        profile["status"] = presence.effective(user_id, profile["status"])
+    return profile
 
 
 @app.post("/api/upload")
-async def upload(request: Request, file: UploadFile = File(...)):
-    user = require_user(request)
-    # Validar tipo de arquivo
-    allowed_exts = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp4', '.webm', '.mov', '.mp3', '.ogg', '.wav', '.pdf', '.txt', '.zip'}
-    ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in allowed_exts:
-        raise HTTPException(status_code=400, detail=f"Tipo de arquivo nao permitido. Extensoes aceitas: {', '.join(allowed_exts)}")
-    # Limite de tamanho: 25MB
-    content = await file.read()
-    if len(content) > 25 * 1024 * 1024:
-        raise HTTPException(status_code=413, detail="Arquivo muito grande. Limite: 25MB")
-    # Nome seguro
-    fname = f"{uuid.uuid4().hex}{ext}"
-    path = os.path.join(UPLOAD_DIR, fname)
-    with open(path, "wb") as f:
-        f.write(content)
-    return {"url": f"/static/uploads/{fname}"}
-
-
+async def upload(request: Request, user: dict = Depends(require_user)):
+    upload = await receive_upload(request, "file", UPLOAD_ALLOWED_EXTS, UPLOAD_MAX_BYTES, "Arquivo muito grande. Limite: 25MB")
+    url, deduplicated = await _upload_io(store_upload, upload)
+    return {"url": url, "sha256": upload.sha256, "deduplicated": deduplicated}
 
 
 @app.post("/api/reports")
-def create_report(request: Request, target_id: str = Form(None), target_type: str = Form("message"),
+def create_report(user: dict = Depends(require_user), target_id: str = Form(None), target_type: str = Form("message"),
                   room_id: str = Form(None), message_id: int = Form(None),
                   reason: str = Form(...), details: str = Form("")):
-    user = require_user(request)
     valid_reasons = ['spam', 'harassment', 'nsfw', 'hate', 'doxxing', 'other']
     if reason not in valid_reasons:
         raise HTTPException(status_code=400, detail="Motivo invalido")
     if not room_id:
         raise HTTPException(status_code=400, detail="room_id obrigatorio")
     rid = str(uuid.uuid4())[:8]
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("""INSERT INTO reports (id, reporter_id, target_id, target_type, room_id, message_id, reason, details)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-        (rid, user["id"], target_id, target_type, room_id, message_id, reason, details))
-    conn.commit()
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO reports (id, reporter_id, target_id, target_type, room_id, message_id, reason, details)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (rid, user["id"], target_id, target_type, room_id, message_id, reason, details))
+        conn.commit()
     return {"ok": True, "id": rid}
 
 
 @app.get("/api/reports")
-def list_reports(request: Request, status: str = "open"):
-    user = require_user(request)
+def list_reports(user: dict = Depends(require_user), status: str = "open"):
     # Por enquanto, qualquer usuário pode ver as próprias denúncias
     # Em produção, isso deve ser restrito a mods/admins
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("""SELECT r.*, u.username as reporter_name, tu.username as target_name
-        FROM reports r
-        LEFT JOIN users u ON u.id = r.reporter_id
-        LEFT JOIN users tu ON tu.id = r.target_id
-        WHERE r.reporter_id = ? AND r.status = ?
-        ORDER BY r.created_at DESC""", (user["id"], status))
-    rows = [dict(r) for r in c.fetchall()]
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("""SELECT r.*, u.username as reporter_name, tu.username as target_name
+            FROM reports r
+            LEFT JOIN users u ON u.id = r.reporter_id
+            LEFT JOIN users tu ON tu.id = r.target_id
+            WHERE r.reporter_id = ? AND r.status = ?
+            ORDER BY r.created_at DESC""", (user["id"], status))
+        rows = [dict(r) for r in c.fetchall()]
     return rows
 
 
 @app.post("/api/reports/{report_id}/resolve")
-def resolve_report(report_id: str, request: Request):
-    user = require_user(request)
+def resolve_report(report_id: str, user: dict = Depends(require_user)):
     # Verificar se o usuário é moderador/admin (owner ou mod de algum círculo)
-    conn = get_db(CIRCLES_DB)
-    c = conn.cursor()
-    c.execute("SELECT role FROM circle_members WHERE user_id = ? AND role IN ('owner', 'mod') LIMIT 1", (user["id"],))
-    mod_row = c.fetchone()
-    conn.close()
-    if not mod_row:
-        raise HTTPException(status_code=403, detail="Acesso negado: apenas moderadores podem resolver denuncias")
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("UPDATE reports SET status = 'resolved', resolved_at = CURRENT_TIMESTAMP, resolved_by = ? WHERE id = ?",
-        (user["id"], report_id))
-    conn.commit()
-    conn.close()
+    with db_conn(USERS_DB) as conn:
+        c = conn.cursor()
+        c.execute("SELECT role FROM circles_db.circle_members WHERE user_id = ? AND role IN ('owner', 'mod') LIMIT 1", (user["id"],))
+        if not c.fetchone():
+            raise HTTPException(status_code=403, detail="Acesso negado: apenas moderadores podem resolver denuncias")
+        c.execute("UPDATE reports SET status = 'resolved', resolved_at = CURRENT_TIMESTAMP, resolved_by = ? WHERE id = ?",
+            (user["id"], report_id))
+        conn.commit()
     return {"ok": True}
 
 
+# ========== WEBSOCKETS ==========
+# /ws/session é o socket único do cliente: vários rooms ao mesmo tempo mais as
+# notificações. Trocar de tela é subscribe/unsubscribe no mesmo socket, sem novo
+# handshake nem JWT. /ws/{room_id} e /ws/notifications continuam para clientes antigos.
+WS_SESSION_MAX_ROOMS = int(os.environ.get("LUMINA_WS_SESSION_MAX_ROOMS", "50"))
+
+
+async def _read_handshake(ws):
+    """Primeiro frame do socket (objeto JSON), ou None depois de fechar o socket."""
+    raw = await ws.receive_text()
+    try:
+        data = codec.loads(raw)
+    except codec.errors:
+        data = None
+    if not isinstance(data, dict):
+        await ws.close()
+        return None
+    return data
+
+
+async def _room_access(room_id: str, user_id: str) -> bool:
+    allowed = access_cache.peek_room(room_id, user_id)
+    if allowed is None:
+        allowed = await run_db(access_cache.room_allowed, room_id, user_id)
+    return allowed
+
+
+async def _enter_room(ws, user, room_id: str, last_id=None):
+    """Inscreve o socket no room e manda o histórico (ou o delta após last_id) e os usuários."""
+    if manager.join(room_id, ws):
+        await manager.broadcast(room_id, {"type": "user_joined"}, exclude=ws,
+                                raw={"user": manager.user_json[ws], "users": manager.users_json(room_id)})
+    history = await run_db(_history_frame, room_id, last_id)
+    manager.send(ws, {**history, "room": room_id})
+    manager.send(ws, {"type": "users", "room": room_id}, raw={"users": manager.users_json(room_id)})
+
+
+async def _attach_notifications(conn, user, since=None):
+    """Liga a conexão às notificações do usuário e manda o "hello" com o que ele perdeu desde since."""
+    user_id = user["id"]
+    hello = {"type": "hello", "user_id": user_id, "user": user, "reset": False, "events": []}
+    if since:
+        events = notif_manager.changes_since(user_id, since)
+        if events is None:
+            version = notif_manager.version()
+            hello["reset"] = True
+            hello["friends"] = await run_db(_friends_of, user_id)
+            hello["unread"] = await run_db(unread_store.get_all, user_id)
+            # O que chegou durante a leitura do snapshot vai junto; daqui em diante vem ao vivo
+            events = notif_manager.changes_since(user_id, version) or []
+        hello["events"] = events
+    notif_manager.attach(user_id, conn)
+    conn.push(codec.dumps({**hello, "v": notif_manager.version()}))
+
+
+async def _came_online(user_id: str):
+    """Conexão aberta: só memória, o banco só é lido na primeira vez."""
+    if presence.needs_load(user_id):
+        await run_db(presence.load, user_id)
+    presence.connect(user_id)
+
+
+async def _room_frame(ws, user, room_id: str, mtype: str, data: dict):
+    """Frame do cliente (já validado pelo codec) para um room em que o socket está inscrito."""
+    # Perfil codificado no handshake; se o reaper já descartou o socket, codifica de novo
+    me = {"user": manager.user_json.get(ws) or codec.dumps(user)}
+    # Um só tipo daqui em diante: o cache de histórico é indexado pelo id inteiro
+    msg_id = _parse_msg_id(data.get("msg_id"))
+    if msg_id is None and mtype in ("edit_message", "delete_message", "reaction"):
+        return
+
+    if mtype == "mark_read":
+        count = await run_db(unread_store.mark_read, user["id"], room_id, msg_id)
+        if count is not None:
+            notif_manager.notify(user["id"], {"type": "unread", "room_id": room_id, "count": count})
+        return
+
+    if mtype == "typing":
+        typing_tracker.typing(room_id, user["id"])
+        return
+
+    if mtype == "voice_join":
+        manager.voice_join(room_id, user)
+        await manager.broadcast(room_id, {"type": "voice_user_joined", "voice_users": manager.get_voice_users(room_id)}, raw=me)
+        return
+
+    if mtype == "voice_leave":
+        manager.voice_leave(room_id, user["id"])
+        await manager.broadcast(room_id, {"type": "voice_user_left", "voice_users": manager.get_voice_users(room_id)}, raw=me)
+        return
+
+    if mtype in ("voice_offer", "voice_answer", "voice_ice"):
+        target = data["target"]
+        # Só permite signaling para usuários no mesmo room
+        room_users_ids = {u["id"] for u in manager.get_users(room_id)}
+        if target and target in room_users_ids and target != user["id"]:
+            field = {"voice_offer": "offer", "voice_answer": "answer", "voice_ice": "candidate"}[mtype]
+            await manager.send_to_user(target, room_id, {"type": mtype, "from": user["id"], field: data[field]})
+        return
+
+    if mtype == "edit_message":
+        new_content = data["content"]
+        msg_room = await run_db(_edit_own_message, msg_id, user["id"], new_content)
+        if msg_room:
+            await manager.broadcast(msg_room, {"type": "message_edited", "msg_id": msg_id, "content": new_content})
+        return
+
+    if mtype == "delete_message":
+        msg_room = await run_db(_delete_own_message, msg_id, user["id"])
+        if msg_room:
+            await manager.broadcast(msg_room, {"type": "message_deleted", "msg_id": msg_id})
+        return
+
+    if mtype == "reaction":
+        emoji = data["emoji"]
+        # Só vale para mensagens deste room: o acesso verificado foi o dele
+        try:
+            msg_room, added, _ = await message_writer.submit("reaction", {"msg_id": msg_id, "user_id": user["id"], "emoji": emoji,
+                                                                          "room_id": room_id})
+        except Exception:
+            # Falha de gravação não derruba o socket (e os outros rooms dele)
+            manager.send(ws, {"type": "reaction_failed", "room": room_id, "msg_id": msg_id, "emoji": emoji})
+            return
+        if msg_room:
+            # Só o delta: cada cliente aplica no mapa que já tem da mensagem
+            await manager.broadcast(msg_room, {"type": "reaction_delta", "msg_id": msg_id, "emoji": emoji,
+                                              "user_id": user["id"], "added": added})
+        return
+
+    if mtype != "message":
+        # Tipo desconhecido não vira mensagem gravada no banco
+        return
+
+    content = data["content"]
+    file_url = data["file_url"]
+    db_type = "image" if file_url else "text"
+
+    reply_to_id = data["reply_to_id"]
+    reply_to_user = data["reply_to_user"]
+    reply_to_content = data["reply_to_content"]
+    typing_tracker.stop(room_id, user["id"])
+    recipients = [u["id"] for u in manager.get_users(room_id) if u["id"] != user["id"]]
+    record = {
+        "room_id": room_id, "user_id": user["id"] if not user.get("is_guest") else None,
+        "user_name": user["name"], "user_color": user["color"], "user_avatar": user.get("avatar_image"),
+        "content": content, "msg_type": db_type, "file_url": file_url, "reply_to_id": reply_to_id,
+        "reply_to_user": reply_to_user, "reply_to_content": reply_to_content, "recipients": recipients,
+        "timestamp": _db_now()}
+    seq = message_writer.next_seq()
+    failed = {"type": "message_failed", "seq": seq, "user_id": user["id"]}
+    msg_id = None
+    if WRITE_DURABILITY == "sync":
+        try:
+            msg_id = await message_writer.submit("message", record)
+        except Exception:
+            # Nada foi transmitido ainda: só quem enviou fica sabendo
+            manager.send(ws, {**failed, "room": room_id})
+            return
+
+    msg_broadcast = {"type": "message", "id": msg_id, "seq": seq, "content": content,
+        "file_url": file_url, "msg_type": db_type,
+        "reply_to_id": reply_to_id, "reply_to_user": reply_to_user, "reply_to_content": reply_to_content,
+        "timestamp": datetime.utcnow().isoformat() + "Z"}
+    await manager.broadcast(room_id, msg_broadcast, raw=me)
+    if msg_id is None:
+        # Só enfileira depois do broadcast, para o "message_committed" nunca chegar antes da mensagem
+        async def _on_commit(real_id, seq=seq, msg_room=room_id):
+            await manager.broadcast(msg_room, {"type": "message_committed", "seq": seq, "id": real_id})
+
+        async def _on_error(exc, msg_room=room_id):
+            # A mensagem provisória já foi transmitida: todos a descartam
+            await manager.broadcast(msg_room, failed)
+        message_writer.submit("message", record, on_commit=_on_commit, on_error=_on_error)
+
+
+async def _session_subscribe(ws, user, data: dict):
+    room_id = data.get("room")
+    if not isinstance(room_id, str):
+        return
+    if room_id not in manager.rooms_of(ws) and len(manager.rooms_of(ws)) >= WS_SESSION_MAX_ROOMS:
+        manager.send(ws, {"type": "subscribe_denied", "room": room_id, "reason": "limit"})
+        return
+    if not await _room_access(room_id, user["id"]):
+        manager.send(ws, {"type": "subscribe_denied", "room": room_id, "reason": "forbidden"})
+        return
+    await _enter_room(ws, user, room_id, _parse_msg_id(data.get("last_id")))
+
+
+@app.websocket("/ws/session")
+async def session_ws(ws: WebSocket):
+    """Sessão multiplexada.
+
+    Handshake: {"token", "v": versão das notificações já vista, "rooms": [{"room", "last_id"}]}.
+    Depois: {"type": "subscribe", "room", "last_id"}, {"type": "unsubscribe", "room"}, "ping"
+    e os frames de room de sempre com o campo "room". Todo frame de room volta com
+    "room"; hello, pong e notificações vêm sem.
+    """
+    await ws.accept()
+    data = await _read_handshake(ws)
+    if data is None:
+        return
+
+    user = None
+    token = data.get("token")
+    payload = decode_token(token) if token else None
+    if payload:
+        profile = auth_cache.get(token)
+        user = _ws_user(profile) if profile is not None else await run_db(_load_ws_user, payload["sub"])
+    if not user:
+        await ws.close()
+        return
+
+    conn = manager.attach(ws, user)
+    try:
+        await _attach_notifications(conn, user, data.get("v"))
+        await _came_online(user["id"])
+        for entry in (data.get("rooms") or [])[:WS_SESSION_MAX_ROOMS]:
+            if isinstance(entry, dict):
+                await _session_subscribe(ws, user, entry)
+
+        while True:
+            raw = await ws.receive_text()
+            manager.touch(ws)
+            data = codec.decode_frame(raw)
+            if data is None:
+                continue
+            mtype = data["type"]
+
+            if mtype == "ping":
+                manager.pong(ws)
+            elif mtype == "subscribe":
+                await _session_subscribe(ws, user, data)
+            elif mtype == "unsubscribe":
+                await manager.part(data.get("room"), ws)
+            elif data["room"] in manager.rooms_of(ws):
+                await _room_frame(ws, user, data["room"], mtype, data)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        notif_manager.detach(user["id"], conn)
+        await manager.close_session(ws)
+        presence.disconnect(user["id"])
+
+
 @app.websocket("/ws/notifications")
 async def notif_ws(ws: WebSocket):
     await ws.accept()
-    raw = await ws.receive_text()
-    try:
-        data = json.loads(raw)
-    except:
-        await ws.close(); return
+    data = await _read_handshake(ws)
+    if data is None:
+        return
     token = data.get("token")
     if not token:
         await ws.close(); return
@@ -1114,254 +4719,122 @@ async def notif_ws(ws: WebSocket):
     if not payload:
         await ws.close(); return
     user_id = payload["sub"]
-    conn = get_db(USERS_DB)
-    c = conn.cursor()
-    c.execute("UPDATE users SET status = 'online', last_seen = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-    notif_manager.connect(user_id, ws)
+    conn = notif_manager.connect(user_id, ws)
+    await _came_online(user_id)
     try:
         while True:
-            await ws.receive_text()
+            raw = await ws.receive_text()
+            data = codec.decode_frame(raw)
+            if data is not None and data["type"] == "ping":
+                conn.push(PONG_FRAME)
     except WebSocketDisconnect:
         pass
     finally:
-        notif_manager.disconnect(user_id)
-        # NÃO seta offline aqui — o status persiste entre reinicios do servidor
-        # O usuário pode estar com status 'busy' ou 'away' e não queremos perder isso
-        conn = get_db(USERS_DB)
-        c = conn.cursor()
-        c.execute("UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        notif_manager.disconnect(user_id, conn)
+        # O status escolhido persiste; os outros veem "offline" só depois da carência
+        presence.disconnect(user_id)
 
 
 @app.websocket("/ws/{room_id}")
 async def ws_endpoint(room_id: str, ws: WebSocket):
     await ws.accept()
-    raw = await ws.receive_text()
-    try:
-        data = json.loads(raw)
-    except:
-        await ws.close(); return
+    data = await _read_handshake(ws)
+    if data is None:
+        return
 
     user = None
     token = data.get("token")
     if token:
         payload = decode_token(token)
         if payload:
-            conn = get_db(USERS_DB)
-            c = conn.cursor()
-            c.execute("SELECT id, username, display_name, avatar_color, avatar_image FROM users WHERE id = ?", (payload["sub"],))
-            row = c.fetchone()
-            conn.close()
-            if row:
-                user = {"id": row["id"], "name": row["display_name"] or row["username"], "color": row["avatar_color"], "avatar_image": row["avatar_image"] or "/static/cosmic_aero/alpacas/alpaca_gray.png", "is_guest": False}
+            # Perfil e permissão em memória quando possível: reconexão em massa não toca no banco
+            profile = auth_cache.get(token)
+            allowed = access_cache.peek_room(room_id, payload["sub"])
+            if profile is not None and allowed is not None:
+                user = _ws_user(profile) if allowed else None
+            else:
+                user = await run_db(_load_ws_user, payload["sub"], room_id)
 
     if not user:
         await ws.close()
         return
 
-    # Validar permissão para o room_id
-    if room_id.startswith("topic:"):
-        topic_id = room_id.split(":", 1)[1]
-        conn = get_db(CIRCLES_DB)
-        c = conn.cursor()
-        c.execute("SELECT circle_id FROM topics WHERE id = ?", (topic_id,))
-        topic_row = c.fetchone()
-        conn.close()
-        if not topic_row:
-            await ws.close()
-            return
-        try:
-            _require_circle_member(topic_row["circle_id"], user["id"])
-        except HTTPException:
-            await ws.close()
-            return
-    elif room_id.startswith("dm:"):
-        chat_id = room_id.split(":", 1)[1]
-        try:
-            _require_dm_participant(chat_id, user["id"])
-        except HTTPException:
-            await ws.close()
-            return
-
-    manager.connect(room_id, ws, user)
-
-    await ws.send_text(json.dumps({"type": "handshake", "user_id": user["id"], "user": user}))
-    await manager.broadcast(room_id, {"type": "user_joined", "user": user, "users": manager.get_users(room_id)}, exclude=ws)
-    await ws.send_text(json.dumps({"type": "history", "messages": _get_history(room_id, 50)}))
-    await ws.send_text(json.dumps({"type": "users", "users": manager.get_users(room_id)}))
+    manager.attach(ws, user)
+    manager.send(ws, {"type": "handshake", "user_id": user["id"], "user": user})
+    await _enter_room(ws, user, room_id, _parse_msg_id(data.get("last_id")))
+    await _came_online(user["id"])
 
     try:
         while True:
             raw = await ws.receive_text()
-            data = json.loads(raw)
-            mtype = data.get("type", "message")
-
-            if mtype == "typing":
-                await manager.broadcast(room_id, {"type": "typing", "user": user}, exclude=ws)
-                continue
-
-            if mtype == "voice_join":
-                manager.voice_users.setdefault(room_id, {})[user["id"]] = user
-                await manager.broadcast(room_id, {"type": "voice_user_joined", "user": user, "voice_users": manager.get_voice_users(room_id)})
-                continue
-
-            if mtype == "voice_leave":
-                if room_id in manager.voice_users and user["id"] in manager.voice_users[room_id]:
-                    del manager.voice_users[room_id][user["id"]]
-                    if not manager.voice_users[room_id]:
-                        del manager.voice_users[room_id]
-                await manager.broadcast(room_id, {"type": "voice_user_left", "user": user, "voice_users": manager.get_voice_users(room_id)})
-                continue
-
-            if mtype == "voice_offer":
-                target = data.get("target")
-                # Só permite signaling para usuários no mesmo room
-                room_users_ids = {u["id"] for u in manager.get_users(room_id)}
-                if target and target in room_users_ids and target != user["id"]:
-                    await manager.send_to_user(target, {"type": "voice_offer", "from": user["id"], "offer": data["offer"]})
+            manager.touch(ws)
+            data = codec.decode_frame(raw)
+            if data is None:
                 continue
+            mtype = data["type"]
 
-            if mtype == "voice_answer":
-                target = data.get("target")
-                room_users_ids = {u["id"] for u in manager.get_users(room_id)}
-                if target and target in room_users_ids and target != user["id"]:
-                    await manager.send_to_user(target, {"type": "voice_answer", "from": user["id"], "answer": data["answer"]})
-                continue
-
-            if mtype == "voice_ice":
-                target = data.get("target")
-                room_users_ids = {u["id"] for u in manager.get_users(room_id)}
-                if target and target in room_users_ids and target != user["id"]:
-                    await manager.send_to_user(target, {"type": "voice_ice", "from": user["id"], "candidate": data["candidate"]})
+            if mtype == "ping":
+                manager.pong(ws)
                 continue
 
             if mtype == "subscribe":
-                new_room = data.get("room")
-                if new_room and new_room != room_id:
-                    # Validar permissão para o novo room
-                    if new_room.startswith("topic:"):
-                        new_topic_id = new_room.split(":", 1)[1]
-                        conn = get_db(CIRCLES_DB)
-                        c = conn.cursor()
-                        c.execute("SELECT circle_id FROM topics WHERE id = ?", (new_topic_id,))
-                        new_topic_row = c.fetchone()
-                        conn.close()
-                        if not new_topic_row:
-                            continue
-                        try:
-                            _require_circle_member(new_topic_row["circle_id"], user["id"])
-                        except HTTPException:
-                            continue
-                    elif new_room.startswith("dm:"):
-                        new_chat_id = new_room.split(":", 1)[1]
-                        try:
-                            _require_dm_participant(new_chat_id, user["id"])
-                        except HTTPException:
-                            continue
-                    manager.leave_room(room_id, ws)
+                new_room = data["room"]
+                if new_room != room_id and await _room_access(new_room, user["id"]):
+                    await manager.part(room_id, ws)
                     room_id = new_room
-                    manager.connect(room_id, ws, user)
-                    await ws.send_text(json.dumps({"type": "history", "messages": _get_history(room_id, 50)}))
-                    await ws.send_text(json.dumps({"type": "users", "users": manager.get_users(room_id)}))
-                    await manager.broadcast(room_id, {"type": "user_joined", "user": user, "users": manager.get_users(room_id)}, exclude=ws)
+                    await _enter_room(ws, user, room_id, _parse_msg_id(data.get("last_id")))
                 continue
 
-            if mtype == "edit_message":
-                msg_id = data.get("msg_id")
-                new_content = data.get("content", "")
-                conn = get_db(MESSAGES_DB)
-                c = conn.cursor()
-                c.execute("SELECT user_id FROM messages WHERE id = ?", (msg_id,))
-                row = c.fetchone()
-                if row and row["user_id"] == user["id"]:
-                    c.execute("UPDATE messages SET content = ?, edited_at = CURRENT_TIMESTAMP WHERE id = ?", (new_content, msg_id))
-                    conn.commit()
-                    await manager.broadcast(room_id, {"type": "message_edited", "msg_id": msg_id, "content": new_content})
-                conn.close()
-                continue
-
-            if mtype == "delete_message":
-                msg_id = data.get("msg_id")
-                conn = get_db(MESSAGES_DB)
-                c = conn.cursor()
-                c.execute("SELECT user_id FROM messages WHERE id = ?", (msg_id,))
-                row = c.fetchone()
-                if row and row["user_id"] == user["id"]:
-                    c.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
-                    c.execute("DELETE FROM reactions WHERE message_id = ?", (msg_id,))
-                    conn.commit()
-                    await manager.broadcast(room_id, {"type": "message_deleted", "msg_id": msg_id})
-                conn.close()
-                continue
-
-            if mtype == "reaction":
-                msg_id = data.get("msg_id")
-                emoji = data.get("emoji")
-                conn = get_db(MESSAGES_DB)
-                c = conn.cursor()
-                try:
-                    c.execute("INSERT INTO reactions (message_id, user_id, emoji) VALUES (?, ?, ?)", (msg_id, user["id"], emoji))
-                    conn.commit()
-                    added = True
-                except sqlite3.IntegrityError:
-                    c.execute("DELETE FROM reactions WHERE message_id = ? AND user_id = ? AND emoji = ?", (msg_id, user["id"], emoji))
-                    conn.commit()
-                    added = False
-                c.execute("SELECT user_id, emoji FROM reactions WHERE message_id = ?", (msg_id,))
-                reactions = {}
-                for r in c.fetchall():
-                    e = r["emoji"]
-                    if e not in reactions:
-                        reactions[e] = {"count": 0, "users": []}
-                    reactions[e]["count"] += 1
-                    reactions[e]["users"].append(r["user_id"])
-                conn.close()
-                await manager.broadcast(room_id, {"type": "reaction_update", "msg_id": msg_id, "reactions": reactions})
-                continue
-
-            content = data.get("content", "")
-            file_url = data.get("file_url")
-            db_type = "image" if file_url else "text"
-
-            conn = get_db(MESSAGES_DB)
-            c = conn.cursor()
-            reply_to_id = data.get("reply_to_id")
-            reply_to_user = data.get("reply_to_user")
-            reply_to_content = data.get("reply_to_content")
-            c.execute("""INSERT INTO messages (room_id, user_id, user_name, user_color, content, msg_type, file_url,
-                reply_to_id, reply_to_user, reply_to_content) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (room_id, user["id"] if not user.get("is_guest") else None, user["name"], user["color"],
-                 content, db_type, file_url, reply_to_id, reply_to_user, reply_to_content))
-            msg_id = c.lastrowid
-            conn.commit()
-            conn.close()
-
-            room_users = manager.get_users(room_id)
-            conn = get_db(MESSAGES_DB)
-            c = conn.cursor()
-            for u in room_users:
-                if u["id"] != user["id"]:
-                    c.execute("INSERT INTO unread (user_id, room_id, count, last_message_id) VALUES (?, ?, 1, ?) ON CONFLICT(user_id, room_id) DO UPDATE SET count = count + 1, last_message_id = excluded.last_message_id",
-                        (u["id"], room_id, msg_id))
-            conn.commit()
-            conn.close()
-
-            msg_broadcast = {"type": "message", "id": msg_id, "user": user, "content": content,
-                "file_url": file_url, "msg_type": db_type,
-                "reply_to_id": reply_to_id, "reply_to_user": reply_to_user, "reply_to_content": reply_to_content,
-                "timestamp": datetime.utcnow().isoformat() + "Z"}
-            await manager.broadcast(room_id, msg_broadcast)
+            await _room_frame(ws, user, room_id, mtype, data)
 
     except WebSocketDisconnect:
         pass
     finally:
-        user_left = manager.disconnect(room_id, ws)
-        await manager.broadcast(room_id, {"type": "user_left", "user": user_left, "users": manager.get_users(room_id)})
-        if room_id in manager.voice_users and user_left.get("id") in manager.voice_users.get(room_id, {}):
-            del manager.voice_users[room_id][user_left["id"]]
-            if not manager.voice_users[room_id]:
-                del manager.voice_users[room_id]
-            await manager.broadcast(room_id, {"type": "voice_user_left", "user": user_left, "voice_users": manager.get_voice_users(room_id)})
+        # Nada a fazer se o reaper de sockets ociosos já tirou este socket dos rooms
+        await manager.close_session(ws)
+        presence.disconnect(user["id"])
+
+
+# ========== CICLO DE VIDA ==========
+
+@app.on_event("startup")
+async def start_background_tasks():
+    loop_monitor.start()
+    await run_db(unread_store.load)
+    unread_store.start()
+    message_writer.start()
+    await backplane.start(_on_backplane_event)
+    manager.start()
+    notif_manager.start()
+    typing_tracker.start()
+    presence.start()
+    search_backfill.start()
+    upload_sweeper.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    # Ordem importa: a fila write-behind precisa do executor e dos pools para o flush final
+    await search_backfill.close()
+    await upload_sweeper.close()
+    await message_writer.close()
+    await unread_store.close()
+    await presence.close()
+    await typing_tracker.close()
+    await manager.stop()
+    await backplane.close()
+    loop_monitor.stop()
+    for pool in DB_POOLS.values():
+        pool.close_all()
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["--backfill-search"]:
+        # Indexa de uma vez as mensagens antigas (o servidor também faz isso em background)
+        search_backfill.run()
+        print(search_backfill.stats())
+    elif sys.argv[1:] == ["--upload-report"]:
+        print(json.dumps(upload_store_report(), indent=2))
+    else:
+        print("uso: python disgarai.py --backfill-search | --upload-report")
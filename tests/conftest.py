@@ -0,0 +1,86 @@
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="module")
+def app_module(request, tmp_path_factory):
+    """disgarai importado de uma cópia num diretório temporário (bancos e uploads ficam lá).
+
+    APP_ENV no módulo de teste define variáveis LUMINA_* lidas no import."""
+    root = tmp_path_factory.mktemp("app")
+    shutil.copy(REPO / "disgarai.py", root)
+    (root / "static").mkdir()
+    shutil.copy(REPO / "static" / "index.html", root / "static")
+    spec = importlib.util.spec_from_file_location("disgarai", root / "disgarai.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["disgarai"] = module
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in getattr(request.module, "APP_ENV", {}).items():
+            mp.setenv(name, value)
+        spec.loader.exec_module(module)
+    yield module
+    sys.modules.pop("disgarai", None)
+
+
+@pytest.fixture(scope="module")
+def client(app_module):
+    with TestClient(app_module.app) as cl:
+        yield cl
+
+
+@pytest.fixture(scope="module")
+def register(client):
+    """register("alice") -> (user, headers)"""
+    def _register(username):
+        r = client.post("/api/register", data={"username": username, "password": "pw"})
+        assert r.status_code == 200, r.text
+        data = r.json()
+        return data["user"], {"Authorization": "Bearer " + data["token"]}
+    return _register
+
+
+def receive_until(ws, frame_type, limit=50):
+    """Lê frames do socket até chegar um do tipo pedido."""
+    for _ in range(limit):
+        frame = ws.receive_json()
+        if frame["type"] == frame_type:
+            return frame
+    raise AssertionError(f"nenhum frame {frame_type!r} em {limit}")
+
+
+class FakeSocket:
+    """Socket de servidor em memória para testar RoomManager sem HTTP."""
+
+    def __init__(self, stalled=False):
+        self.sent = []
+        self.closed_with = None
+        self._stalled = stalled
+
+    async def send_text(self, text):
+        if self._stalled:
+            # Cliente que parou de ler: o escritor fica preso no primeiro frame
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def room_manager(d):
+    """RoomManager num backplane só dele."""
+    return d.RoomManager(d.LocalBackplane("teste", []))
+
+
+def stop_all(manager):
+    for conn in manager.conns.values():
+        conn.stop()
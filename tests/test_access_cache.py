@@ -0,0 +1,59 @@
+import threading
+from contextlib import contextmanager
+
+
+def _circle(client, headers, name):
+    circle = client.post("/api/circles", data={"name": name}, headers=headers).json()
+    topic_id = client.get(f"/api/circles/{circle['id']}", headers=headers).json()["topics"][0]["id"]
+    return circle, topic_id
+
+
+def test_join_replaces_a_cached_deny(client, app_module, register):
+    cache = app_module.access_cache
+    _, ho = register("dona")
+    guest, hg = register("convidada")
+    circle, topic_id = _circle(client, ho, "fechado")
+    assert client.get(f"/api/topics/{topic_id}/history", headers=hg).status_code == 403
+    assert cache.peek_room("topic:" + topic_id, guest["id"]) is False
+
+    assert client.post("/api/circles/join", data={"code": circle["invite_code"]}, headers=hg).status_code == 200
+    assert cache.peek_room("topic:" + topic_id, guest["id"]) is None
+    assert client.get(f"/api/topics/{topic_id}/history", headers=hg).status_code == 200
+    assert cache.peek_room("topic:" + topic_id, guest["id"]) is True
+
+
+def test_new_topic_is_reachable_right_away(client, app_module, register):
+    owner, ho = register("criadora")
+    circle, _ = _circle(client, ho, "topicos")
+    assert client.get(f"/api/circles/{circle['id']}", headers=ho).status_code == 200
+    tid = client.post(f"/api/circles/{circle['id']}/topics", data={"name": "novo"}, headers=ho).json()["id"]
+    assert app_module.access_cache.room_allowed("topic:" + tid, owner["id"])
+    assert client.get(f"/api/topics/{tid}/history", headers=ho).status_code == 200
+
+
+def test_load_racing_an_invalidation_is_not_cached(client, app_module, register, monkeypatch):
+    """Um load que leu os membros antes de um join não pode gravar a lista velha."""
+    d = app_module
+    cache = d.access_cache
+    _, ho = register("corrida")
+    guest, hg = register("atrasada")
+    circle, topic_id = _circle(client, ho, "corrida")
+    cache.invalidate(circle_id=circle["id"])
+    real_db_conn = d.db_conn
+    joined = threading.Event()
+
+    @contextmanager
+    def db_conn_then_join(path):
+        with real_db_conn(path) as conn:
+            yield conn
+        if path == d.CIRCLES_DB and not joined.is_set():
+            # O join termina entre a leitura do load e o _put
+            joined.set()
+            monkeypatch.setattr(d, "db_conn", real_db_conn)
+            client.post("/api/circles/join", data={"code": circle["invite_code"]}, headers=hg)
+
+    monkeypatch.setattr(d, "db_conn", db_conn_then_join)
+    stale = cache.circle_roles(circle["id"])
+    assert joined.is_set() and guest["id"] not in stale
+    assert circle["id"] not in cache.circles
+    assert cache.room_allowed("topic:" + topic_id, guest["id"])
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+
+def _codecs(app_module):
+    for name in ("stdlib", "orjson", "msgspec"):
+        try:
+            yield app_module.FrameCodec(name)
+        except ImportError:
+            pass
+
+
+@pytest.fixture(scope="module")
+def codecs(app_module):
+    return list(_codecs(app_module))
+
+
+def test_round_trip(codecs):
+    msg = {"type": "message", "id": 7, "content": "olá 👍", "reactions": {"👍": {"count": 1, "users": ["a"]}}, "file_url": None}
+    for codec in codecs:
+        assert codec.loads(codec.dumps(msg)) == msg, codec.name
+        assert json.loads(codec.dumps(msg)) == msg, codec.name
+
+
+def test_frame_splices_pre_encoded_fields(codecs):
+    for codec in codecs:
+        user = codec.dumps({"id": "u1", "name": "alice"})
+        text = codec.frame({"type": "message", "content": "oi"}, raw={"user": user})
+        assert json.loads(text) == {"user": {"id": "u1", "name": "alice"}, "type": "message", "content": "oi"}
+        assert json.loads(codec.frame({}, raw={"user": user})) == {"user": {"id": "u1", "name": "alice"}}
+        with pytest.raises(AssertionError):
+            codec.frame({"user": None}, raw={"user": user})
+
+
+def test_decode_frame_fills_defaults_and_drops_unknown_fields(app_module):
+    codec = app_module.FrameCodec("stdlib")
+    frame = codec.decode_frame(json.dumps({"content": "oi", "extra": 1}))
+    assert frame == {"type": "message", "content": "oi", "file_url": None, "reply_to_id": None,
+                     "reply_to_user": None, "reply_to_content": None, "room": None}
+
+
+@pytest.mark.parametrize("msg_id, expected", [(5, 5), ("5", 5), ("0012", 12)])
+def test_decode_frame_normalizes_message_ids(app_module, msg_id, expected):
+    codec = app_module.FrameCodec("stdlib")
+    for mtype in ("edit_message", "delete_message", "reaction", "mark_read"):
+        frame = codec.decode_frame(json.dumps({"type": mtype, "msg_id": msg_id, "emoji": "👍"}))
+        assert frame["msg_id"] == expected and type(frame["msg_id"]) is int, (mtype, frame)
+
+
+@pytest.mark.parametrize("raw", [
+    "não é json",
+    "[1, 2]",
+    "42",
+    '"ping"',
+    json.dumps({"type": "nao_existe"}),
+    json.dumps({"type": "delete_message"}),
+    json.dumps({"type": "delete_message", "msg_id": "1 OR 1=1"}),
+    json.dumps({"type": "delete_message", "msg_id": "-1"}),
+    json.dumps({"type": "delete_message", "msg_id": True}),
+    json.dumps({"type": "delete_message", "msg_id": 1.5}),
+    json.dumps({"type": "reaction", "msg_id": 1}),
+    json.dumps({"type": "subscribe", "room": 3}),
+    json.dumps({"type": "message", "content": {"x": 1}}),
+])
+def test_decode_frame_rejects_invalid(app_module, raw):
+    codec = app_module.FrameCodec("stdlib")
+    assert codec.decode_frame(raw) is None
+    assert codec.stats()["invalid"] == 1
@@ -0,0 +1,43 @@
+from conftest import receive_until
+
+
+def test_pooled_connections_see_the_sibling_databases(client, app_module, register):
+    d = app_module
+    user, _ = register("attach")
+    with d.db_conn(d.MESSAGES_DB) as conn:
+        assert conn.execute("SELECT username FROM users_db.users WHERE id = ?", (user["id"],)).fetchone()[0] == "attach"
+        assert conn.execute("SELECT count(*) FROM circles_db.circle_members").fetchone()[0] >= 0
+    with d.db_conn(d.USERS_DB) as conn:
+        assert conn.execute("SELECT count(*) FROM messages_db.messages").fetchone()[0] >= 0
+
+
+def test_dm_list_joins_peer_last_message_and_unread(client, register):
+    alice, ha = register("ana")
+    bob, hb = register("beto")
+    client.post("/api/friends/request", data={"username": "beto"}, headers=ha)
+    client.post("/api/friends/accept", data={"friend_id": alice["id"]}, headers=hb)
+    chat = client.get("/api/dm-chats", headers=ha).json()[0]
+    assert chat["peer_id"] == bob["id"] and chat["username"] == "beto" and chat["last_message"] is None
+    room_id = "dm:" + chat["id"]
+    tokens = {name: h["Authorization"].split()[1] for name, h in (("ana", ha), ("beto", hb))}
+    with client.websocket_connect("/ws/session") as wa, client.websocket_connect("/ws/session") as wb:
+        wa.send_json({"token": tokens["ana"], "rooms": [{"room": room_id}]})
+        receive_until(wa, "users")
+        wb.send_json({"token": tokens["beto"], "rooms": [{"room": room_id}]})
+        receive_until(wb, "users")
+        wb.send_json({"type": "message", "room": room_id, "content": "x" * 500})
+        msg_id = receive_until(wb, "message_committed")["id"]
+    chat = client.get("/api/dm-chats", headers=ha).json()[0]
+    last = chat["last_message"]
+    assert last["id"] == msg_id and last["user_id"] == bob["id"] and last["content"].endswith("…")
+    assert len(last["content"]) < 500 and chat["unread"] == 1
+
+
+def test_circle_members_come_with_profiles(client, register):
+    owner, ho = register("dona")
+    guest, hg = register("visita")
+    circle = client.post("/api/circles", data={"name": "c"}, headers=ho).json()
+    client.post("/api/circles/join", data={"code": circle["invite_code"]}, headers=hg)
+    members = {m["id"]: m for m in client.get(f"/api/circles/{circle['id']}", headers=ho).json()["members"]}
+    assert members[owner["id"]]["username"] == "dona" and members[owner["id"]]["role"] == "owner"
+    assert members[guest["id"]]["username"] == "visita" and members[guest["id"]]["role"] == "member"
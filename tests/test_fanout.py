@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from conftest import FakeSocket, room_manager, stop_all
+
+
+def test_slow_consumer_is_dropped_or_disconnected(app_module, monkeypatch):
+    d = app_module
+    monkeypatch.setattr(d, "FANOUT_QUEUE_SIZE", 4)
+
+    async def scenario(policy):
+        monkeypatch.setattr(d, "SLOW_CONSUMER_POLICY", policy)
+        manager = room_manager(d)
+        slow, fast = FakeSocket(stalled=True), FakeSocket()
+        for i, ws in enumerate((slow, fast)):
+            manager.attach(ws, {"id": f"u{i}", "name": f"u{i}"})
+            manager.join("topic:x", ws)
+        for i in range(10):
+            await manager.broadcast("topic:x", {"type": "message", "n": i})
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        conn = manager.conns[slow]
+        result = conn.closed, conn.dropped, slow.closed_with, [f["n"] for f in fast.sent]
+        stop_all(manager)
+        return result
+
+    closed, dropped, code, fast_got = asyncio.run(scenario("drop"))
+    assert not closed and dropped > 0 and code is None
+    assert fast_got == list(range(10))
+
+    closed, dropped, code, fast_got = asyncio.run(scenario("disconnect"))
+    assert closed and code == 1013
+    assert fast_got == list(range(10))
+
+
+def test_ephemeral_frames_are_dropped_first(app_module, monkeypatch):
+    d = app_module
+    monkeypatch.setattr(d, "FANOUT_QUEUE_SIZE", 4)
+
+    async def scenario():
+        manager = room_manager(d)
+        ws = FakeSocket(stalled=True)
+        conn = manager.attach(ws, {"id": "u1", "name": "u1"})
+        await asyncio.sleep(0)
+        accepted = [conn.push("{}") for _ in range(3)]  # 1 em envio + 2 na fila (metade)
+        ephemeral = conn.push("{}", ephemeral=True)
+        regular = conn.push("{}")
+        stop_all(manager)
+        return accepted, ephemeral, regular, conn.dropped
+
+    accepted, ephemeral, regular, dropped = asyncio.run(scenario())
+    assert all(accepted) and not ephemeral and regular and dropped == 1
+
+
+def test_reaper_closes_idle_sockets_and_tells_the_room(app_module, monkeypatch):
+    d = app_module
+
+    async def scenario():
+        manager = room_manager(d)
+        idle, active = FakeSocket(), FakeSocket()
+        manager.attach(idle, {"id": "zumbi", "name": "zumbi"})
+        manager.attach(active, {"id": "viva", "name": "viva"})
+        for ws in (idle, active):
+            manager.join("topic:x", ws)
+        manager.join("topic:y", idle)
+        manager.conns[idle].last_seen = time.monotonic() - d.WS_IDLE_TIMEOUT_S - 1
+        await manager.reap_idle()
+        await asyncio.sleep(0.01)
+        result = (manager.reaped, idle.closed_with, idle in manager.conns, "zumbi" in manager.sessions,
+                  manager.rooms.get("topic:x"), "topic:y" in manager.rooms,
+                  [f["user"]["id"] for f in active.sent if f["type"] == "user_left"])
+        stop_all(manager)
+        return result
+
+    reaped, code, still_attached, has_session, room_x, room_y_open, left = asyncio.run(scenario())
+    assert reaped == 1 and code == 1001 and not still_attached and not has_session
+    assert room_x is not None and len(room_x) == 1 and not room_y_open
+    assert left == ["zumbi"]
@@ -0,0 +1,14 @@
+def test_friend_request_and_accept(client, register):
+    alice, ha = register("alice")
+    bob, hb = register("bob")
+    assert client.post("/api/friends/request", data={"username": "BOB"}, headers=ha).status_code == 200
+    assert client.post("/api/friends/request", data={"username": "bob"}, headers=ha).status_code == 400
+    assert client.post("/api/friends/request", data={"username": "alice"}, headers=hb).status_code == 400
+    assert client.post("/api/friends/request", data={"username": "alice"}, headers=ha).status_code == 400
+    assert client.post("/api/friends/request", data={"username": "ninguem"}, headers=ha).status_code == 404
+    assert [f["fid"] for f in client.get("/api/friends", headers=hb).json()["pending_received"]] == [alice["id"]]
+
+    assert client.post("/api/friends/accept", data={"friend_id": alice["id"]}, headers=hb).status_code == 200
+    assert client.post("/api/friends/accept", data={"friend_id": alice["id"]}, headers=hb).status_code == 400
+    assert [f["fid"] for f in client.get("/api/friends", headers=ha).json()["friends"]] == [bob["id"]]
+    assert len(client.get("/api/dm-chats", headers=ha).json()) == 1
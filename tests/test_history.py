@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from conftest import receive_until
+
+
+@pytest.fixture(scope="module")
+def room(client, register):
+    """Tópico com 5 mensagens da alice; devolve (room_id, topic_id, headers, token)."""
+    user, headers = register("alice")
+    circle = client.post("/api/circles", data={"name": "historico"}, headers=headers).json()
+    topic_id = client.get(f"/api/circles/{circle['id']}", headers=headers).json()["topics"][0]["id"]
+    room_id = "topic:" + topic_id
+    token = headers["Authorization"].split()[1]
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        for i in range(1, 6):
+            ws.send_json({"type": "message", "room": room_id, "content": f"m{i}"})
+            receive_until(ws, "message_committed")
+    return room_id, topic_id, headers, token
+
+
+def _ids(page):
+    return [m["id"] for m in page["messages"]]
+
+
+def _cached_and_db(client, topic_id, headers):
+    cached = client.get(f"/api/topics/{topic_id}/history", headers=headers).json()
+    fromdb = client.get(f"/api/topics/{topic_id}/history", params={"before_id": 10**9}, headers=headers).json()
+    return cached, fromdb
+
+
+def test_cache_follows_edit_and_delete_with_string_ids(client, app_module, room):
+    room_id, topic_id, headers, token = room
+    cached, fromdb = _cached_and_db(client, topic_id, headers)
+    assert app_module.history_cache.rooms.get(room_id) is not None
+    first, second = _ids(cached)[:2]
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        ws.send_json({"type": "edit_message", "room": room_id, "msg_id": str(second), "content": "editada"})
+        edited = receive_until(ws, "message_edited")
+        assert edited["msg_id"] == second
+        ws.send_json({"type": "delete_message", "room": room_id, "msg_id": str(first)})
+        deleted = receive_until(ws, "message_deleted")
+        assert deleted["msg_id"] == first
+    cached, fromdb = _cached_and_db(client, topic_id, headers)
+    assert first not in _ids(cached)
+    assert cached["messages"] == fromdb["messages"]
+    assert [m["content"] for m in cached["messages"] if m["id"] == second] == ["editada"]
+
+
+def test_reaction_only_applies_to_messages_of_the_frame_room(client, register, room):
+    room_id, topic_id, headers, token = room
+    _, other_headers = register("bob")
+    other_circle = client.post("/api/circles", data={"name": "outro"}, headers=other_headers).json()
+    other_topic = client.get(f"/api/circles/{other_circle['id']}", headers=other_headers).json()["topics"][0]["id"]
+    other_room = "topic:" + other_topic
+    other_token = other_headers["Authorization"].split()[1]
+    with client.websocket_connect("/ws/session") as other:
+        other.send_json({"token": other_token, "rooms": [{"room": other_room}]})
+        receive_until(other, "users")
+        other.send_json({"type": "message", "room": other_room, "content": "de outro room"})
+        foreign_id = receive_until(other, "message_committed")["id"]
+        own_id = _ids(client.get(f"/api/topics/{topic_id}/history", headers=headers).json())[-1]
+        with client.websocket_connect("/ws/session") as ws:
+            ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+            receive_until(ws, "users")
+            ws.send_json({"type": "reaction", "room": room_id, "msg_id": foreign_id, "emoji": "👍"})
+            ws.send_json({"type": "reaction", "room": room_id, "msg_id": own_id, "emoji": "👍"})
+            delta = receive_until(ws, "reaction_delta")
+            assert delta["msg_id"] == own_id and delta["room"] == room_id and delta["added"]
+    foreign = client.get(f"/api/topics/{other_topic}/history", params={"before_id": 10**9}, headers=other_headers).json()
+    assert [m["reactions"] for m in foreign["messages"]] == [{}]
@@ -0,0 +1,13 @@
+def test_metrics_serve_cached_reports(client, app_module, register, monkeypatch):
+    _, headers = register("ops")
+
+    def expensive():
+        raise AssertionError("recalculado a cada /api/metrics")
+
+    monkeypatch.setattr(app_module, "check_query_plans", expensive)
+    monkeypatch.setattr(app_module, "upload_store_report", expensive)
+    r = client.get("/api/metrics", headers=headers)
+    assert r.status_code == 200, r.text
+    metrics = r.json()
+    assert metrics["query_plans"] and all(metrics["query_plans"].values()), metrics["query_plans"]
+    assert "gc_sweeps" in metrics["upload_store"]
@@ -0,0 +1,69 @@
+import pytest
+
+from conftest import receive_until
+
+
+@pytest.fixture(scope="module")
+def topic(client, register):
+    """Tópico com 12 mensagens (m0..m11); devolve (topic_id, headers, ids)."""
+    _, headers = register("alice")
+    circle = client.post("/api/circles", data={"name": "paginas"}, headers=headers).json()
+    topic_id = client.get(f"/api/circles/{circle['id']}", headers=headers).json()["topics"][0]["id"]
+    room_id = "topic:" + topic_id
+    ids = []
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": headers["Authorization"].split()[1], "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        for i in range(12):
+            ws.send_json({"type": "message", "room": room_id, "content": f"m{i}"})
+            ids.append(receive_until(ws, "message_committed")["id"])
+    return topic_id, headers, ids
+
+
+def _page(client, topic, **params):
+    topic_id, headers, _ = topic
+    r = client.get(f"/api/topics/{topic_id}/history", params=params, headers=headers)
+    assert r.status_code == 200, r.text
+    page = r.json()
+    return [m["content"] for m in page["messages"]], page["next_cursor"], page["newer_cursor"]
+
+
+def test_latest_page_and_walking_back(client, topic):
+    contents, older, newer = _page(client, topic, limit=5)
+    assert contents == ["m7", "m8", "m9", "m10", "m11"] and newer is None
+    contents, older, newer = _page(client, topic, limit=5, before_id=older)
+    assert contents == ["m2", "m3", "m4", "m5", "m6"] and newer is not None
+    contents, older, newer = _page(client, topic, limit=5, before_id=older)
+    assert contents == ["m0", "m1"] and older is None
+
+
+def test_before_id_past_the_end_has_no_newer_cursor(client, topic):
+    ids = topic[2]
+    contents, older, newer = _page(client, topic, limit=5, before_id=ids[-1] + 1000)
+    assert contents == ["m7", "m8", "m9", "m10", "m11"] and newer is None
+    contents, older, newer = _page(client, topic, limit=5, before_id=ids[-1])
+    assert contents == ["m6", "m7", "m8", "m9", "m10"] and newer == ids[-2]
+
+
+def test_after_and_around(client, topic):
+    ids = topic[2]
+    contents, older, newer = _page(client, topic, limit=4, after_id=ids[0])
+    assert contents == ["m1", "m2", "m3", "m4"] and newer == ids[4]
+    contents, older, newer = _page(client, topic, limit=4, after_id=ids[8])
+    assert contents == ["m9", "m10", "m11"] and newer is None
+    contents, older, newer = _page(client, topic, limit=4, around_id=ids[6])
+    assert contents == ["m5", "m6", "m7", "m8"] and older == ids[5] and newer == ids[8]
+
+
+def test_only_one_cursor(client, topic):
+    topic_id, headers, _ = topic
+    r = client.get(f"/api/topics/{topic_id}/history", params={"before_id": 1, "after_id": 2}, headers=headers)
+    assert r.status_code == 400
+
+
+def test_reconnect_delta(client, topic):
+    topic_id, headers, ids = topic
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": headers["Authorization"].split()[1], "rooms": [{"room": "topic:" + topic_id, "last_id": ids[9]}]})
+        history = receive_until(ws, "history")
+    assert history["delta"] and [m["content"] for m in history["messages"]] == ["m10", "m11"]
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import pytest
+
+# Sem o loop de fundo: os testes chamam push() na hora certa
+APP_ENV = {"LUMINA_PRESENCE_PUSH_S": "3600", "LUMINA_PRESENCE_OFFLINE_GRACE_S": "0.2"}
+
+
+@pytest.fixture
+def sent(app_module, monkeypatch):
+    """friend_status entregues, como (destinatário, usuário, status)."""
+    out = []
+
+    def notify(uid, msg):
+        if msg["type"] == "friend_status":
+            out.append((uid, msg["user_id"], msg["status"]))
+
+    monkeypatch.setattr(app_module.notif_manager, "notify", notify)
+    return out
+
+
+@pytest.fixture
+def friends(client, register):
+    def _friends(a, b):
+        ua, ha = register(a)
+        ub, hb = register(b)
+        client.post("/api/friends/request", data={"username": b}, headers=ha)
+        client.post("/api/friends/accept", data={"friend_id": ua["id"]}, headers=hb)
+        return ua, ub
+    return _friends
+
+
+def _about(sent, user):
+    # Outros testes deixam offlines pendentes; só interessam os eventos deste usuário
+    return [event for event in sent if event[1] == user["id"]]
+
+
+def _push(app_module):
+    asyncio.run(app_module.presence.push())
+
+
+def test_flapping_connection_is_coalesced(app_module, friends, sent):
+    presence = app_module.presence
+    alice, bob = friends("alice", "bob")
+    presence.connect(alice["id"])
+    presence.disconnect(alice["id"])
+    presence.connect(alice["id"])
+    _push(app_module)
+    assert _about(sent, alice) == [(bob["id"], alice["id"], "online")]
+
+    coalesced = presence.coalesced
+    presence.disconnect(alice["id"])
+    presence.connect(alice["id"])
+    _push(app_module)
+    assert _about(sent, alice) == [(bob["id"], alice["id"], "online")]
+    assert presence.coalesced == coalesced + 1
+    presence.disconnect(alice["id"])
+
+
+def test_offline_only_after_grace(app_module, friends, sent):
+    presence = app_module.presence
+    carol, dave = friends("carol", "dave")
+    presence.connect(carol["id"])
+    _push(app_module)
+    presence.disconnect(carol["id"])
+    _push(app_module)
+    assert presence.effective(carol["id"]) == "online"
+    assert _about(sent, carol) == [(dave["id"], carol["id"], "online")]
+
+    time.sleep(app_module.PRESENCE_OFFLINE_GRACE_S + 0.05)
+    _push(app_module)
+    assert presence.effective(carol["id"]) == "offline"
+    assert _about(sent, carol)[-1] == (dave["id"], carol["id"], "offline")
+
+
+def test_failed_audience_lookup_retries_the_change(app_module, friends, sent, monkeypatch):
+    presence = app_module.presence
+    erin, frank = friends("erin", "frank")
+
+    def unavailable(user_ids):
+        raise app_module.HTTPException(status_code=503, detail="Banco ocupado")
+
+    lookup = app_module._presence_audiences
+    monkeypatch.setattr(app_module, "_presence_audiences", unavailable)
+    presence.connect(erin["id"])
+    with pytest.raises(app_module.HTTPException):
+        _push(app_module)
+    assert _about(sent, erin) == []
+
+    monkeypatch.setattr(app_module, "_presence_audiences", lookup)
+    _push(app_module)
+    assert _about(sent, erin) == [(frank["id"], erin["id"], "online")]
+    presence.disconnect(erin["id"])
@@ -0,0 +1,17 @@
+from test_unread import dm, mark_read, present, send, unread  # noqa: F401
+from test_unread import test_counts_and_mark_read, test_mark_read_past_the_last_message_does_not_hide_new_ones  # noqa: F401
+
+APP_ENV = {"LUMINA_UNREAD_MODE": "marker"}
+
+
+def test_uses_read_markers(app_module):
+    assert type(app_module.unread_store).__name__ == "ReadMarkerStore"
+
+
+def test_partial_mark_read_counts_what_is_left(client, dm):
+    room_id, ha, alice_token, bob_token = dm
+    with present(client, alice_token, room_id):
+        ids = send(client, bob_token, room_id, ["x", "y", "z"])
+    before = unread(client, ha, room_id)
+    mark_read(client, alice_token, room_id, ids[0])
+    assert unread(client, ha, room_id) == 2 and before >= 3
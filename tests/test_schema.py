@@ -0,0 +1,15 @@
+import os
+
+
+def test_migrations_reach_the_latest_version_and_are_idempotent(app_module):
+    d = app_module
+    expected = {os.path.basename(path): steps[-1][0] for path, steps in d.MIGRATIONS.items()}
+    assert d.schema_versions() == expected
+    for path, steps in d.MIGRATIONS.items():
+        assert d.run_migrations(path, steps) == steps[-1][0]
+    assert d.schema_versions() == expected
+
+
+def test_every_hot_query_uses_an_index(app_module):
+    for name, report in app_module.check_query_plans().items():
+        assert report["ok"], (name, report["plan"])
@@ -0,0 +1,95 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def rooms(client, app_module, register):
+    """Dois tópicos da alice e um do bob, com mensagens gravadas direto no banco."""
+    alice, ha = register("alice")
+    bob, hb = register("bob")
+
+    def topic(headers, name):
+        circle = client.post("/api/circles", data={"name": name}, headers=headers).json()
+        return "topic:" + client.get(f"/api/circles/{circle['id']}", headers=headers).json()["topics"][0]["id"]
+
+    a1, a2, b1 = topic(ha, "um"), topic(ha, "dois"), topic(hb, "tres")
+    ids = {}
+    with app_module.db_conn(app_module.MESSAGES_DB) as conn:
+        def post(room_id, user, content):
+            c = conn.execute("""INSERT INTO messages (room_id, user_id, user_name, user_color, content, msg_type, timestamp)
+                VALUES (?, ?, ?, '#fff', ?, 'text', '2026-01-01T00:00:00')""", (room_id, user["id"], user["username"], content))
+            ids.setdefault(room_id, []).append(c.lastrowid)
+        for i in range(7):
+            post(a1, alice, f"relatorio parcial {i}" + " relatorio" * (i % 3))
+        post(a2, alice, "relatorio do outro topico")
+        post(a2, alice, "<b>alerta</b> & cia")
+        post(b1, bob, "relatorio secreto do bob")
+        conn.commit()
+    return {"alice": ha, "bob": hb, "a1": a1, "a2": a2, "b1": b1, "ids": ids}
+
+
+def _search(client, headers, **params):
+    r = client.get("/api/search", params=params, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def _all_pages(client, headers, **params):
+    ids, cursor = [], None
+    while True:
+        page = _search(client, headers, **params, **({"cursor": cursor} if cursor else {}))
+        ids += [m["id"] for m in page["results"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return ids
+
+
+def test_results_are_scoped_to_the_users_rooms(client, rooms):
+    found = {m["room_id"] for m in _search(client, rooms["alice"], q="relatorio", limit=50)["results"]}
+    assert found == {rooms["a1"], rooms["a2"]}
+    assert [m["room_id"] for m in _search(client, rooms["bob"], q="relatorio")["results"]] == [rooms["b1"]]
+    only = _search(client, rooms["alice"], q="relatorio", room_id=rooms["a2"])["results"]
+    assert [m["id"] for m in only] == rooms["ids"][rooms["a2"]][:1]
+    assert _search(client, rooms["alice"], q="relatorio", room_id=rooms["b1"]) == {"results": [], "next_cursor": None}
+
+
+@pytest.mark.parametrize("order", ["recent", "rank"])
+def test_cursor_pages_cover_every_hit_once(client, rooms, order):
+    expected = set(rooms["ids"][rooms["a1"]])
+    ids = _all_pages(client, rooms["alice"], q="parcial", order=order, limit=2)
+    assert len(ids) == len(set(ids)) and set(ids) == expected
+    if order == "recent":
+        assert ids == sorted(expected, reverse=True)
+
+
+@pytest.mark.parametrize("order", ["recent", "rank"])
+def test_windowed_path_matches_the_selective_path(client, app_module, rooms, monkeypatch, order):
+    selective = _all_pages(client, rooms["alice"], q="relatorio", order=order, limit=3)
+    monkeypatch.setattr(app_module, "SEARCH_SELECTIVE_MAX", 2)
+    windowed = _all_pages(client, rooms["alice"], q="relatorio", order=order, limit=3)
+    assert windowed == selective
+
+
+def test_rank_window_scores_only_the_most_recent_hits(client, app_module, rooms, monkeypatch):
+    monkeypatch.setattr(app_module, "SEARCH_SELECTIVE_MAX", 2)
+    monkeypatch.setattr(app_module, "SEARCH_RANK_WINDOW", 3)
+    ids = _all_pages(client, rooms["alice"], q="parcial", order="rank", limit=2)
+    assert sorted(ids) == sorted(rooms["ids"][rooms["a1"]])[-3:]
+
+
+def test_snippet_is_escaped_and_marked(client, rooms):
+    [hit] = _search(client, rooms["alice"], q="alerta")["results"]
+    assert "&lt;b&gt;<mark>alerta</mark>&lt;/b&gt;" in hit["snippet"] and "&amp;" in hit["snippet"]
+
+
+@pytest.mark.parametrize("q", ['"', 'relatorio"', "NEAR(relatorio", "relatorio*", "*", "relatorio OR bob", "room_key:x", "-relatorio"])
+def test_fts_syntax_is_searched_as_text(client, rooms, q):
+    results = _search(client, rooms["alice"], q=q)["results"]
+    assert all(m["room_id"] in (rooms["a1"], rooms["a2"]) for m in results)
+
+
+def test_invalid_input(client, rooms):
+    h = rooms["alice"]
+    assert client.get("/api/search", params={"q": "  "}, headers=h).status_code == 400
+    assert client.get("/api/search", params={"q": "x", "order": "old"}, headers=h).status_code == 400
+    assert client.get("/api/search", params={"q": "x", "cursor": "a:b"}, headers=h).status_code == 400
+    assert client.get("/api/search", params={"q": "x", "order": "recent", "cursor": "z"}, headers=h).status_code == 400
@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        pass
+
+
+@pytest.mark.parametrize("first_frame", ["[1, 2]", "42", '"token"', "null", "{nao e json"])
+@pytest.mark.parametrize("path", ["/ws/session", "/ws/notifications", "/ws/topic:x"])
+def test_handshake_that_is_not_an_object_closes_cleanly(client, path, first_frame):
+    with client.websocket_connect(path) as ws:
+        ws.send_text(first_frame)
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+    assert closed.value.code == 1000
+
+
+def test_send_to_user_reaches_tabs_on_every_worker(app_module):
+    d = app_module
+
+    async def scenario():
+        hub = []
+        managers, sockets = [], []
+        for node in ("a", "b"):
+            backplane = d.LocalBackplane(node, hub)
+            manager = d.RoomManager(backplane)
+            await backplane.start(manager.handle_event)
+            ws = FakeSocket()
+            manager.attach(ws, {"id": "u1", "name": "alice"})
+            manager.join("topic:x", ws)
+            managers.append(manager)
+            sockets.append(ws)
+        await managers[0].send_to_user("u1", "topic:x", {"type": "voice_offer", "from": "u2", "offer": "sdp"})
+        await asyncio.sleep(0.05)
+        for manager in managers:
+            for conn in manager.conns.values():
+                conn.stop()
+        return [[f for f in ws.sent if f["type"] == "voice_offer"] for ws in sockets]
+
+    local, remote = asyncio.run(scenario())
+    assert local == remote == [{"type": "voice_offer", "from": "u2", "offer": "sdp", "room": "topic:x"}]
@@ -0,0 +1,31 @@
+import asyncio
+
+from conftest import FakeSocket, room_manager, stop_all
+
+
+def test_typing_set_is_coalesced_and_expires_in_one_frame(app_module):
+    d = app_module
+
+    async def scenario():
+        manager = room_manager(d)
+        ws = FakeSocket()
+        manager.attach(ws, {"id": "leitor", "name": "leitor"})
+        manager.join("topic:x", ws)
+        tracker = d.TypingTracker(manager, ttl=0.05, interval=0.01)
+        tracker.typing("topic:x", "a")
+        tracker.typing("topic:x", "b")
+        tracker.typing("topic:x", "a")  # renovação: nenhum frame novo
+        tracker.flush()
+        tracker.typing("topic:x", "b")
+        tracker.flush()
+        await asyncio.sleep(0.06)
+        tracker.flush()  # a e b expiram juntos: um typing_set vazio
+        tracker.flush()
+        await asyncio.sleep(0.01)
+        frames = [f["users"] for f in ws.sent if f["type"] == "typing_set"]
+        stop_all(manager)
+        return frames, tracker.expired, tracker.suppressed
+
+    frames, expired, suppressed = asyncio.run(scenario())
+    assert frames == [["a", "b"], []]
+    assert expired == 2 and suppressed == 2
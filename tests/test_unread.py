@@ -0,0 +1,70 @@
+import contextlib
+
+import pytest
+
+from conftest import receive_until
+
+
+@pytest.fixture(scope="module")
+def dm(client, register):
+    """DM entre alice e bob; devolve (room_id, alice_headers, alice_token, bob_token)."""
+    alice, ha = register("alice")
+    _, hb = register("bob")
+    client.post("/api/friends/request", data={"username": "bob"}, headers=ha)
+    client.post("/api/friends/accept", data={"friend_id": alice["id"]}, headers=hb)
+    room_id = "dm:" + client.get("/api/dm-chats", headers=ha).json()[0]["id"]
+    return room_id, ha, ha["Authorization"].split()[1], hb["Authorization"].split()[1]
+
+
+def send(client, token, room_id, contents):
+    ids = []
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        for content in contents:
+            ws.send_json({"type": "message", "room": room_id, "content": content})
+            ids.append(receive_until(ws, "message_committed")["id"])
+    return ids
+
+
+@contextlib.contextmanager
+def present(client, token, room_id):
+    """Usuário com o room aberto (no modo "counter" só quem está no room ganha não lidas)."""
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        yield ws
+
+
+def mark_read(client, token, room_id, msg_id):
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        ws.send_json({"type": "mark_read", "room": room_id, "msg_id": msg_id})
+        ws.send_json({"type": "ping"})
+        receive_until(ws, "pong")
+
+
+def unread(client, headers, room_id):
+    return client.get("/api/unread", headers=headers).json().get(room_id, 0)
+
+
+def test_counts_and_mark_read(client, app_module, dm):
+    room_id, ha, alice_token, bob_token = dm
+    with present(client, alice_token, room_id):
+        ids = send(client, bob_token, room_id, ["a", "b", "c"])
+    assert unread(client, ha, room_id) == 3
+    mark_read(client, alice_token, room_id, ids[-1])
+    assert unread(client, ha, room_id) == 0
+    with present(client, alice_token, room_id):
+        send(client, bob_token, room_id, ["d"])
+    assert unread(client, ha, room_id) == 1
+
+
+def test_mark_read_past_the_last_message_does_not_hide_new_ones(client, app_module, dm):
+    room_id, ha, alice_token, bob_token = dm
+    mark_read(client, alice_token, room_id, 10**12)
+    assert unread(client, ha, room_id) == 0
+    with present(client, alice_token, room_id):
+        send(client, bob_token, room_id, ["e", "f"])
+    assert unread(client, ha, room_id) == 2
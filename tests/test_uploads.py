@@ -0,0 +1,69 @@
+import hashlib
+import os
+import time
+
+from conftest import receive_until
+
+
+
+
+def test_avatar_upload_updates_profile(client, register):
+    user, headers = register("avatar")
+    r = client.post("/api/me/avatar", files={"file": ("eu.png", b"\x89PNG\r\n\x1a\nfake")}, headers=headers)
+    assert r.status_code == 200, r.text
+    url = r.json()["avatar_image"]
+    assert url.startswith("/static/avatars/avatar_" + user["id"])
+    assert client.get("/api/me", headers=headers).json()["avatar_image"] == url
+    bad = client.post("/api/me/avatar", files={"file": ("eu.exe", b"MZ")}, headers=headers)
+    assert bad.status_code == 400
+
+
+def _refs(d, sha256):
+    with d.db_conn(d.MESSAGES_DB) as conn:
+        row = conn.execute("SELECT refs FROM uploads WHERE sha256 = ?", (sha256,)).fetchone()
+    return None if row is None else row[0]
+
+
+def test_same_content_is_stored_once(client, app_module, register):
+    _, headers = register("dedup")
+    first = client.post("/api/upload", files={"file": ("a.txt", b"mesmo conteudo")}, headers=headers).json()
+    again = client.post("/api/upload", files={"file": ("b.png", b"mesmo conteudo")}, headers=headers).json()
+    assert first["sha256"] == hashlib.sha256(b"mesmo conteudo").hexdigest()
+    assert not first["deduplicated"] and again["deduplicated"]
+    # Nome próprio por upload, com a extensão de quem enviou, e um arquivo só no disco
+    assert again["url"] != first["url"] and again["url"].endswith(".png") and first["url"].endswith(".txt")
+    assert os.path.samefile(app_module._upload_path(first["url"]), app_module._upload_path(again["url"]))
+    assert not os.listdir(app_module.UPLOAD_TMP_DIR)
+
+
+def test_upload_url_is_not_derived_from_content(client, register):
+    _, headers = register("privado")
+    r = client.post("/api/upload", files={"file": ("c.txt", b"so meu")}, headers=headers).json()
+    assert r["sha256"] not in r["url"]
+    assert client.post("/api/upload/by-hash", data={"sha256": r["sha256"]}, headers=headers).status_code in (404, 405)
+
+
+def test_refcounts_follow_messages_and_sweeper_removes_orphans(client, app_module, register):
+    d = app_module
+    _, headers = register("refs")
+    kept = client.post("/api/upload", files={"file": ("k.txt", b"referenciado")}, headers=headers).json()
+    other_name = client.post("/api/upload", files={"file": ("k2.txt", b"referenciado")}, headers=headers).json()
+    orphan = client.post("/api/upload", files={"file": ("o.txt", b"sem mensagem")}, headers=headers).json()
+    orphan_again = client.post("/api/upload", files={"file": ("o.pdf", b"sem mensagem")}, headers=headers).json()
+    circle = client.post("/api/circles", data={"name": "arquivos"}, headers=headers).json()
+    room_id = "topic:" + client.get(f"/api/circles/{circle['id']}", headers=headers).json()["topics"][0]["id"]
+    with client.websocket_connect("/ws/session") as ws:
+        ws.send_json({"token": headers["Authorization"].split()[1], "rooms": [{"room": room_id}]})
+        receive_until(ws, "users")
+        ids = []
+        for url in (kept["url"], other_name["url"]):
+            ws.send_json({"type": "message", "room": room_id, "content": "", "file_url": url})
+            ids.append(receive_until(ws, "message_committed")["id"])
+    assert _refs(d, kept["sha256"]) == 2 and _refs(d, orphan["sha256"]) == 0
+    assert client.delete(f"/api/messages/{ids[0]}", headers=headers).status_code == 200
+    assert _refs(d, kept["sha256"]) == 1
+
+    assert d.upload_sweeper.sweep(now=time.time() + d.UPLOAD_GC_GRACE_S + 60) >= 1
+    assert _refs(d, orphan["sha256"]) is None and not os.path.exists(d._upload_path(orphan["url"]))
+    assert not os.path.exists(d._upload_path(orphan_again["url"]))
+    assert _refs(d, kept["sha256"]) == 1 and os.path.exists(d._upload_path(kept["url"]))
@@ -0,0 +1,46 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def searcher(client):
+    headers = {}
+    for username, display_name in [("eu", "Eu Mesmo"), ("marina", "Marina Costa"), ("mariana", "Mariana Silva"),
+                                   ("zeca", "José Carlos"), ("maria_b", "Maria")]:
+        r = client.post("/api/register", data={"username": username, "password": "pw", "display_name": display_name})
+        assert r.status_code == 200, r.text
+        headers[username] = ({"Authorization": "Bearer " + r.json()["token"]}, r.json()["user"]["id"])
+    client.post("/api/friends/request", data={"username": "mariana"}, headers=headers["eu"][0])
+    client.post("/api/friends/accept", data={"friend_id": headers["eu"][1]}, headers=headers["mariana"][0])
+    return headers["eu"][0]
+
+
+def search(client, headers, q):
+    r = client.get("/api/users/search", params={"q": q}, headers=headers)
+    assert r.status_code == 200, r.text
+    return [(u["username"], u["relation"]) for u in r.json()]
+
+
+def test_prefix_is_case_insensitive_and_friends_come_first(client, searcher):
+    expected = [("mariana", "friend"), ("maria_b", None), ("marina", None)]
+    assert search(client, searcher, "mar") == expected
+    assert search(client, searcher, "MARI") == expected
+
+
+def test_substring_and_display_name(client, searcher):
+    assert search(client, searcher, "ian") == [("mariana", "friend")]
+    assert search(client, searcher, "costa") == [("marina", None)]
+    assert search(client, searcher, "carlos") == [("zeca", None)]
+
+
+def test_accents_are_ignored(client, searcher):
+    assert search(client, searcher, "josé") == search(client, searcher, "jose") == [("zeca", None)]
+
+
+def test_typos_still_match(client, searcher):
+    assert ("marina", None) in search(client, searcher, "marima")
+    assert ("mariana", "friend") in search(client, searcher, "marnia")
+
+
+def test_empty_query(client, searcher):
+    assert search(client, searcher, "") == []
+    assert search(client, searcher, "   ") == []
@@ -0,0 +1,121 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from conftest import receive_until
+
+
+@pytest.fixture(scope="module")
+def session(client, register):
+    user, headers = register("alice")
+    circle = client.post("/api/circles", data={"name": "escrita"}, headers=headers).json()
+    topic_id = client.get(f"/api/circles/{circle['id']}", headers=headers).json()["topics"][0]["id"]
+    return user, "topic:" + topic_id, headers["Authorization"].split()[1]
+
+
+@pytest.fixture
+def failing_writes(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "_apply_write_batch", lambda ops: [sqlite3.OperationalError("disk I/O error")] * len(ops))
+
+
+def _connect(client, token, room_id):
+    ws = client.websocket_connect("/ws/session")
+    ws.__enter__()
+    ws.send_json({"token": token, "rooms": [{"room": room_id}]})
+    receive_until(ws, "users")
+    return ws
+
+
+def _still_open(ws):
+    ws.send_json({"type": "ping"})
+    receive_until(ws, "pong")
+
+
+@pytest.mark.parametrize("durability", ["batched", "sync"])
+def test_failed_message_write_keeps_socket_open(client, app_module, session, failing_writes, monkeypatch, durability):
+    user, room_id, token = session
+    monkeypatch.setattr(app_module, "WRITE_DURABILITY", durability)
+    ws = _connect(client, token, room_id)
+    try:
+        ws.send_json({"type": "message", "room": room_id, "content": "nao grava"})
+        failed = receive_until(ws, "message_failed")
+        assert failed["room"] == room_id and failed["user_id"] == user["id"] and failed["seq"]
+        _still_open(ws)
+    finally:
+        ws.__exit__(None, None, None)
+
+
+def test_failed_reaction_write_keeps_socket_open(client, app_module, session, failing_writes):
+    user, room_id, token = session
+    ws = _connect(client, token, room_id)
+    try:
+        ws.send_json({"type": "reaction", "room": room_id, "msg_id": 1, "emoji": "👍"})
+        failed = receive_until(ws, "reaction_failed")
+        assert failed["msg_id"] == 1 and failed["room"] == room_id
+        _still_open(ws)
+    finally:
+        ws.__exit__(None, None, None)
+
+
+def _record(app_module, room_id, user, content):
+    return {"room_id": room_id, "user_id": user["id"], "user_name": user["username"], "user_color": "#fff",
+            "user_avatar": None, "content": content, "msg_type": "text", "file_url": None, "reply_to_id": None,
+            "reply_to_user": None, "reply_to_content": None, "timestamp": "2026-01-01T00:00:00", "recipients": []}
+
+
+def _count(app_module, room_id):
+    with app_module.db_conn(app_module.MESSAGES_DB) as conn:
+        return conn.execute("SELECT COUNT(*) FROM messages WHERE room_id=?", (room_id,)).fetchone()[0]
+
+
+def test_close_flushes_the_batch_in_progress(client, app_module, session):
+    user, room_id, _ = session
+    before = _count(app_module, room_id)
+    writer = app_module.MessageWriter(flush_ms=1000)
+    committed = []
+
+    async def scenario():
+        writer.start()
+        futs = []
+        for i in range(3):
+            async def on_commit(msg_id):
+                committed.append(msg_id)
+            futs.append(writer.submit("message", _record(app_module, room_id, user, f"fim {i}"), on_commit=on_commit))
+        # O writer já puxou as ops para o lote e espera flush_interval por mais
+        await asyncio.sleep(0.05)
+        await writer.close()
+        return [f.result() for f in futs]
+
+    ids = asyncio.run(scenario())
+    assert len(ids) == 3 and committed == ids
+    assert writer.committed == 3
+    assert _count(app_module, room_id) == before + 3
+
+
+def test_cancelled_waiter_does_not_kill_the_writer(client, app_module, session, monkeypatch):
+    user, room_id, _ = session
+    writer = app_module.MessageWriter(flush_ms=1)
+    calls = []
+
+    def flaky(ops):
+        calls.append(len(ops))
+        if len(calls) == 1:
+            return [sqlite3.OperationalError("disk I/O error")] * len(ops)
+        return [-1] * len(ops)
+
+    monkeypatch.setattr(app_module, "_apply_write_batch", flaky)
+    monkeypatch.setattr(writer, "_update_cache", lambda op, result: None)
+
+    async def scenario():
+        writer.start()
+        waiter = asyncio.ensure_future(writer.submit("message", _record(app_module, room_id, user, "x")))
+        await asyncio.sleep(0)
+        waiter.cancel()  # handler sync cancelado (cliente caiu) enquanto o lote falha
+        await asyncio.sleep(0.05)
+        ok = await asyncio.wait_for(writer.submit("message", _record(app_module, room_id, user, "y")), 1)
+        await writer.close()
+        return ok
+
+    assert asyncio.run(scenario()) == -1
+    assert writer.failed == 1 and writer.committed == 1